@@ -1,5 +1,7 @@
-from flask import Flask, render_template, request, jsonify, Response, session, redirect, url_for, send_from_directory, g, current_app, send_file
+from flask import Flask, render_template, request, jsonify, Response, session, redirect, url_for, send_from_directory, g, current_app, send_file, has_app_context
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
 import os
 import socket
 import ssl
@@ -11,17 +13,38 @@ import subprocess
 import threading
 from threading import Thread
 import psutil
+import queue
+import random
 import re
+import gzip
+import io
+import multiprocessing
+import shutil
+import tarfile
+import zipfile
+import zlib
+from collections import deque
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime
 from dotenv import load_dotenv
 from jinja2 import ChoiceLoader, FileSystemLoader
 import argparse
+import base64
+import bisect
+import hashlib
+import html
+import tempfile
+import unicodedata
 import logging
 import webbrowser
 from flask_cors import CORS
 import sqlite3
 import markdown2
-from reportlab.lib.pagesizes import letter
+from reportlab.lib.pagesizes import letter, A4
+from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
+from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Preformatted
 from reportlab.pdfgen import canvas
 from io import BytesIO
 import textwrap
@@ -45,7 +68,7 @@ app.jinja_loader = ChoiceLoader([
 app.secret_key = os.urandom(24)  # Required for session management
 load_dotenv()
 
-OLLAMA_BASE_URL = "http://localhost:11434"  # Always use HTTP for Ollama
+OLLAMA_BASE_URL = os.getenv('OLLAMA_BASE_URL', 'http://localhost:11434')  # Always use HTTP for Ollama
 
 MODEL_SPECS = {
     "deepseek-r1:7b": {
@@ -66,31 +89,255 @@ MODEL_SPECS = {
     }
 }
 
+OLLAMA_POOL_SIZE = int(os.getenv('OLLAMA_POOL_SIZE', '32'))  # Max keep-alive connections held open to Ollama
+OLLAMA_CONNECT_RETRIES = int(os.getenv('OLLAMA_CONNECT_RETRIES', '2'))  # Extra attempts after a connection error
+OLLAMA_RETRY_BACKOFF = float(os.getenv('OLLAMA_RETRY_BACKOFF', '0.25'))  # Base delay (seconds) between retries
+
+# (connect, read) timeouts per kind of Ollama operation; None means wait indefinitely
+OLLAMA_TIMEOUTS = {
+    'health': (2, float(os.getenv('OLLAMA_HEALTH_TIMEOUT', '3'))),
+    'generate': (5, float(os.getenv('OLLAMA_GENERATE_TIMEOUT', '300'))),
+    'pull': (5, None),
+    'warmup': (5, float(os.getenv('OLLAMA_WARMUP_TIMEOUT', '300')))
+}
+
+def is_connect_failure(error):
+    """Whether a request failed before reaching Ollama, so sending it again cannot run it twice"""
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    cause = error.args[0] if error.args else None
+    return isinstance(getattr(cause, 'reason', cause), NewConnectionError)  # requests wraps it in a MaxRetryError
+
+class OllamaClient:
+    """Shared, thread-safe HTTP client for the Ollama API backed by a keep-alive connection pool"""
+
+    def __init__(self, base_url=OLLAMA_BASE_URL, pool_size=OLLAMA_POOL_SIZE, retries=OLLAMA_CONNECT_RETRIES,
+                 backoff=OLLAMA_RETRY_BACKOFF, timeouts=None):
+        self.base_url = base_url.rstrip('/')
+        self.pool_size = pool_size
+        self.retries = retries
+        self.backoff = backoff
+        self.timeouts = dict(OLLAMA_TIMEOUTS, **(timeouts or {}))
+        self._lock = threading.Lock()
+        self._retried = 0
+        self._failed = 0
+        self.session = self._new_session()
+
+    def _new_session(self):
+        session = requests.Session()
+        session.headers.update({'Connection': 'keep-alive'})
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size, pool_block=False, max_retries=0)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+    def reset(self):
+        """Drop pooled connections, e.g. in a forked worker that must not share its parent's sockets"""
+        self.session = self._new_session()
+
+    def request(self, method, path, operation, retries=None, **kwargs):
+        """Send a request, retrying with jittered exponential backoff when Ollama cannot be connected to"""
+        kwargs.setdefault('timeout', self.timeouts[operation])
+        retries = self.retries if retries is None else retries
+        url = f"{self.base_url}{path}"
+        for attempt in range(retries + 1):
+            try:
+                started = time.monotonic()
+                response = self.session.request(method, url, **kwargs)
+                metrics.observe('ollama_request_seconds', operation, time.monotonic() - started)
+                return response
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                # Once the request is sent (a dropped connection, a read timeout) Ollama may already be
+                # running it, and a chat or pull must not run twice; only connection setup is retried
+                if not is_connect_failure(e) or attempt == retries:
+                    with self._lock:
+                        self._failed += 1
+                    raise
+                delay = self.backoff * (2 ** attempt) * random.uniform(0.5, 1.5)
+                logger.warning(f"Connection to Ollama failed ({operation}), retrying in {delay:.2f}s: {str(e)}")
+                with self._lock:
+                    self._retried += 1
+                time.sleep(delay)
+
+    def tags(self, timeout=None, retries=None):
+        """GET /api/tags"""
+        kwargs = {'timeout': timeout} if timeout is not None else {}
+        return self.request('GET', '/api/tags', 'health', retries=retries, **kwargs)
+
+    def chat(self, payload, stream=True):
+        """POST /api/chat"""
+        return self.request('POST', '/api/chat', 'generate', json=dict(payload, stream=stream), stream=stream)
+
+    def pull(self, model_name, stream=False):
+        """POST /api/pull"""
+        return self.request('POST', '/api/pull', 'pull', json={'name': model_name, 'stream': stream}, stream=stream)
+
+    def load(self, model_name, keep_alive=None, options=None):
+        """Load a model into memory without generating anything (an /api/chat request with no messages).
+
+        Pass the options generations will use: Ollama reloads a model whose
+        ``num_ctx`` changes.
+        """
+        payload = {'model': model_name, 'messages': [], 'stream': False}
+        if keep_alive is not None:
+            payload['keep_alive'] = keep_alive
+        if options:
+            payload['options'] = options
+        return self.request('POST', '/api/chat', 'warmup', json=payload)
+
+    def unload(self, model_name):
+        """Ask Ollama to release a model's memory now"""
+        return self.request('POST', '/api/generate', 'warmup', json={'model': model_name, 'keep_alive': 0, 'stream': False})
+
+    def ps(self):
+        """GET /api/ps: the models currently loaded and their memory use"""
+        return self.request('GET', '/api/ps', 'health')
+
+    def stats(self):
+        """Connection pool counters: hits reuse a kept-alive connection, misses open a new one"""
+        requests_made = connections_opened = idle = 0
+        pools = self.session.get_adapter(self.base_url).poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            requests_made += pool.num_requests
+            connections_opened += pool.num_connections
+            idle += sum(1 for conn in list(pool.pool.queue) if conn is not None) if pool.pool else 0
+        with self._lock:
+            return {
+                'pool_size': self.pool_size,
+                'requests': requests_made,
+                'pool_hits': max(requests_made - connections_opened, 0),
+                'pool_misses': connections_opened,
+                'idle_connections': idle,
+                'retries': self._retried,
+                'failures': self._failed
+            }
+
+ollama_client = OllamaClient()
+
+OLLAMA_HEALTH_INTERVAL = float(os.getenv('OLLAMA_HEALTH_INTERVAL', '10'))  # Seconds between probes while Ollama is up
+OLLAMA_HEALTH_TIMEOUT = OLLAMA_TIMEOUTS['health'][1]  # Hard timeout for a single probe
+OLLAMA_HEALTH_MAX_BACKOFF = float(os.getenv('OLLAMA_HEALTH_MAX_BACKOFF', '60'))  # Longest wait between probes while Ollama is down
+
+class OllamaHealthMonitor:
+    """Background thread that keeps a cached snapshot of the Ollama service status"""
+
+    def __init__(self, interval=OLLAMA_HEALTH_INTERVAL, timeout=OLLAMA_HEALTH_TIMEOUT, max_backoff=OLLAMA_HEALTH_MAX_BACKOFF):
+        self.interval = interval
+        self.timeout = timeout
+        self.max_backoff = max_backoff
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._first_probe = threading.Event()
+        self._thread = None
+        self._pid = None
+        self._snapshot = {
+            'status': 'unknown',
+            'up': False,
+            'models': [],
+            'error': 'Ollama status has not been checked yet',
+            'latency_ms': None,
+            'checked_at': None,
+            'consecutive_failures': 0,
+            'next_check_in': None
+        }
+
+    def probe(self):
+        """Query /api/tags once and update the snapshot"""
+        started = time.monotonic()
+        up, models, error = False, [], None
+        try:
+            # The monitor backs off on its own, so probes are not retried
+            response = ollama_client.tags(timeout=(min(2, self.timeout), self.timeout), retries=0)
+            if response.status_code == 200:
+                up = True
+                models = [m['name'] for m in response.json().get('models', [])]
+            else:
+                error = f"Ollama service returned status code {response.status_code}"
+        except requests.exceptions.Timeout:
+            error = f"Ollama service did not answer within {self.timeout}s"
+        except requests.exceptions.ConnectionError:
+            error = "Could not connect to Ollama service. Is it running?"
+        except Exception as e:
+            error = f"Error checking Ollama status: {str(e)}"
+        latency_ms = round((time.monotonic() - started) * 1000, 1)
+
+        with self._lock:
+            was_up = self._snapshot['up']
+            failures = 0 if up else self._snapshot['consecutive_failures'] + 1
+            self._snapshot = {
+                'status': 'up' if up else 'down',
+                'up': up,
+                'models': models if up else self._snapshot['models'],
+                'error': error,
+                'latency_ms': latency_ms,
+                'checked_at': datetime.now().isoformat(),
+                'consecutive_failures': failures,
+                'next_check_in': self._next_delay(failures)
+            }
+        self._first_probe.set()
+
+        if up and not was_up:
+            logger.info(f"Ollama service is running. Available models: {models}")
+        elif not up and (was_up or failures == 1):
+            logger.error(error)
+        return self.snapshot()
+
+    def _next_delay(self, failures):
+        if failures == 0:
+            return self.interval
+        return min(self.interval * (2 ** (failures - 1)), self.max_backoff)
+
+    def _run(self):
+        while True:
+            delay = self.probe()['next_check_in']
+            self._wake.wait(delay)
+            self._wake.clear()
+
+    def start(self):
+        """Start the monitor thread (again, after a fork) if it is not running"""
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive() and self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._first_probe.clear()
+            self._thread = Thread(target=self._run, name='ollama-health', daemon=True)
+            self._thread.start()
+
+    def refresh(self):
+        """Ask the monitor thread to probe now instead of waiting for the next tick"""
+        self._wake.set()
+
+    def wait(self, timeout=None):
+        """Block until the first probe has finished, for startup code; request handlers use snapshot()"""
+        self.start()
+        return self._first_probe.wait(self.timeout if timeout is None else timeout)
+
+    def snapshot(self):
+        """Return a copy of the latest status without doing any network I/O or waiting.
+        Its status is 'unknown' until the first probe in this process has finished."""
+        self.start()
+        with self._lock:
+            return dict(self._snapshot, models=list(self._snapshot['models']))
+
+ollama_health = OllamaHealthMonitor()
+
 def check_ollama_status():
-    """Check if Ollama service is running and accessible"""
-    try:
-        logger.info("Checking Ollama service status...")
-        response = requests.get(f"{OLLAMA_BASE_URL}/api/tags")
-        
-        if response.status_code == 200:
-            models = response.json().get('models', [])
-            logger.info(f"Ollama service is running. Available models: {[m['name'] for m in models]}")
-            return True, None
-        else:
-            error_msg = f"Ollama service returned status code {response.status_code}"
-            logger.error(error_msg)
-            return False, error_msg
-    except requests.exceptions.ConnectionError:
-        error_msg = "Could not connect to Ollama service. Is it running?"
-        logger.error(error_msg)
-        return False, error_msg
-    except Exception as e:
-        error_msg = f"Error checking Ollama status: {str(e)}"
-        logger.error(error_msg)
-        return False, error_msg
+    """Check if Ollama service is running and accessible, using the cached health snapshot.
+    Returns None instead of True/False while the status is still unknown."""
+    status = ollama_health.snapshot()
+    if status['up']:
+        return True, None
+    if status['status'] == 'unknown':
+        return None, status['error']
+    return False, status['error']
 
 def init_app():
     logger.info("Initializing application...")
+    ollama_health.wait()
+    model_residency.start()
     ollama_status, error = check_ollama_status()
     if not ollama_status:
         logger.error(f"Ollama service check failed: {error}")
@@ -99,16 +346,15 @@ def init_app():
 @app.route('/')
 def index():
     logger.info("Accessing landing page...")
-    ollama_status, error = check_ollama_status()
-    if not ollama_status:
+    ollama_running, error = check_ollama_status()
+    if ollama_running is False:
         logger.warning(f"Ollama service not available: {error}")
     # If a model is already selected and initialized, redirect to chat
     if 'model' in session:
         return redirect(url_for('chat'))
     
     try:    
-        ollama_running = check_ollama_status()[0]
-        logger.info(f"Ollama status: {'running' if ollama_running else 'not running'}")
+        logger.info(f"Ollama status: {'unknown' if ollama_running is None else 'running' if ollama_running else 'not running'}")
         
         cert_path = os.path.join(os.path.dirname(__file__), 'ssl', 'cert.pem')
         key_path = os.path.join(os.path.dirname(__file__), 'ssl', 'key.pem')
@@ -117,11 +363,134 @@ def index():
         
         return render_template('landing.html', 
                              models=MODEL_SPECS, 
-                             ollama_running=ollama_running)
+                             ollama_running=ollama_running is not False)
     except Exception as e:
         logger.error(f"Error in index route: {str(e)}")
         return f"Error loading page: {str(e)}", 500
 
+@app.route('/health')
+def health():
+    """Expose the cached Ollama health snapshot"""
+    status = ollama_health.snapshot()
+    return jsonify({
+        'status': 'ok' if status['up'] else 'unknown' if status['status'] == 'unknown' else 'degraded',
+        'ollama': status,
+        'client': ollama_client.stats(),
+        'response_cache': response_cache.stats(),
+        'scheduler': generation_scheduler.stats(),
+        'residency': model_residency.stats(),
+        'generations': generation_sessions.stats()
+    }), 200 if status['up'] else 503
+
+def prometheus_labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for v in labels.values())
+    return '{' + ','.join(f'{key}="{value}"' for key, value in zip(labels, escaped)) + '}'
+
+def render_metrics():
+    """Request-path histograms and the health, client, cache, scheduler and residency stats
+    in the Prometheus text format. Values are per process."""
+    lines = []
+
+    def family(name, kind, help_text):
+        lines.append(f"# HELP guria_{name} {help_text}")
+        lines.append(f"# TYPE guria_{name} {kind}")
+
+    def sample(name, value, **labels):
+        lines.append(f"guria_{name}{prometheus_labels(labels)} {value}")
+
+    def histogram(name, snapshot, **labels):
+        for bound, count in snapshot['buckets'].items():
+            sample(f"{name}_bucket", count, **labels, le=bound)
+        sample(f"{name}_sum", snapshot['sum'], **labels)
+        sample(f"{name}_count", snapshot['count'], **labels)
+
+    collected = metrics.collect()
+    for name, (help_text, label_name, bounds) in METRIC_SERIES.items():
+        family(name, 'histogram', help_text)
+        for (series, label), cells in sorted(collected.items()):
+            if series == name:
+                histogram(name, metric_cells_snapshot(bounds, cells), **{label_name: label})
+
+    family('ollama_up', 'gauge', 'Whether the last Ollama health probe succeeded')
+    sample('ollama_up', int(ollama_health.snapshot()['up']))
+
+    client = ollama_client.stats()
+    for key, help_text in (('requests', 'Requests sent to Ollama'),
+                           ('pool_misses', 'Connections opened to Ollama'),
+                           ('retries', 'Ollama requests retried after a connection error'),
+                           ('failures', 'Ollama requests that failed after retrying')):
+        family(f"ollama_{key}_total", 'counter', help_text)
+        sample(f"ollama_{key}_total", client[key])
+
+    cache = response_cache.stats()
+    for key, help_text in (('hits', 'Generations replayed from the response cache'),
+                           ('misses', 'Cacheable generations not found in the response cache'),
+                           ('stores', 'Generations stored in the response cache'),
+                           ('evictions', 'Response cache entries evicted'),
+                           ('bytes_saved', 'Response bytes served from the response cache')):
+        family(f"response_cache_{key}_total", 'counter', help_text)
+        sample(f"response_cache_{key}_total", cache[key])
+
+    scheduler = generation_scheduler.stats()
+    for key, help_text in (('admitted', 'Generations given a slot or a place in the queue'),
+                           ('rejected', 'Generations turned away because the queue was full'),
+                           ('abandoned', 'Queued generations whose client left before they started')):
+        family(f"generations_{key}_total", 'counter', help_text)
+        sample(f"generations_{key}_total", scheduler[key])
+    for key, help_text in (('active', 'Generations running'), ('queued', 'Generations waiting for a slot'),
+                           ('limit', 'Concurrent generations allowed')):
+        family(f"generations_{key}", 'gauge', help_text)
+        for model, lane in sorted(scheduler['models'].items()):
+            sample(f"generations_{key}", lane[key], model=model)
+
+    residency = model_residency.stats()
+    family('model_ram_budget_bytes', 'gauge', 'Memory budget for loaded models')
+    sample('model_ram_budget_bytes', residency['budget_bytes'])
+    family('model_resident_bytes', 'gauge', 'Estimated memory used by loaded models')
+    sample('model_resident_bytes', residency['resident_bytes'])
+    family('model_resident', 'gauge', 'Whether the model is loaded in Ollama')
+    for model, state in sorted(residency['models'].items()):
+        sample('model_resident', int(state['resident']), model=model)
+    for key, help_text in (('loads', 'Model loads'), ('unloads', 'Model unloads'),
+                           ('evictions', 'Models unloaded to stay within the memory budget')):
+        family(f"model_{key}_total", 'counter', help_text)
+        for model, state in sorted(residency['models'].items()):
+            sample(f"model_{key}_total", state[key], model=model)
+    family('model_cold_start_seconds', 'histogram', 'Time to load a model that was not in memory')
+    for model, state in sorted(residency['models'].items()):
+        histogram('model_cold_start_seconds', state['cold_start_seconds'], model=model)
+
+    return '\n'.join(lines) + '\n'
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """Prometheus scrape endpoint"""
+    try:
+        return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
+    except Exception as e:
+        logger.error(f"Error rendering metrics: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/metrics/summary')
+def metrics_summary():
+    """Count, mean, median and 95th percentile of each per-model series, optionally for one ``model``"""
+    only = request.args.get('model')
+    models = {}
+    for (name, label), cells in metrics.collect().items():
+        help_text, label_name, bounds = METRIC_SERIES[name]
+        if label_name != 'model' or (only and label != only):
+            continue
+        snapshot = metric_cells_snapshot(bounds, cells)
+        models.setdefault(label, {})[name] = {
+            'count': snapshot['count'],
+            'mean': round(snapshot['sum'] / snapshot['count'], 4) if snapshot['count'] else None,
+            'p50': round(histogram_quantile(0.5, snapshot), 4) if snapshot['count'] else None,
+            'p95': round(histogram_quantile(0.95, snapshot), 4) if snapshot['count'] else None
+        }
+    return jsonify({'models': models})
+
 @app.route('/chat')
 def chat_page():
     # If no model is selected, redirect to model selection
@@ -133,90 +502,1380 @@ def chat_page():
                          selected_model=session['model'],
                          ollama_running=ollama_running)
 
-@app.route('/chat', methods=['POST'])
-def chat():
+def sse_event(payload):
+    """Format a payload as a Server-Sent Events data frame"""
+    return f"data: {json.dumps(payload, separators=(',', ':'), ensure_ascii=False)}\n\n"
+
+SSE_COALESCE_MS = float(os.getenv('GURIA_SSE_COALESCE_MS', '40'))
+SSE_COALESCE_BYTES = int(os.getenv('GURIA_SSE_COALESCE_BYTES', '2048'))
+
+def coalesce_window(data):
+    """Per-request coalescing window in seconds from the optional ``coalesce_ms`` field (0 disables it)"""
     try:
-        data = request.get_json()
-        prompt = data.get('prompt', '')
-        model = data.get('model', session.get('model', 'llama2'))
-        chat_id = data.get('chat_id')
-        
-        if not prompt:
-            return jsonify({'error': 'No prompt provided'}), 400
-            
-        logger.info(f"Received chat request with model: {model}")
-        
-        # Check Ollama connection first
-        ollama_status, error = check_ollama_status()
-        if not ollama_status:
-            return jsonify({"error": f"Ollama service not available: {error}"}), 503
+        window_ms = float(data.get('coalesce_ms', SSE_COALESCE_MS))
+    except (TypeError, ValueError):
+        window_ms = SSE_COALESCE_MS
+    return min(max(window_ms, 0), 1000) / 1000
+
+class StreamCoalescer:
+    """Batch streamed text into fewer SSE frames of the form ``{key: text}``.
+
+    Text is sent straight away if nothing went out during the last ``window``
+    seconds, so slow streams are not delayed; otherwise it is buffered until the
+    window has passed or ``max_bytes`` is reached. Buffered text is not sent by
+    add() alone: the caller waits no longer than deadline() for more text and
+    calls flush_due() when it passes. Call flush() when the stream ends.
+    """
+
+    def __init__(self, key='response', window=SSE_COALESCE_MS / 1000, max_bytes=SSE_COALESCE_BYTES,
+                 clock=time.monotonic):
+        self.key = key
+        self.window = window
+        self.max_bytes = max_bytes
+        self.clock = clock
+        self.frames = 0
+        self._pending_key = key
+        self._pending = []
+        self._pending_bytes = 0
+        self._last_flush = float('-inf')
+
+    def add(self, text, key=None):
+        """Buffer ``text`` under ``key`` (default: the coalescer's key), returning any frames due, else ''.
+
+        Text under a different key than what is buffered sends the buffered text first.
+        """
+        if not text:
+            return ''
+        key = key or self.key
+        frames = self.flush() if self._pending and key != self._pending_key else ''
+        self._pending_key = key
+        self._pending.append(text)
+        self._pending_bytes += len(text)
+        if self._pending_bytes >= self.max_bytes or self.clock() - self._last_flush >= self.window:
+            return frames + self.flush()
+        return frames
 
-        def generate():
+    def deadline(self):
+        """``clock`` time by which the buffered text must go out, or None if nothing is buffered"""
+        return self._last_flush + self.window if self._pending else None
+
+    def flush_due(self):
+        """Frame for the buffered text once its window has passed, else ''"""
+        if self._pending and self.clock() >= self._last_flush + self.window:
+            return self.flush()
+        return ''
+
+    def flush(self):
+        """Frame for everything buffered so far, or an empty string if there is nothing"""
+        if not self._pending:
+            return ''
+        frame = sse_event({self._pending_key: ''.join(self._pending)})
+        self._pending = []
+        self._pending_bytes = 0
+        self._last_flush = self.clock()
+        self.frames += 1
+        return frame
+
+def load_model_profiles(spec):
+    """Profiles from GURIA_MODEL_PROFILES: inline JSON, or the path of a JSON file"""
+    spec = spec.strip()
+    if not spec:
+        return {}
+    if not spec.startswith('{'):
+        with open(spec) as f:
+            spec = f.read()
+    return json.loads(spec)
+
+def merge_profiles(*profiles):
+    """Overlay profiles left to right; ``options`` are merged key by key"""
+    merged = {'options': {}}
+    for profile in profiles:
+        for key, value in profile.items():
+            if key == 'options':
+                merged['options'].update(value)
+            else:
+                merged[key] = value
+    return merged
+
+# Generation settings per model, matched by name prefix: '' applies to every model and
+# 'deepseek-r1' to every deepseek-r1 tag. 'options' are Ollama model options (num_ctx,
+# num_predict, temperature, ...), 'system' is a system prompt and 'keep_alive' replaces
+# GURIA_MODEL_KEEP_ALIVE. GURIA_MODEL_PROFILES adds or overrides entries in the same shape.
+DEFAULT_MODEL_PROFILES = {
+    '': {'options': {'num_predict': 2048, 'temperature': 0.7, 'top_k': 40, 'top_p': 0.9}},
+    # DeepSeek's recommended sampling for R1; its reasoning needs room, and it works best without a system prompt
+    'deepseek-r1': {'options': {'num_predict': 4096, 'temperature': 0.6, 'top_p': 0.95}},
+}
+MODEL_PROFILES = {key: merge_profiles(DEFAULT_MODEL_PROFILES.get(key, {}), override)
+                  for key, override in {**DEFAULT_MODEL_PROFILES,
+                                        **load_model_profiles(os.getenv('GURIA_MODEL_PROFILES', ''))}.items()}
+
+def model_profile(model):
+    """Settings for ``model``: every profile whose prefix matches, most specific last"""
+    matching = sorted((key for key in MODEL_PROFILES if model.startswith(key)), key=len)
+    return merge_profiles(*(MODEL_PROFILES[key] for key in matching))
+
+def create_chat(conn, model, title, timestamp=None):
+    """Insert an empty conversation and return its id"""
+    timestamp = timestamp or datetime.now().isoformat()
+    cursor = conn.execute(
+        'INSERT INTO chats (model, title, timestamp, updated_at, message_count) VALUES (?, ?, ?, ?, 0)',
+        (model, title, timestamp, timestamp)
+    )
+    return cursor.lastrowid
+
+def append_messages(conn, chat_id, messages):
+    """Append messages to a conversation in one transaction.
+
+    Each message is a dict with ``role`` and ``content`` and optionally ``model``,
+    ``prompt_tokens``, ``completion_tokens`` and ``duration_ms``. The cost is one
+    row per message plus one counter update, however long the conversation is.
+    A transaction the caller already opened is left for the caller to commit.
+    Returns False if the conversation does not exist.
+    """
+    # IMMEDIATE takes the write lock up front so concurrent appends cannot reuse a seq
+    owns_transaction = not conn.in_transaction
+    if owns_transaction:
+        conn.execute('BEGIN IMMEDIATE')
+    try:
+        row = conn.execute('SELECT message_count FROM chats WHERE id = ?', (chat_id,)).fetchone()
+        if row is None:
+            if owns_transaction:
+                conn.rollback()
+            return False
+        now = datetime.now().isoformat()
+        conn.executemany(
+            '''INSERT INTO messages (chat_id, seq, role, content, model, prompt_tokens, completion_tokens, duration_ms, created_at)
+               VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+            [(chat_id, row[0] + offset + 1, message['role'], message['content'], message.get('model'),
+              message.get('prompt_tokens'), message.get('completion_tokens'), message.get('duration_ms'), now)
+             for offset, message in enumerate(messages)]
+        )
+        conn.execute(
+            'UPDATE chats SET message_count = message_count + ?, updated_at = ? WHERE id = ?',
+            (len(messages), now, chat_id)
+        )
+        if owns_transaction:
+            conn.commit()
+        return True
+    except Exception:
+        conn.rollback()
+        raise
+
+def load_messages(conn, chat_id):
+    """All messages of a conversation in order, read with one range scan over (chat_id, seq)"""
+    rows = conn.execute(
+        '''SELECT seq, role, content, model, prompt_tokens, completion_tokens, duration_ms, created_at
+           FROM messages WHERE chat_id = ? ORDER BY seq''',
+        (chat_id,)
+    ).fetchall()
+    return [{
+        'seq': row[0],
+        'role': row[1],
+        'content': row[2],
+        'model': row[3],
+        'prompt_tokens': row[4],
+        'completion_tokens': row[5],
+        'duration_ms': row[6],
+        'timestamp': row[7]
+    } for row in rows]
+
+def store_chat_response(model, prompt, full_response, chat_id=None, stats=None):
+    """Save a turn, returning ``(chat_id, message_id)``: its conversation and the answer's row.
+
+    A new conversation is started when ``chat_id`` is empty or no longer exists.
+    ``stats`` is Ollama's final ``done`` chunk, used for token counts and timing.
+    The answer of a generation still running is replaced later with
+    update_chat_response().
+    """
+    stats = stats or {}
+    turn = [
+        {'role': 'user', 'content': prompt, 'model': model},
+        {
+            'role': 'assistant',
+            'content': full_response,
+            'model': model,
+            'prompt_tokens': stats.get('prompt_eval_count'),
+            'completion_tokens': stats.get('eval_count'),
+            'duration_ms': stats['total_duration'] / 1e6 if stats.get('total_duration') else None
+        }
+    ]
+    started = time.monotonic()
+    with db_connection() as conn:
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            if not (chat_id and append_messages(conn, chat_id, turn)):
+                chat_id = create_chat(conn, model, prompt)
+                append_messages(conn, chat_id, turn)
+            message_id = conn.execute(
+                'SELECT id FROM messages WHERE chat_id = ? ORDER BY seq DESC LIMIT 1', (chat_id,)
+            ).fetchone()[0]
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+    metrics.observe('db_write_seconds', model, time.monotonic() - started)
+    return chat_id, message_id
+
+def update_chat_response(message_id, model, full_response, stats=None):
+    """Replace an answer saved by store_chat_response() and mark its conversation updated"""
+    stats = stats or {}
+    started = time.monotonic()
+    with db_connection() as conn:
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.execute(
+                'UPDATE messages SET content = ?, prompt_tokens = ?, completion_tokens = ?, duration_ms = ? WHERE id = ?',
+                (full_response, stats.get('prompt_eval_count'), stats.get('eval_count'),
+                 stats['total_duration'] / 1e6 if stats.get('total_duration') else None, message_id)
+            )
+            conn.execute(
+                'UPDATE chats SET updated_at = ? WHERE id = (SELECT chat_id FROM messages WHERE id = ?)',
+                (datetime.now().isoformat(), message_id)
+            )
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+    metrics.observe('db_write_seconds', model, time.monotonic() - started)
+
+CONTEXT_TOKEN_BUDGET = int(os.getenv('GURIA_CONTEXT_TOKEN_BUDGET', '2048'))  # History per turn when the profile sets no num_ctx
+CHARS_PER_TOKEN = 4  # Rough estimate; the history only needs to stay near its budget
+THINK_BLOCK = re.compile(r'<think>.*?</think>\s*', re.DOTALL)
+
+def history_budget(options):
+    """Tokens of history to send: what num_ctx leaves after the answer, else GURIA_CONTEXT_TOKEN_BUDGET.
+
+    The answer is given num_predict tokens but never more than half the window,
+    so a long num_predict (or -1, unlimited) still leaves room for the conversation.
+    """
+    num_ctx = options.get('num_ctx')
+    if not num_ctx:
+        return CONTEXT_TOKEN_BUDGET
+    num_predict = options.get('num_predict', -1)
+    return num_ctx - (num_ctx // 2 if num_predict < 0 else min(num_predict, num_ctx // 2))
+
+def history_messages(conn, chat_id, budget):
+    """The most recent messages of a conversation that fit in ``budget`` tokens, oldest first.
+
+    Messages are read newest first and reading stops once the budget is spent, so
+    the cost does not depend on how long the conversation is. Older messages that
+    do not fit are left out whole, and the chain of thought of earlier answers is
+    not sent back.
+    """
+    remaining = budget * CHARS_PER_TOKEN
+    messages = []
+    for role, content in conn.execute(
+            'SELECT role, content FROM messages WHERE chat_id = ? ORDER BY seq DESC', (chat_id,)):
+        if role == 'assistant':
+            content = THINK_BLOCK.sub('', content)
+        if len(content) > remaining:
+            break
+        remaining -= len(content)
+        messages.append({'role': role, 'content': content})
+    messages.reverse()
+    return messages
+
+def build_chat_payload(model, prompt, chat_id=None, system=None):
+    """/api/chat body for the next turn of a conversation.
+
+    Options come from the model's profile. The messages are the system prompt
+    (``system``, else the profile's), the recent history of ``chat_id`` and the
+    new prompt.
+    """
+    profile = model_profile(model)
+    options = profile['options']
+    system = system if system is not None else profile.get('system')
+    messages = [{'role': 'user', 'content': prompt}]
+    if chat_id:
+        budget = history_budget(options) - (len(prompt) + len(system or '')) // CHARS_PER_TOKEN
+        with db_connection() as conn:
+            messages = history_messages(conn, chat_id, budget) + messages
+    if system:
+        messages.insert(0, {'role': 'system', 'content': system})
+    return {
+        'model': model,
+        'messages': messages,
+        'keep_alive': model_residency.keep_alive(model),
+        'options': options
+    }
+
+def chunk_content(chunk):
+    """Text of an /api/chat stream chunk"""
+    message = chunk.get('message')
+    return message.get('content', '') if message else ''
+
+RESPONSE_CACHE_MODELS = {m.strip() for m in os.getenv('GURIA_RESPONSE_CACHE_MODELS', '').split(',') if m.strip()}
+RESPONSE_CACHE_ALLOW_SAMPLED = os.getenv('GURIA_RESPONSE_CACHE_ALLOW_SAMPLED', '0') == '1'
+RESPONSE_CACHE_MAX_BYTES = int(os.getenv('GURIA_RESPONSE_CACHE_MAX_BYTES', str(64 * 1024 * 1024)))
+RESPONSE_CACHE_TTL = int(os.getenv('GURIA_RESPONSE_CACHE_TTL', '86400'))
+RESPONSE_CACHE_REPLAY_DELAY = float(os.getenv('GURIA_RESPONSE_CACHE_REPLAY_DELAY_MS', '0')) / 1000
+
+RESPONSE_CACHE_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS response_cache (
+    key TEXT PRIMARY KEY,
+    model TEXT NOT NULL,
+    chunks TEXT NOT NULL,
+    done TEXT NOT NULL,
+    bytes INTEGER NOT NULL,
+    created_at REAL NOT NULL,
+    last_used REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_response_cache_last_used ON response_cache (last_used);
+'''
+
+class ResponseCache:
+    """Opt-in cache of complete generations, stored in SQLite with TTL and LRU eviction.
+
+    Entries are keyed on the model, the whitespace-normalized messages (system
+    prompt, history and prompt) and the sampling options. Only models listed in
+    GURIA_RESPONSE_CACHE_MODELS are cached, and only with deterministic options
+    (temperature 0) unless GURIA_RESPONSE_CACHE_ALLOW_SAMPLED is set.
+    """
+
+    def __init__(self, models=RESPONSE_CACHE_MODELS, allow_sampled=RESPONSE_CACHE_ALLOW_SAMPLED,
+                 max_bytes=RESPONSE_CACHE_MAX_BYTES, ttl=RESPONSE_CACHE_TTL):
+        self.models = models
+        self.allow_sampled = allow_sampled
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._stores = 0
+        self._evictions = 0
+        self._bytes_saved = 0
+
+    def key_for(self, payload):
+        """Cache key for an /api/chat payload, or None if it must not be cached"""
+        model = payload['model']
+        if model not in self.models and '*' not in self.models:
+            return None
+        options = payload.get('options', {})
+        if options.get('temperature', 0.8) != 0 and not self.allow_sampled:
+            return None
+        messages = [[message['role'], ' '.join(unicodedata.normalize('NFC', message['content']).split())]
+                    for message in payload['messages']]
+        material = json.dumps([model, messages, options], sort_keys=True)
+        return hashlib.sha256(material.encode()).hexdigest()
+
+    def get(self, key):
+        """Cached ``(chunks, done)`` for a key, or None on a miss"""
+        now = time.time()
+        with db_connection() as conn:
+            row = conn.execute(
+                'SELECT chunks, done, bytes FROM response_cache WHERE key = ? AND created_at > ?',
+                (key, now - self.ttl)
+            ).fetchone()
+            if row is not None:
+                conn.execute('UPDATE response_cache SET last_used = ? WHERE key = ?', (now, key))
+                conn.commit()
+        with self._lock:
+            if row is None:
+                self._misses += 1
+                return None
+            self._hits += 1
+            self._bytes_saved += row[2]
+        return json.loads(row[0]), json.loads(row[1])
+
+    def put(self, key, model, chunks, done):
+        """Store a finished generation, evicting expired and least recently used entries past max_bytes"""
+        # Token counts replay as-is; timings describe the original run only
+        done = {k: v for k, v in done.items() if k in ('eval_count', 'prompt_eval_count', 'done_reason')}
+        encoded_chunks = json.dumps([piece for piece in chunks if piece])
+        encoded_done = json.dumps(done)
+        size = len(encoded_chunks) + len(encoded_done)
+        if size > self.max_bytes:
+            return
+        now = time.time()
+        with db_connection() as conn:
+            conn.execute('BEGIN IMMEDIATE')
             try:
-                response = requests.post(
-                    f"{OLLAMA_BASE_URL}/api/generate",
-                    json={
-                        "model": model,
-                        "prompt": prompt,
-                        "stream": True,
-                        "options": {
-                            "num_predict": 2048,
-                            "temperature": 0.7,
-                            "top_k": 40,
-                            "top_p": 0.9
-                        }
-                    },
-                    stream=True,
-                    timeout=(5, 300)
+                conn.execute(
+                    'INSERT OR REPLACE INTO response_cache (key, model, chunks, done, bytes, created_at, last_used) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                    (key, model, encoded_chunks, encoded_done, size, now, now)
                 )
-                
-                if response.status_code != 200:
-                    yield f"data: {json.dumps({'error': 'Failed to get response from Ollama'})}\n\n"
-                    return
-                
-                full_response = ""
-                for line in response.iter_lines():
-                    if line:
-                        try:
-                            chunk_data = json.loads(line)
-                            if 'response' in chunk_data:
-                                full_response += chunk_data['response']
-                                yield f"data: {json.dumps({'response': chunk_data['response']})}\n\n"
-                            if chunk_data.get('done', False):
-                                # Save the complete response to database
-                                conn = get_db()
-                                cursor = conn.cursor()
-                                timestamp = datetime.now().isoformat()
-                                
-                                if not chat_id:
-                                    cursor.execute(
-                                        'INSERT INTO chats (model, prompt, response, timestamp) VALUES (?, ?, ?, ?)',
-                                        (model, prompt, full_response, timestamp)
-                                    )
-                                    conn.commit()
-                                    new_chat_id = cursor.lastrowid
-                                    yield f"data: {json.dumps({'chat_id': new_chat_id})}\n\n"
-                                else:
-                                    cursor.execute(
-                                        'UPDATE chats SET prompt = ?, response = ? WHERE id = ?',
-                                        (prompt, full_response, chat_id)
-                                    )
-                                    conn.commit()
-                        except json.JSONDecodeError:
-                            continue
-                
+                evicted = conn.execute('DELETE FROM response_cache WHERE created_at <= ?', (now - self.ttl,)).rowcount
+                excess = conn.execute('SELECT COALESCE(SUM(bytes), 0) FROM response_cache').fetchone()[0] - self.max_bytes
+                if excess > 0:
+                    victims = []
+                    for victim, victim_size in conn.execute(
+                            'SELECT key, bytes FROM response_cache ORDER BY last_used'):
+                        victims.append((victim,))
+                        excess -= victim_size
+                        if excess <= 0:
+                            break
+                    conn.executemany('DELETE FROM response_cache WHERE key = ?', victims)
+                    evicted += len(victims)
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+        with self._lock:
+            self._stores += 1
+            self._evictions += evicted
+
+    def replay(self, chunks, done, delay=RESPONSE_CACHE_REPLAY_DELAY):
+        """Yield a cached generation as Ollama stream chunks, optionally at a simulated token cadence"""
+        for piece in chunks:
+            yield {'message': {'role': 'assistant', 'content': piece}, 'done': False}
+            if delay:
+                time.sleep(delay)
+        yield dict(done, message={'role': 'assistant', 'content': ''}, done=True)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'enabled_models': sorted(self.models),
+                'hits': self._hits,
+                'misses': self._misses,
+                'stores': self._stores,
+                'evictions': self._evictions,
+                'bytes_saved': self._bytes_saved
+            }
+
+response_cache = ResponseCache()
+
+def iter_ndjson(response):
+    """Decode Ollama's NDJSON stream, skipping lines that are not valid JSON"""
+    for line in response.iter_lines():
+        if line:
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError:
+                continue
+
+def parse_model_limits(spec):
+    """Parse ``model=limit`` pairs, e.g. ``deepseek-r1:14b=1,llama2=4``"""
+    limits = {}
+    for item in spec.split(','):
+        if '=' in item:
+            model, limit = item.rsplit('=', 1)
+            limits[model.strip()] = int(limit)
+    return limits
+
+MODEL_CONCURRENCY = int(os.getenv('GURIA_MODEL_CONCURRENCY', '2'))
+MODEL_CONCURRENCY_OVERRIDES = parse_model_limits(os.getenv('GURIA_MODEL_CONCURRENCY_OVERRIDES', ''))
+QUEUE_SIZE = int(os.getenv('GURIA_QUEUE_SIZE', '32'))  # Waiting generations per model before new ones get 429
+QUEUE_PER_CLIENT = int(os.getenv('GURIA_QUEUE_PER_CLIENT', '4'))
+QUEUE_TIMEOUT = float(os.getenv('GURIA_QUEUE_TIMEOUT', '120'))
+QUEUE_POSITION_INTERVAL = 1.0  # Seconds between queue position updates sent to a waiting client
+
+class Histogram:
+    """Thread-safe cumulative histogram with fixed bucket bounds"""
+
+    def __init__(self, bounds):
+        self.bounds = tuple(bounds)
+        self._lock = threading.Lock()
+        self._counts = [0] * (len(self.bounds) + 1)
+        self._sum = 0.0
+        self._count = 0
+
+    def observe(self, value):
+        index = next((i for i, bound in enumerate(self.bounds) if value <= bound), len(self.bounds))
+        with self._lock:
+            self._counts[index] += 1
+            self._sum += value
+            self._count += 1
+
+    def snapshot(self):
+        with self._lock:
+            counts, total, count = list(self._counts), self._sum, self._count
+        cumulative, running = {}, 0
+        for bound, bucket in zip(self.bounds + ('+Inf',), counts):
+            running += bucket
+            cumulative[str(bound)] = running
+        return {'buckets': cumulative, 'sum': round(total, 6), 'count': count}
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+TOKEN_RATE_BUCKETS = (1, 2, 5, 10, 15, 20, 30, 40, 60, 80, 100, 150, 200, 400, 1000)
+
+# Series recorded on the request paths: name -> (help text, label, bucket bounds)
+METRIC_SERIES = {
+    'ollama_request_seconds': ('Time until Ollama answered a request with its response headers', 'operation', LATENCY_BUCKETS),
+    'queue_wait_seconds': ('Time a generation waited for a concurrency slot', 'model', LATENCY_BUCKETS),
+    'time_to_first_token_seconds': ('Time from sending a generation to Ollama until its first token', 'model', LATENCY_BUCKETS),
+    'generation_seconds': ('Time from sending a generation to Ollama until its last token', 'model', LATENCY_BUCKETS),
+    'prefill_seconds': ('Prompt evaluation time reported by Ollama (prompt_eval_duration)', 'model', LATENCY_BUCKETS),
+    'decode_tokens_per_second': ('Generation speed reported by Ollama (eval_count / eval_duration)', 'model', TOKEN_RATE_BUCKETS),
+    'sse_write_seconds': ('Time per stream spent writing frames to the client', 'model', LATENCY_BUCKETS),
+    'db_write_seconds': ('Time to save a finished turn', 'model', LATENCY_BUCKETS),
+    'initialize_seconds': ('Time /initialize_model took to load an installed model', 'model', LATENCY_BUCKETS),
+    'export_render_seconds': ('Time to render one chat as a PDF', 'source', LATENCY_BUCKETS),
+}
+
+class Metrics:
+    """Histograms for METRIC_SERIES, one per label value, recorded without taking a lock.
+
+    Each thread counts into its own shard and collect() adds the shards up. Shards
+    of threads that have exited are folded into a shared total, so servers that
+    start a thread per request do not accumulate them. Counts are per process.
+    """
+
+    def __init__(self, series=METRIC_SERIES):
+        self.series = series
+        self._local = threading.local()
+        self._lock = threading.Lock()  # Guards the shard list, never taken by observe() once a thread has a shard
+        self._shards = []
+        self._retired = {}
+
+    def _shard(self):
+        shard = getattr(self._local, 'shard', None)
+        if shard is None:
+            shard = self._local.shard = {}
+            with self._lock:
+                self._fold_exited()
+                self._shards.append((threading.current_thread(), shard))
+        return shard
+
+    def _fold_exited(self):
+        live = []
+        for thread, shard in self._shards:
+            if thread.is_alive():
+                live.append((thread, shard))
+            else:
+                for key, cells in shard.items():
+                    add_metric_cells(self._retired, key, cells)
+        self._shards = live
+
+    def observe(self, name, label, value):
+        """Record ``value`` for ``name`` under ``label`` (a model, operation or source)"""
+        bounds = self.series[name][2]
+        shard = self._shard()
+        cells = shard.get((name, label))
+        if cells is None:
+            # One count per bucket plus the overflow bucket, then the sum
+            cells = shard[(name, label)] = [0] * (len(bounds) + 1) + [0.0]
+        cells[bisect.bisect_left(bounds, value)] += 1
+        cells[-1] += value
+
+    def collect(self):
+        """``{(name, label): cells}`` summed over every thread"""
+        with self._lock:
+            self._fold_exited()
+            totals = {key: list(cells) for key, cells in self._retired.items()}
+            shards = [shard for _, shard in self._shards]
+        for shard in shards:
+            for key, cells in shard.copy().items():
+                add_metric_cells(totals, key, cells)
+        return totals
+
+    def snapshot(self, name, label):
+        """The series as a Histogram.snapshot() style dict, or None if nothing was recorded"""
+        cells = self.collect().get((name, label))
+        return metric_cells_snapshot(self.series[name][2], cells) if cells else None
+
+def add_metric_cells(totals, key, cells):
+    if key in totals:
+        totals[key] = [a + b for a, b in zip(totals[key], cells)]
+    else:
+        totals[key] = list(cells)
+
+def metric_cells_snapshot(bounds, cells):
+    cumulative, running = {}, 0
+    for bound, bucket in zip(tuple(bounds) + ('+Inf',), cells):
+        running += bucket
+        cumulative[str(bound)] = running
+    return {'buckets': cumulative, 'sum': round(cells[-1], 6), 'count': running}
+
+metrics = Metrics()
+
+def histogram_quantile(q, snapshot):
+    """Estimate a quantile from cumulative buckets, interpolating within a bucket like Prometheus does"""
+    count = snapshot['count']
+    if not count:
+        return None
+    rank = q * count
+    previous_bound, previous_count = 0.0, 0
+    for bound, cumulative in snapshot['buckets'].items():
+        if cumulative >= rank:
+            if bound == '+Inf':
+                return previous_bound
+            bound = float(bound)
+            in_bucket = cumulative - previous_count
+            return previous_bound + (bound - previous_bound) * (rank - previous_count) / in_bucket if in_bucket else bound
+        previous_bound, previous_count = float(bound), cumulative
+    return previous_bound
+
+class GenerationTimer:
+    """Times one generation: first token, last token and Ollama's own prefill and decode figures"""
+
+    def __init__(self, model):
+        self.model = model
+        self.started = None
+        self.first_token_at = None
+
+    def start(self):
+        """Mark the request going to Ollama; generations replayed from the response cache are never started"""
+        self.started = time.monotonic()
+
+    def token(self):
+        if self.started is not None and self.first_token_at is None:
+            self.first_token_at = time.monotonic()
+            metrics.observe('time_to_first_token_seconds', self.model, self.first_token_at - self.started)
+
+    def done(self, chunk):
+        """Record the totals from Ollama's final ``done`` chunk"""
+        if self.started is None:
+            return
+        metrics.observe('generation_seconds', self.model, time.monotonic() - self.started)
+        if chunk.get('prompt_eval_duration'):
+            metrics.observe('prefill_seconds', self.model, chunk['prompt_eval_duration'] / 1e9)
+        if chunk.get('eval_count') and chunk.get('eval_duration'):
+            metrics.observe('decode_tokens_per_second', self.model, chunk['eval_count'] / (chunk['eval_duration'] / 1e9))
+
+def timed_stream(frames, model):
+    """Pass SSE frames through, recording how long the server spent writing them to the client"""
+    writing = 0.0
+    try:
+        for frame in frames:
+            started = time.monotonic()
+            yield frame
+            writing += time.monotonic() - started
+    finally:
+        metrics.observe('sse_write_seconds', model, writing)
+
+class QueueFull(Exception):
+    """Raised when a generation cannot even be queued; ``retry_after`` is a hint in seconds"""
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class GenerationTicket:
+    """A generation's place in its model's queue, granted once a concurrency slot is free"""
+
+    def __init__(self, model, client):
+        self.model = model
+        self.client = client
+        self.enqueued_at = time.monotonic()
+        self.started_at = None
+        self.released = False
+        self._granted = threading.Event()
+        self._callbacks = []
+
+    @property
+    def granted(self):
+        return self._granted.is_set()
+
+    def wait(self, timeout):
+        """Block until granted or ``timeout`` passes; returns whether the slot was granted"""
+        return self._granted.wait(timeout)
+
+class GenerationScheduler:
+    """Admission control in front of Ollama: a concurrency limit per model and a bounded queue.
+
+    Waiting generations are served round-robin across clients, so one client
+    with several queued requests cannot starve the others. Limits apply per
+    process; with --server prefork each worker enforces them separately.
+    """
+
+    WAIT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+    DEPTH_BUCKETS = (0, 1, 2, 4, 8, 16, 32, 64)
+
+    def __init__(self, default_limit=MODEL_CONCURRENCY, limits=None, queue_size=QUEUE_SIZE,
+                 per_client=QUEUE_PER_CLIENT):
+        self.default_limit = default_limit
+        self.limits = dict(MODEL_CONCURRENCY_OVERRIDES if limits is None else limits)
+        self.queue_size = queue_size
+        self.per_client = per_client
+        self._lock = threading.Lock()
+        self._lanes = {}
+        self.wait_time = Histogram(self.WAIT_BUCKETS)
+        self.queue_depth = Histogram(self.DEPTH_BUCKETS)
+        self._admitted = 0
+        self._rejected = 0
+        self._abandoned = 0
+
+    def _lane(self, model):
+        lane = self._lanes.get(model)
+        if lane is None:
+            # waiting maps client -> tickets; its key order is the round-robin order
+            lane = self._lanes[model] = {'active': 0, 'waiting': {}, 'queued': 0, 'service_time': 10.0}
+        return lane
+
+    def limit_for(self, model):
+        return self.limits.get(model, self.default_limit)
+
+    def admit(self, model, client):
+        """Take a slot or a place in the queue, raising QueueFull if neither is available"""
+        with self._lock:
+            lane = self._lane(model)
+            limit = self.limit_for(model)
+            self.queue_depth.observe(lane['queued'])
+            ticket = GenerationTicket(model, client)
+            if lane['active'] < limit and not lane['queued']:
+                lane['active'] += 1
+                self._grant(ticket)
+            else:
+                waiting = lane['waiting'].get(client, [])
+                if lane['queued'] >= self.queue_size or len(waiting) >= self.per_client:
+                    self._rejected += 1
+                    retry_after = max(1, int(lane['service_time'] * (lane['queued'] + 1) / max(limit, 1)))
+                    raise QueueFull(f"Too many queued requests for {model}", retry_after)
+                lane['waiting'].setdefault(client, waiting).append(ticket)
+                lane['queued'] += 1
+            self._admitted += 1
+        return ticket
+
+    def _grant(self, ticket):
+        ticket.started_at = time.monotonic()
+        self.wait_time.observe(ticket.started_at - ticket.enqueued_at)
+        metrics.observe('queue_wait_seconds', ticket.model, ticket.started_at - ticket.enqueued_at)
+        ticket._granted.set()
+        for callback in ticket._callbacks:
+            callback()
+
+    def _promote(self, lane, limit):
+        while lane['active'] < limit and lane['waiting']:
+            client = next(iter(lane['waiting']))
+            tickets = lane['waiting'].pop(client)
+            ticket = tickets.pop(0)
+            if tickets:
+                lane['waiting'][client] = tickets  # Back of the rotation
+            lane['queued'] -= 1
+            lane['active'] += 1
+            self._grant(ticket)
+
+    def release(self, ticket):
+        """Free the ticket's slot, or drop it from the queue if it never started; safe to call twice"""
+        with self._lock:
+            if ticket.released:
+                return
+            ticket.released = True
+            lane = self._lane(ticket.model)
+            if ticket.granted:
+                lane['active'] -= 1
+                # Smoothed generation time, used for Retry-After hints
+                lane['service_time'] = 0.8 * lane['service_time'] + 0.2 * (time.monotonic() - ticket.started_at)
+            else:
+                tickets = lane['waiting'].get(ticket.client, [])
+                if ticket in tickets:
+                    tickets.remove(ticket)
+                    lane['queued'] -= 1
+                    if not tickets:
+                        del lane['waiting'][ticket.client]
+                self._abandoned += 1
+            self._promote(lane, self.limit_for(ticket.model))
+
+    def on_grant(self, ticket, callback):
+        """Run ``callback`` (from the releasing thread) once the ticket is granted"""
+        with self._lock:
+            if ticket.granted:
+                callback()
+            else:
+                ticket._callbacks.append(callback)
+
+    def position(self, ticket):
+        """1-based place in line under round-robin service, or 0 once granted"""
+        with self._lock:
+            if ticket.granted or ticket.released:
+                return 0
+            queues = list(self._lane(ticket.model)['waiting'].items())
+            clients = [client for client, _ in queues]
+            if ticket.client not in clients:
+                return 0
+            rank = clients.index(ticket.client)
+            depth = queues[rank][1].index(ticket)
+            ahead = sum(min(len(tickets), depth + (1 if i < rank else 0)) for i, (_, tickets) in enumerate(queues))
+            return ahead + 1
+
+    def stats(self):
+        with self._lock:
+            models = {
+                model: {'active': lane['active'], 'queued': lane['queued'], 'limit': self.limit_for(model)}
+                for model, lane in self._lanes.items()
+            }
+            counters = {'admitted': self._admitted, 'rejected': self._rejected, 'abandoned': self._abandoned}
+        return dict(counters, models=models, wait_seconds=self.wait_time.snapshot(),
+                    queue_depth=self.queue_depth.snapshot())
+
+generation_scheduler = GenerationScheduler()
+
+def client_key():
+    """Identify the client for fair queueing: a random id kept in the Flask session"""
+    if 'client_id' not in session:
+        session['client_id'] = os.urandom(8).hex()
+    return session['client_id']
+
+def queue_rejection(error):
+    """429 response for a generation that could not be queued"""
+    response = jsonify({'error': str(error), 'retry_after': error.retry_after})
+    response.headers['Retry-After'] = str(error.retry_after)
+    return response, 429
+
+def wait_for_slot(ticket):
+    """Yield queue position events until the ticket is granted or released; raises TimeoutError after QUEUE_TIMEOUT"""
+    deadline = time.monotonic() + QUEUE_TIMEOUT
+    last_position = None
+    while not ticket.wait(0 if last_position is None else QUEUE_POSITION_INTERVAL):
+        if ticket.released:
+            return
+        if time.monotonic() >= deadline:
+            raise TimeoutError(f"Timed out after {QUEUE_TIMEOUT:.0f}s waiting for {ticket.model}")
+        position = generation_scheduler.position(ticket)
+        if position != last_position:
+            last_position = position
+            yield sse_event({'queue': {'position': position}})
+
+def parse_size(spec):
+    """Bytes in a size such as ``16GB`` or ``512MB``; None if it cannot be parsed"""
+    match = re.fullmatch(r'\s*([\d.]+)\s*([KMGT]?)B?\s*', str(spec or ''), re.IGNORECASE)
+    if not match:
+        return None
+    return int(float(match.group(1)) * 1024 ** ' KMGT'.index(match.group(2).upper() or ' '))
+
+def model_list(spec):
+    return [m.strip() for m in spec.split(',') if m.strip()]
+
+def canonical_model(name):
+    """Model name without the implicit ``:latest`` tag, so ``llama2`` and ``llama2:latest`` match"""
+    return name[:-len(':latest')] if name.endswith(':latest') else name
+
+PIN_RETRY_MAX_BACKOFF = 3600  # Longest wait (seconds) between attempts to reload a pinned model that fails to load
+MODEL_KEEP_ALIVE = os.getenv('GURIA_MODEL_KEEP_ALIVE', '30m')  # How long Ollama keeps an idle, unpinned model loaded
+PINNED_MODELS = model_list(os.getenv('GURIA_PINNED_MODELS', ''))
+PRELOAD_MODELS = model_list(os.getenv('GURIA_PRELOAD_MODELS', ''))
+MODEL_RAM_BUDGET = parse_size(os.getenv('GURIA_MODEL_RAM_BUDGET', ''))  # Defaults to a fraction of system RAM
+MODEL_RAM_FRACTION = float(os.getenv('GURIA_MODEL_RAM_FRACTION', '0.75'))
+HOT_MODEL_USES = int(os.getenv('GURIA_HOT_MODEL_USES', '10'))  # Generations within HOT_MODEL_WINDOW that pin a model
+HOT_MODEL_WINDOW = float(os.getenv('GURIA_HOT_MODEL_WINDOW', '600'))
+RESIDENCY_INTERVAL = float(os.getenv('GURIA_RESIDENCY_INTERVAL', '30'))  # Seconds between syncs with /api/ps
+COLD_START_THRESHOLD_MS = 500  # A load_duration above this means the generation had to load the model
+COLD_START_BUCKETS = (0.5, 1, 2, 5, 10, 20, 30, 60, 120)
+
+class ModelResidency:
+    """Decides which models stay loaded in Ollama, within a RAM budget.
+
+    Every generation carries a ``keep_alive``: pinned and hot models (used
+    HOT_MODEL_USES times within HOT_MODEL_WINDOW) stay loaded indefinitely, the rest
+    for MODEL_KEEP_ALIVE. A background thread syncs with Ollama's /api/ps, reloads
+    pinned models that dropped out and unloads the least recently used unpinned models
+    while the resident set exceeds the budget. Sizes come from /api/ps for loaded
+    models and from MODEL_SPECS otherwise. Loads, unloads and cold-start latencies
+    are recorded per model.
+    """
+
+    def __init__(self, budget=MODEL_RAM_BUDGET, keep_alive=MODEL_KEEP_ALIVE, pinned=PINNED_MODELS,
+                 preload=PRELOAD_MODELS, interval=RESIDENCY_INTERVAL):
+        self.budget = budget or int(psutil.virtual_memory().total * MODEL_RAM_FRACTION)
+        self.keep_alive_default = keep_alive
+        self.pinned = {canonical_model(m) for m in pinned}
+        self.preload = list(preload)
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+        self._pid = None
+        self._leader = None
+        self._models = {}
+        self._held = set()  # Models last told to stay loaded indefinitely
+        self._pin_failures = {}  # Pinned model -> (consecutive failed loads, time of the next attempt)
+        self._events = deque(maxlen=50)
+
+    def _model(self, model):
+        model = canonical_model(model)
+        state = self._models.get(model)
+        if state is None:
+            state = self._models[model] = {
+                'resident': False, 'size': None, 'last_used': None, 'recent_uses': deque(),
+                'generations': 0, 'loads': 0, 'unloads': 0, 'evictions': 0,
+                'cold_start': Histogram(COLD_START_BUCKETS), 'last_load_ms': None
+            }
+        return state
+
+    def _is_hot(self, state, now):
+        while state['recent_uses'] and state['recent_uses'][0] < now - HOT_MODEL_WINDOW:
+            state['recent_uses'].popleft()
+        return len(state['recent_uses']) >= HOT_MODEL_USES
+
+    def _record(self, model, event, **details):
+        self._events.append(dict(details, model=model, event=event, at=datetime.now().isoformat()))
+        logger.info(f"Model {model} {event}" + ''.join(f", {k}={v}" for k, v in details.items()))
+
+    def is_pinned(self, model):
+        with self._lock:
+            return canonical_model(model) in self.pinned or self._is_hot(self._model(model), time.time())
+
+    def keep_alive(self, model):
+        """``keep_alive`` to send with a generation for ``model``"""
+        return -1 if self.is_pinned(model) else model_profile(model).get('keep_alive', self.keep_alive_default)
+
+    def record_generation(self, model, done):
+        """Note a finished generation; its ``load_duration`` tells whether it paid for a cold start"""
+        if 'load_duration' not in done:
+            return  # Replayed from the response cache, Ollama was not involved
+        load_ms = done['load_duration'] / 1e6
+        now = time.time()
+        with self._lock:
+            state = self._model(model)
+            state['last_used'] = now
+            state['recent_uses'].append(now)
+            state['generations'] += 1
+            newly_resident = not state['resident']
+            state['resident'] = True
+            if load_ms >= COLD_START_THRESHOLD_MS:
+                state['loads'] += 1
+                state['last_load_ms'] = round(load_ms, 1)
+                state['cold_start'].observe(load_ms / 1000)
+                self._record(model, 'load', reason='request', duration_ms=round(load_ms, 1))
+            rearm = canonical_model(model) not in self._held and self._is_hot(state, now)
+        if newly_resident or rearm:
+            self._wake.set()  # Enforce the budget / hold the now-hot model without delaying this request
+
+    def _estimated_size(self, model, state):
+        return state['size'] or parse_size(MODEL_SPECS.get(model, {}).get('ram')) or 0
+
+    def load(self, model, reason='select'):
+        """Load ``model`` now, making room for it first; raises if Ollama refuses"""
+        with self._lock:
+            state = self._model(model)
+            size = self._estimated_size(model, state)
+        self._make_room(size, keep=model)
+        keep_alive = self.keep_alive(model)
+        started = time.monotonic()
+        response = ollama_client.load(model, keep_alive, model_profile(model)['options'])
+        if response.status_code != 200:
+            raise Exception(f"Failed to load model {model}: {response.text}")
+        duration_ms = round((time.monotonic() - started) * 1000, 1)
+        with self._lock:
+            state['resident'] = True
+            state['last_used'] = time.time()
+            state['loads'] += 1
+            state['last_load_ms'] = duration_ms
+            state['cold_start'].observe(duration_ms / 1000)
+            if keep_alive == -1:
+                self._held.add(canonical_model(model))
+            self._record(model, 'load', reason=reason, duration_ms=duration_ms)
+
+    def unload(self, model, reason='evicted'):
+        response = ollama_client.unload(model)
+        if response.status_code != 200:
+            logger.warning(f"Failed to unload model {model}: {response.text}")
+            return False
+        with self._lock:
+            state = self._model(model)
+            state['resident'] = False
+            state['unloads'] += 1
+            if reason == 'evicted':
+                state['evictions'] += 1
+            self._held.discard(canonical_model(model))
+            self._record(model, 'unload', reason=reason)
+        return True
+
+    def _make_room(self, needed, keep=None):
+        """Unload least recently used, unpinned models until ``needed`` more bytes fit in the budget"""
+        now = time.time()
+        keep = canonical_model(keep) if keep else None
+        with self._lock:
+            resident = {m: s for m, s in self._models.items() if s['resident'] and m != keep}
+            used = sum(self._estimated_size(m, s) for m, s in resident.items())
+            candidates = sorted(
+                (m for m, s in resident.items() if m not in self.pinned and not self._is_hot(s, now)),
+                key=lambda m: resident[m]['last_used'] or 0)
+        for model in candidates:
+            if used + needed <= self.budget:
+                break
+            if self.unload(model):
+                used -= self._estimated_size(model, resident[model])
+
+    def sync(self):
+        """Refresh the resident set from /api/ps, then apply pins and the budget"""
+        response = ollama_client.ps()
+        if response.status_code != 200:
+            return
+        loaded = {canonical_model(m['name']): m.get('size') for m in response.json().get('models', [])}
+        now = time.time()
+        with self._lock:
+            for model, state in self._models.items():
+                if state['resident'] and model not in loaded:
+                    state['resident'] = False
+                    state['unloads'] += 1
+                    self._held.discard(model)
+                    self._record(model, 'unload', reason='expired')
+            for model, size in loaded.items():
+                state = self._model(model)
+                state['resident'] = True
+                state['size'] = size or state['size']
+            missing_pins = [m for m in self.pinned if not self._model(m)['resident']]
+            # Models whose indefinite keep_alive no longer applies get the normal idle timeout back
+            cooled = [m for m in self._held if m not in self.pinned and not self._is_hot(self._model(m), now)]
+            warmed = [m for m, s in self._models.items()
+                      if s['resident'] and m not in self._held and (m in self.pinned or self._is_hot(s, now))]
+        for model in missing_pins:
+            self._load_pinned(model, now)
+        for model in cooled + warmed:
+            hold = model in warmed
+            try:
+                ollama_client.load(model, -1 if hold else self.keep_alive(model), model_profile(model)['options'])
             except Exception as e:
-                logger.error(f"Error generating response: {str(e)}")
-                yield f"data: {json.dumps({'error': str(e)})}\n\n"
-        
-        return Response(generate(), mimetype='text/event-stream')
-        
+                logger.warning(f"Failed to update keep_alive of model {model}: {str(e)}")
+                continue
+            with self._lock:
+                (self._held.add if hold else self._held.discard)(model)
+        self._make_room(0)
+
+    def _load_pinned(self, model, now):
+        """Reload a pinned model, backing off exponentially (for this model only) while it fails"""
+        failures, retry_at = self._pin_failures.get(model, (0, 0))
+        if now < retry_at:
+            return
+        try:
+            self.load(model, reason='pinned')
+            self._pin_failures.pop(model, None)
+        except Exception as e:
+            failures += 1
+            delay = min(self.interval * 2 ** (failures - 1), PIN_RETRY_MAX_BACKOFF)
+            self._pin_failures[model] = (failures, now + delay)
+            logger.error(f"Error loading pinned model {model} (attempt {failures}, retrying in {delay:.0f}s): {str(e)}")
+
+    def _run(self):
+        preloaded = False
+        while True:
+            # Of several processes sharing one Ollama, only the elected one loads and unloads models
+            if self._leader is None or self._leader():
+                if not preloaded:
+                    preloaded = True
+                    for model in self.preload:
+                        try:
+                            self.load(model, reason='preload')
+                        except Exception as e:
+                            logger.error(f"Error preloading model {model}: {str(e)}")
+                try:
+                    self.sync()
+                except Exception as e:
+                    logger.warning(f"Model residency sync failed: {str(e)}")
+            self._wake.wait(self.interval)
+            self._wake.clear()
+
+    def start(self, leader=None):
+        """Start the residency thread (again, after a fork) if it is not running.
+
+        ``leader`` is called before every sync; while it returns False this process
+        leaves preloading and evictions to another one.
+        """
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive() and self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._leader = leader
+            self._thread = Thread(target=self._run, name='model-residency', daemon=True)
+            self._thread.start()
+
+    def stats(self):
+        now = time.time()
+        with self._lock:
+            return {
+                'budget_bytes': self.budget,
+                'resident_bytes': sum(self._estimated_size(m, s) for m, s in self._models.items() if s['resident']),
+                'keep_alive': self.keep_alive_default,
+                'models': {model: {
+                    'resident': state['resident'],
+                    'size': state['size'],
+                    'pinned': model in self.pinned,
+                    'hot': self._is_hot(state, now),
+                    'last_used': datetime.fromtimestamp(state['last_used']).isoformat() if state['last_used'] else None,
+                    'generations': state['generations'],
+                    'loads': state['loads'],
+                    'unloads': state['unloads'],
+                    'evictions': state['evictions'],
+                    'last_load_ms': state['last_load_ms'],
+                    'cold_start_seconds': state['cold_start'].snapshot()
+                } for model, state in self._models.items()},
+                'events': list(self._events)[-20:]
+            }
+
+model_residency = ModelResidency()
+
+@app.route('/chat', methods=['POST'])
+def chat():
+    return stream_turn(legacy=False)
+
+MODEL_PULL_EVENT_INTERVAL = 0.25  # Minimum seconds between progress events sent to one client
+MODEL_PULL_RATE_SMOOTHING = 0.3  # Weight of the newest sample in the moving average download rate
+MODEL_PULL_SHARE_INTERVAL = 0.5  # Minimum seconds between progress writes to the shared job table
+
+# Pull jobs as last reported by the process running them, so every prefork worker can follow and cancel them
+MODEL_PULL_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS model_pulls (
+    model TEXT PRIMARY KEY,
+    state TEXT NOT NULL,
+    pid INTEGER NOT NULL,
+    cancel_requested INTEGER NOT NULL DEFAULT 0,
+    updated_at REAL NOT NULL
+);
+'''
+
+def model_available(model, models):
+    """Whether ``model`` is among Ollama's installed ``models`` (an untagged name means ``:latest``)"""
+    return model in models or (':' not in model and f"{model}:latest" in models)
+
+class ModelPulls:
+    """Registry of background model downloads through Ollama's streaming pull API.
+
+    There is at most one running job per model, so concurrent requests for the same
+    model share it. Jobs report byte progress, rate and ETA and can be cancelled;
+    starting a cancelled or failed job again resumes it, because Ollama keeps the
+    layers it already downloaded. Jobs run in the process that started them and
+    publish their state to the ``model_pulls`` table, where other processes
+    (prefork workers) read it and ask for cancellation.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        self._jobs = {}
+
+    def start(self, model):
+        """Start pulling ``model``, or return the job already pulling it here or in another process"""
+        shared = self._shared(model)
+        with self._lock:
+            job = self._jobs.get(model)
+            if job and job['status'] == 'pulling':
+                return self._public(job)
+            if shared and shared['status'] == 'pulling':
+                return shared
+            job = {
+                'model': model, 'status': 'pulling', 'phase': 'starting', 'completed': 0, 'total': 0,
+                'percent': 0.0, 'rate': None, 'eta': None, 'error': None,
+                'started_at': time.time(), 'finished_at': None, 'version': 0,
+                'cancel': threading.Event(), 'response': None, 'shared_at': 0
+            }
+            self._jobs[model] = job
+        self._share(job, new=True)
+        Thread(target=self._run, args=(job,), name=f"pull-{model}", daemon=True).start()
+        logger.info(f"Pulling model {model}")
+        return self._public(job)
+
+    @staticmethod
+    def _public(job):
+        return {key: value for key, value in job.items() if key not in ('cancel', 'response', 'shared_at')}
+
+    def _update(self, job, **changes):
+        with self._changed:
+            job.update(changes)
+            job['version'] += 1
+            self._changed.notify_all()
+        if 'status' in changes or time.monotonic() - job['shared_at'] >= MODEL_PULL_SHARE_INTERVAL:
+            self._share(job)
+
+    def _share(self, job, new=False):
+        """Publish a job's state and pick up cancellation asked for by another process"""
+        job['shared_at'] = time.monotonic()
+        try:
+            with db_connection() as conn:
+                conn.execute(
+                    '''INSERT INTO model_pulls (model, state, pid, updated_at) VALUES (?, ?, ?, ?)
+                       ON CONFLICT (model) DO UPDATE SET state = excluded.state, pid = excluded.pid,
+                       updated_at = excluded.updated_at''' + (', cancel_requested = 0' if new else ''),
+                    (job['model'], json.dumps(self._public(job)), os.getpid(), time.time()))
+                cancel_requested = conn.execute(
+                    'SELECT cancel_requested FROM model_pulls WHERE model = ?', (job['model'],)).fetchone()[0]
+                conn.commit()
+        except sqlite3.Error as e:
+            logger.warning(f"Could not share the state of the pull of {job['model']}: {str(e)}")
+            return
+        if cancel_requested and job['status'] == 'pulling':
+            job['cancel'].set()
+
+    def _shared(self, model):
+        """The job as published by the process running it, or None if no process has pulled ``model``"""
+        try:
+            with db_connection() as conn:
+                row = conn.execute('SELECT state, pid FROM model_pulls WHERE model = ?', (model,)).fetchone()
+        except sqlite3.Error as e:
+            logger.warning(f"Could not read the shared state of the pull of {model}: {str(e)}")
+            return None
+        if row is None:
+            return None
+        job = json.loads(row[0])
+        if job['status'] == 'pulling' and row[1] != os.getpid() and not psutil.pid_exists(row[1]):
+            job.update(status='error', error='The server process running this pull exited', eta=None)
+        return job
+
+    def _run(self, job):
+        layers = {}
+        rate, sample = None, (time.monotonic(), 0)
+        succeeded = False
+        try:
+            response = ollama_client.pull(job['model'], stream=True)
+            with self._lock:
+                job['response'] = response
+            if job['cancel'].is_set():
+                response.close()
+            if response.status_code != 200:
+                raise RuntimeError(f"Ollama returned status {response.status_code}: {response.text[:200]}")
+            for chunk in iter_ndjson(response):
+                if job['cancel'].is_set():
+                    break
+                if 'error' in chunk:
+                    raise RuntimeError(chunk['error'])
+                if chunk.get('total'):
+                    # Progress is reported per layer; the job total is the sum over all layers seen so far
+                    layers[chunk.get('digest') or chunk.get('status')] = (chunk['total'], chunk.get('completed', 0))
+                total = sum(size for size, _ in layers.values())
+                completed = sum(done for _, done in layers.values())
+                now = time.monotonic()
+                if now - sample[0] >= 0.5:
+                    current = max(completed - sample[1], 0) / (now - sample[0])
+                    rate = current if rate is None else (
+                        MODEL_PULL_RATE_SMOOTHING * current + (1 - MODEL_PULL_RATE_SMOOTHING) * rate)
+                    sample = (now, completed)
+                succeeded = chunk.get('status') == 'success'
+                self._update(job, phase=chunk.get('status', job['phase']), completed=completed, total=total,
+                             percent=round(100 * completed / total, 1) if total else 0.0,
+                             rate=round(rate) if rate is not None else None,
+                             eta=round((total - completed) / rate, 1) if rate else None)
+        except Exception as e:
+            if not job['cancel'].is_set():
+                logger.error(f"Error pulling model {job['model']}: {str(e)}")
+                self._update(job, status='error', error=str(e), finished_at=time.time())
+                return
+        finally:
+            if job['response'] is not None:
+                job['response'].close()
+
+        if job['cancel'].is_set() and not succeeded:
+            logger.info(f"Pull of {job['model']} cancelled at {job['completed']}/{job['total']} bytes")
+            self._update(job, status='cancelled', eta=None, finished_at=time.time())
+        elif succeeded:
+            ollama_health.probe()  # So the model list is current before clients see the job finish
+            logger.info(f"Pulled model {job['model']} in {time.time() - job['started_at']:.1f}s")
+            self._update(job, status='done', percent=100.0, eta=0, finished_at=time.time())
+        else:
+            self._update(job, status='error', error='Pull ended before it completed', finished_at=time.time())
+
+    def cancel(self, model):
+        """Stop a running pull; returns the job, or None if there is no such job"""
+        with self._lock:
+            job = self._jobs.get(model)
+        if job is None or job['status'] != 'pulling':
+            shared = self._shared(model)
+            if shared and shared['status'] == 'pulling' and (job is None or shared['started_at'] > job['started_at']):
+                return self._cancel_shared(model)
+            return self.status(model)
+        with self._lock:
+            job['cancel'].set()
+            response = job['response']
+        if response is not None:
+            response.close()  # Unblocks the worker if it is waiting for the next progress line
+        return self.wait(model, timeout=2)
+
+    def _cancel_shared(self, model, timeout=2):
+        """Ask the process running a pull to stop it, and wait a little for it to do so"""
+        with db_connection() as conn:
+            conn.execute('UPDATE model_pulls SET cancel_requested = 1 WHERE model = ?', (model,))
+            conn.commit()
+        deadline = time.monotonic() + timeout
+        while True:
+            job = self._shared(model)
+            if job is None or job['status'] != 'pulling' or time.monotonic() >= deadline:
+                return job
+            time.sleep(MODEL_PULL_EVENT_INTERVAL)
+
+    def is_local(self, model):
+        """Whether this process is running the latest pull of ``model``"""
+        with self._lock:
+            return model in self._jobs and self._jobs[model]['status'] == 'pulling'
+
+    def status(self, model):
+        """The latest job for ``model``: this process's own, or the one another process published"""
+        with self._lock:
+            job = self._jobs.get(model)
+            job = self._public(job) if job else None
+        if job is not None and job['status'] == 'pulling':
+            return job
+        shared = self._shared(model)
+        if shared is not None and (job is None or shared['started_at'] > job['started_at']):
+            return shared
+        return job
+
+    def wait_for_change(self, model, version, timeout):
+        """Block until the job's version passes ``version`` (or ``timeout``), then return it"""
+        if not self.is_local(model):
+            # Run by another process: poll what it publishes
+            deadline = time.monotonic() + timeout
+            while True:
+                job = self.status(model)
+                if job is None or job['version'] != version or time.monotonic() >= deadline:
+                    return job
+                time.sleep(MODEL_PULL_EVENT_INTERVAL)
+        with self._changed:
+            self._changed.wait_for(lambda: self._jobs.get(model, {}).get('version', version) != version, timeout)
+            job = self._jobs.get(model)
+            return self._public(job) if job else None
+
+    def wait(self, model, timeout=None):
+        """Block until the pull of ``model`` finishes and return the job"""
+        with self._changed:
+            self._changed.wait_for(lambda: self._jobs.get(model, {}).get('status') != 'pulling', timeout)
+            job = self._jobs.get(model)
+            return self._public(job) if job else None
+
+model_pulls = ModelPulls()
+
+@app.route('/models/pull', methods=['POST'])
+def start_model_pull():
+    """Start (or join) a background pull of ``model``; progress is streamed from ``events_url``"""
+    try:
+        data = request.get_json(silent=True) or {}
+        model = data.get('model')
+        if not model:
+            return jsonify({'error': 'No model specified'}), 400
+        job = model_pulls.start(model)
+        return jsonify(dict(job, events_url=url_for('model_pull_events', model=model))), 202
     except Exception as e:
-        logger.error(f"Error in chat endpoint: {str(e)}")
+        logger.error(f"Error starting model pull: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
+@app.route('/models/pull/<path:model>')
+def get_model_pull(model):
+    job = model_pulls.status(model)
+    if job is None:
+        return jsonify({'error': 'No pull for this model'}), 404
+    return jsonify(job)
+
+@app.route('/models/pull/<path:model>/cancel', methods=['POST'])
+def cancel_model_pull(model):
+    job = model_pulls.cancel(model)
+    if job is None:
+        return jsonify({'error': 'No pull for this model'}), 404
+    return jsonify(job)
+
+@app.route('/models/pull/<path:model>/events')
+def model_pull_events(model):
+    """Stream a pull's progress as SSE until it finishes.
+
+    Each event is the job's latest state, so a slow client skips intermediate
+    updates instead of falling behind. A pull running in another prefork worker
+    is followed through the state that worker publishes. Only POST /models/pull
+    starts a pull; an unknown one is a 404.
+    """
+    job = model_pulls.status(model)
+    if job is None:
+        return jsonify({'error': 'No pull for this model'}), 404
+
+    def generate():
+        current = job
+        while True:
+            yield sse_event({'pull': current})
+            if current['status'] != 'pulling':
+                return
+            time.sleep(MODEL_PULL_EVENT_INTERVAL)
+            # Heartbeat every 15s keeps proxies from closing an idle stream
+            current = model_pulls.wait_for_change(model, current['version'], 15) or current
+
+    return Response(generate(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
 @app.route('/initialize_model', methods=['POST'])
 def initialize_model():
+    """Load a model, or start pulling it first.
+
+    Returns 202 with the pull job when the model is not installed yet; call again
+    once the pull is done to load it.
+    """
     try:
         data = request.get_json()
         model = data.get('model')
@@ -225,14 +1884,26 @@ def initialize_model():
 
         logger.info(f"Initializing model: {model}")
         
-        # Check Ollama status first
-        ollama_status, error = check_ollama_status()
-        if not ollama_status:
-            return jsonify({'error': f'Ollama service not available: {error}'}), 503
+        # Check Ollama status first; a fresh worker probes now rather than guess the model list
+        status = ollama_health.snapshot()
+        if status['status'] == 'unknown':
+            status = ollama_health.probe()
+        if not status['up']:
+            return jsonify({'error': f"Ollama service not available: {status['error']}"}), 503
+
+        if not model_available(model, status['models']):
+            job = model_pulls.start(model)
+            return jsonify({
+                'status': 'pulling',
+                'pull': job,
+                'events_url': url_for('model_pull_events', model=model)
+            }), 202
 
         # Initialize the model
+        started = time.monotonic()
         success = initialize_ollama_model(model)
         if success:
+            metrics.observe('initialize_seconds', model, time.monotonic() - started)
             session['model'] = model
             return jsonify({
                 'status': 'success',
@@ -246,42 +1917,621 @@ def initialize_model():
         logger.error(f"Error in initialize_model: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
-def format_chunk_with_thinking(chunk):
-    """Format the response chunk to identify and mark chain of thought."""
-    # Common thinking patterns
-    thinking_patterns = [
-        (r"Let(?:')?s break this down", "[thinking]Let's break this down"),
-        (r"First,? let(?:')?s", "[thinking]First, let's"),
-        (r"Let(?:')?s start", "[thinking]Let's start"),
-        (r"Let(?:')?s analyze", "[thinking]Let's analyze"),
-        (r"Let(?:')?s consider", "[thinking]Let's consider"),
-        (r"Let(?:')?s look at", "[thinking]Let's look at"),
-        (r"Let(?:')?s examine", "[thinking]Let's examine"),
-        (r"Let(?:')?s understand", "[thinking]Let's understand"),
-        (r"Let(?:')?s think about", "[thinking]Let's think about"),
-        (r"Let(?:')?s approach", "[thinking]Let's approach"),
-        (r"Here(?:')?s how", "[thinking]Here's how"),
-        (r"We need to", "[thinking]We need to"),
-        (r"We should", "[thinking]We should"),
-        (r"We can", "[thinking]We can"),
-        (r"I(?:')?ll help you", "[thinking]I'll help you"),
-        (r"To solve this", "[thinking]To solve this"),
-        (r"To address this", "[thinking]To address this"),
-        (r"To implement this", "[thinking]To implement this"),
-        (r"To create this", "[thinking]To create this"),
-        (r"To handle this", "[thinking]To handle this"),
-    ]
-    
-    # Check if this chunk starts a thinking pattern
-    for pattern, replacement in thinking_patterns:
-        if re.match(pattern, chunk.strip(), re.IGNORECASE):
-            # Find the end of the thought (usually ends with a newline)
-            parts = chunk.split('\n', 1)
-            if len(parts) > 1:
-                return f"{replacement}{parts[0][len(pattern):]}\n[/thinking]\n{parts[1]}"
-            return f"{replacement}{chunk[len(pattern):]}\n[/thinking]\n"
-    
-    return chunk
+# Openings that mark a line as chain of thought when a model does not use <think> tags
+THINKING_PHRASES = (
+    "Let's break this down", "First, let's", "First let's", "Let's start", "Let's analyze", "Let's consider",
+    "Let's look at", "Let's examine", "Let's understand", "Let's think about", "Let's approach", "Here's how",
+    "We need to", "We should", "We can", "I'll help you", "To solve this", "To address this",
+    "To implement this", "To create this", "To handle this",
+)
+THINK_OPEN = '<think>'
+THINK_CLOSE = '</think>'
+
+def build_phrase_trie(phrases):
+    """Lower-case character trie of ``phrases``, each also without its apostrophes; a ``None`` key marks an end"""
+    root = {}
+    for phrase in phrases:
+        for variant in {phrase.lower(), phrase.lower().replace("'", '')}:
+            node = root
+            for char in variant:
+                node = node.setdefault(char, {})
+            node[None] = True
+    return root
+
+THINKING_PHRASE_TRIE = build_phrase_trie(THINKING_PHRASES)
+
+def partial_suffix(text, marker):
+    """Length of the longest end of ``text`` that could be the start of ``marker``"""
+    for size in range(min(len(text), len(marker) - 1), 0, -1):
+        if text.endswith(marker[:size]):
+            return size
+    return 0
+
+class ThinkingStreamParser:
+    """Single-pass splitter of a token stream into chain of thought and answer.
+
+    ``feed()`` takes chunks as they arrive and returns events: ``('thinking', text)``,
+    ``('answer', text)``, and ``('open', source)`` / ``('close', source)`` around each
+    thought, where ``source`` is ``'tag'`` for deepseek-r1 style ``<think>`` blocks and
+    ``'phrase'`` for a line that starts with one of THINKING_PHRASES (only when
+    ``phrases`` is set, and only until the model uses tags). Markers split across
+    chunks are held back until they can be told apart from ordinary text.
+    """
+
+    def __init__(self, phrases=False):
+        self.phrases = phrases
+        self._mode = 'answer'
+        self._buffer = ''
+        self._line_start = True
+
+    def _phrase_at_line_start(self):
+        """True or False once the buffered line start is known to (not) be a phrase; None while undecided"""
+        node = THINKING_PHRASE_TRIE
+        for char in self._buffer.lstrip(' \t').lower():
+            if None in node:
+                return True
+            node = node.get(char)
+            if node is None:
+                return False
+        return True if None in node else None
+
+    def feed(self, text):
+        self._buffer += text
+        events = []
+        while self._buffer:
+            buffer = self._buffer
+            if self._mode == 'tag':
+                end = buffer.find(THINK_CLOSE)
+                if end == -1:
+                    keep = partial_suffix(buffer, THINK_CLOSE)
+                    if len(buffer) > keep:
+                        events.append(('thinking', buffer[:len(buffer) - keep]))
+                    self._buffer = buffer[len(buffer) - keep:]
+                    break
+                if end:
+                    events.append(('thinking', buffer[:end]))
+                events.append(('close', 'tag'))
+                self._buffer = buffer[end + len(THINK_CLOSE):]
+                self._mode = 'answer'
+                self._line_start = False
+                continue
+
+            if self._mode == 'phrase':
+                newline = buffer.find('\n')
+                if newline == -1:
+                    events.append(('thinking', buffer))
+                    self._buffer = ''
+                    break
+                if newline:
+                    events.append(('thinking', buffer[:newline]))
+                events.append(('close', 'phrase'))
+                self._buffer = buffer[newline + 1:]
+                self._mode = 'answer'
+                self._line_start = True
+                continue
+
+            if self._line_start and self.phrases:
+                is_phrase = self._phrase_at_line_start()
+                if is_phrase is None:
+                    break
+                self._line_start = False
+                if is_phrase:
+                    events.append(('open', 'phrase'))
+                    self._mode = 'phrase'
+                    continue
+
+            tag = buffer.find(THINK_OPEN)
+            newline = buffer.find('\n') if self.phrases else -1
+            if tag != -1 and (newline == -1 or tag < newline):
+                if tag:
+                    events.append(('answer', buffer[:tag]))
+                events.append(('open', 'tag'))
+                self._buffer = buffer[tag + len(THINK_OPEN):]
+                self._mode = 'tag'
+                self.phrases = False  # The model marks its own thoughts
+                continue
+            if newline != -1:
+                events.append(('answer', buffer[:newline + 1]))
+                self._buffer = buffer[newline + 1:]
+                self._line_start = True
+                continue
+            keep = partial_suffix(buffer, THINK_OPEN)
+            if len(buffer) > keep:
+                events.append(('answer', buffer[:len(buffer) - keep]))
+            self._buffer = buffer[len(buffer) - keep:]
+            break
+        return events
+
+    def close(self):
+        """Events for whatever is still held back once the stream has ended"""
+        events = []
+        if self._buffer:
+            events.append(('answer' if self._mode == 'answer' else 'thinking', self._buffer))
+            self._buffer = ''
+        if self._mode == 'phrase':
+            events.append(('close', 'phrase'))
+        self._mode = 'answer'
+        return events
+
+# How /query marks thoughts in its text: <think> blocks pass through, phrase lines are wrapped
+LEGACY_THINKING_MARKUP = {
+    ('open', 'tag'): THINK_OPEN, ('close', 'tag'): THINK_CLOSE,
+    ('open', 'phrase'): '[thinking]', ('close', 'phrase'): '\n[/thinking]\n',
+}
+
+def thinking_markup(events):
+    """Text of parser events in /query's format"""
+    return ''.join(text if kind in ('thinking', 'answer') else LEGACY_THINKING_MARKUP[(kind, text)]
+                   for kind, text in events)
+
+class StreamFormatter:
+    """Turns one stream of model output into coalesced SSE frames.
+
+    ``raw`` sends the text as ``response`` frames unchanged. ``segments`` sends the
+    chain of thought as ``thinking`` frames and the rest as ``response`` frames, with
+    the ``<think>`` tags removed. ``legacy`` (/query) sends ``chunk`` frames with
+    thoughts marked up by thinking_markup().
+    """
+
+    def __init__(self, mode='raw', window=SSE_COALESCE_MS / 1000):
+        self.mode = mode
+        self.parser = None if mode == 'raw' else ThinkingStreamParser(phrases=mode == 'legacy')
+        self.coalescer = StreamCoalescer('chunk' if mode == 'legacy' else 'response', window)
+
+    def add(self, text):
+        """``(frames, text to store)`` for the next piece of output; frames may be empty"""
+        if self.parser is None:
+            return self.coalescer.add(text), text
+        return self._frames(self.parser.feed(text))
+
+    def deadline(self):
+        return self.coalescer.deadline()
+
+    def flush_due(self):
+        """Frames for coalesced text whose window has passed; the text was already returned for storing"""
+        return self.coalescer.flush_due()
+
+    def finish(self):
+        """``(frames, text to store)`` for everything still held back at the end of the stream"""
+        if self.parser is None:
+            return self.coalescer.flush(), ''
+        frames, text = self._frames(self.parser.close())
+        return frames + self.coalescer.flush(), text
+
+    def _frames(self, events):
+        text = thinking_markup(events)
+        if self.mode == 'legacy':
+            return self.coalescer.add(text), text
+        frames = ''.join(self.coalescer.add(piece, 'thinking' if kind == 'thinking' else 'response')
+                         for kind, piece in events if kind in ('thinking', 'answer'))
+        return frames, text
+
+def stream_formatter(data, legacy=False):
+    """Formatter for a request: /query's legacy markup, or /chat's raw text or ``segments`` if asked for"""
+    mode = 'legacy' if legacy else 'segments' if data.get('segments') else 'raw'
+    return StreamFormatter(mode, coalesce_window(data))
+
+def ollama_error(status_code, body):
+    """Message for a failed Ollama request, with Ollama's own ``error`` text when it sent one"""
+    try:
+        detail = json.loads(body).get('error')
+    except (ValueError, AttributeError):
+        detail = None
+    return f"Ollama returned status code {status_code}" + (f": {detail}" if detail else '')
+
+class GenerationTurn:
+    """One prompt and answer of a conversation, shared by /chat and /query on both servers.
+
+    Builds the /api/chat payload, turns Ollama's stream chunks into SSE frames and
+    saves the turn, first as checkpoints of a partial answer and then finished.
+    Building the payload reads the chat history, so the ASGI server constructs
+    turns in a worker thread.
+    """
+
+    def __init__(self, data, model, legacy=False):
+        self.model = model
+        self.prompt = data.get('prompt', '')
+        self.chat_id = data.get('chat_id')
+        self.payload = build_chat_payload(model, self.prompt, self.chat_id, data.get('system'))
+        self.cache_key = response_cache.key_for(self.payload)
+        self.formatter = stream_formatter(data, legacy)
+        self.timer = GenerationTimer(model)
+        self.pieces = []
+        self.text = ''
+        self.done = None
+        self.message_id = None
+
+    def feed(self, chunk):
+        """SSE frames for the next /api/chat stream chunk; the ``done`` chunk also flushes the formatter"""
+        frames = ''
+        content = chunk_content(chunk)
+        if content:
+            self.timer.token()
+            self.pieces.append(content)
+            frame, text = self.formatter.add(content)
+            self.text += text
+            frames += frame
+        if chunk.get('done', False):
+            self.timer.done(chunk)
+            frame, text = self.formatter.finish()
+            self.text += text
+            frames += frame
+            self.done = chunk
+        return frames
+
+    def flush_due(self):
+        """SSE frames for output the formatter has held back for a whole coalescing window"""
+        return self.formatter.flush_due()
+
+    def interrupt(self):
+        """SSE frames for output still held back when the stream stops before its ``done`` chunk"""
+        frames, text = self.formatter.finish()
+        self.text += text
+        return frames
+
+    def checkpoint(self):
+        """Write the answer so far: the turn is stored the first time and its answer updated after that"""
+        if self.message_id is None:
+            self.chat_id, self.message_id = store_chat_response(
+                self.model, self.prompt, self.text, self.chat_id, stats=self.done)
+        else:
+            update_chat_response(self.message_id, self.model, self.text, stats=self.done)
+
+    def save(self, cached=False):
+        """Store the turn (and cache it if it finished and was not a replay); returns the chat id"""
+        if self.done is not None:
+            model_residency.record_generation(self.model, self.done)
+        elif not self.text and self.message_id is None:
+            return self.chat_id  # Stopped before any output; there is nothing to keep
+        try:
+            self.checkpoint()
+            if self.done is not None and self.cache_key and not cached:
+                response_cache.put(self.cache_key, self.model, self.pieces, self.done)
+        except Exception as e:
+            # The answer has already been streamed; keep the client's chat id
+            logger.error(f"Error saving chat: {str(e)}")
+        return self.chat_id
+
+GENERATION_BUFFER_FRAMES = int(os.getenv('GURIA_GENERATION_BUFFER_FRAMES', '2048'))  # Recent frames kept per generation for resuming clients
+GENERATION_CHECKPOINT_SECONDS = float(os.getenv('GURIA_GENERATION_CHECKPOINT_SECONDS', '2'))
+GENERATION_SESSION_TTL = float(os.getenv('GURIA_GENERATION_SESSION_TTL', '300'))  # Seconds a finished generation can still be resumed
+GENERATION_HEARTBEAT = 15  # Seconds of silence before a comment line keeps proxies from closing the stream
+STREAM_TEXT_KEYS = ('response', 'thinking', 'chunk')
+
+def split_frames(frames):
+    """The individual SSE frames in a string of frames"""
+    return [frame + '\n\n' for frame in frames.split('\n\n')[:-1]]
+
+def iter_with_deadline(items, deadline, name='stream-reader'):
+    """Yield from ``items``, read in a thread of its own, and yield None each time ``deadline()`` passes first.
+
+    ``deadline()`` returns a time.monotonic() value, or None while there is nothing to wait for.
+    """
+    handoff = queue.Queue()
+    end = object()
+
+    def pump():
+        try:
+            for item in items:
+                handoff.put(item)
+        except Exception as e:
+            handoff.put(e)
+        handoff.put(end)
+
+    Thread(target=pump, name=name, daemon=True).start()
+    while True:
+        due = deadline()
+        try:
+            item = handoff.get(timeout=None if due is None else max(due - time.monotonic(), 0))
+        except queue.Empty:
+            yield None
+            continue
+        if item is end:
+            return
+        if isinstance(item, Exception):
+            raise item
+        yield item
+
+class GenerationSession:
+    """A generation running on the server, independent of the requests watching it.
+
+    Frames go into a ring buffer under increasing event ids, so a client can
+    reconnect with ``Last-Event-ID`` and carry on where it left off. Text frames
+    that fall out of the buffer are folded into ``prefix``; a client that asks
+    for them is sent a ``reset`` frame and the whole answer so far instead.
+    """
+
+    def __init__(self, turn, cached=None, ticket=None, buffer_frames=GENERATION_BUFFER_FRAMES):
+        self.id = os.urandom(8).hex()
+        self.turn = turn
+        self.cached = cached
+        self.ticket = ticket
+        self.status = 'queued'
+        self.error = None
+        self.started_at = time.time()
+        self.finished_at = None
+        self.seq = 0
+        self.frames = deque(maxlen=buffer_frames)
+        self.prefix = []
+        self.changed = threading.Condition()
+        self.listeners = set()  # Called after every change, for watchers on an event loop
+        self.cancelled = threading.Event()
+        self.stop = None  # Set by whoever runs the generation: aborts the upstream request
+        self._next_checkpoint = None
+
+    @property
+    def finished(self):
+        return self.status in ('done', 'error', 'cancelled')
+
+    def state(self):
+        return {
+            'id': self.id, 'model': self.turn.model, 'chat_id': self.turn.chat_id, 'status': self.status,
+            'error': self.error, 'events': self.seq, 'started_at': self.started_at, 'finished_at': self.finished_at,
+            'events_url': f"/generations/{self.id}/events", 'cancel_url': f"/generations/{self.id}/cancel"
+        }
+
+    def emit(self, frames, **changes):
+        """Append SSE frames, each under the next event id, apply ``changes`` and wake every watcher"""
+        if not frames and not changes:
+            return  # Tokens the coalescer is holding back; waking the watchers would be for nothing
+        with self.changed:
+            for frame in split_frames(frames):
+                if len(self.frames) == self.frames.maxlen:
+                    self._fold(self.frames[0][1])
+                self.seq += 1
+                self.frames.append((self.seq, frame))
+            for key, value in changes.items():
+                setattr(self, key, value)
+            self.changed.notify_all()
+            listeners = list(self.listeners)
+        for listener in listeners:
+            listener()
+
+    def _fold(self, frame):
+        payload = json.loads(frame[len('data: '):])
+        if len(payload) != 1 or next(iter(payload)) not in STREAM_TEXT_KEYS:
+            return  # Queue positions and the like only matter while they are current
+        key, text = next(iter(payload.items()))
+        if self.prefix and self.prefix[-1][0] == key:
+            self.prefix[-1][1] += text
+        else:
+            self.prefix.append([key, text])
+
+    def frames_after(self, after):
+        """SSE frames with ids for every event after ``after``; call with ``changed`` held"""
+        first = self.frames[0][0] if self.frames else self.seq + 1
+        out = []
+        if after < first - 1:
+            if self.prefix:
+                if after > 0:
+                    out.append(sse_event({'reset': True}))
+                out.extend(sse_event({key: text}) for key, text in self.prefix[:-1])
+                out.append(f"id: {first - 1}\n" + sse_event({self.prefix[-1][0]: self.prefix[-1][1]}))
+            after = first - 1
+        out.extend(f"id: {seq}\n{frame}" for seq, frame in islice(self.frames, max(after - first + 1, 0), None))
+        return ''.join(out)
+
+    def begin(self):
+        """Mark the generation running once Ollama (or the response cache) starts answering"""
+        self._next_checkpoint = time.monotonic() + GENERATION_CHECKPOINT_SECONDS
+        self.emit('', status='running')
+
+    def feed(self, chunk):
+        """Emit the frames for an Ollama chunk; returns whether the answer so far is due for a checkpoint"""
+        self.emit(self.turn.feed(chunk))
+        if self.turn.done is None and time.monotonic() >= self._next_checkpoint:
+            self._next_checkpoint = time.monotonic() + GENERATION_CHECKPOINT_SECONDS
+            return True
+        return False
+
+    def finish(self, error=None):
+        """Save the turn, finished or not, and emit the last frame; runs once the stream has ended"""
+        if self.turn.done is None:
+            self.emit(self.turn.interrupt())
+        chat_id = self.turn.save(self.cached)
+        if self.turn.done is not None:
+            self.emit(sse_event({'done': True, 'chat_id': chat_id}), status='done', finished_at=time.time())
+        elif self.cancelled.is_set():
+            logger.info(f"Generation {self.id} for {self.turn.model} cancelled after {len(self.turn.text)} characters")
+            self.emit(sse_event({'cancelled': True, 'chat_id': chat_id}), status='cancelled', finished_at=time.time())
+        else:
+            error = error or 'Generation ended before it completed'
+            self.emit(sse_event({'error': error}), status='error', error=error, finished_at=time.time())
+
+class GenerationSessions:
+    """Registry of generation sessions; the threaded server also runs them here.
+
+    A generation runs in its own thread until Ollama finishes or the session is
+    cancelled, however many clients watch it and whether they stay connected.
+    Finished sessions can be resumed for GURIA_GENERATION_SESSION_TTL seconds.
+    The registry is per process.
+    """
+
+    def __init__(self, ttl=GENERATION_SESSION_TTL):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._sessions = {}
+
+    def add(self, session):
+        now = time.time()
+        with self._lock:
+            self._sessions = {key: value for key, value in self._sessions.items()
+                              if not (value.finished and now - value.finished_at > self.ttl)}
+            self._sessions[session.id] = session
+        session.emit(sse_event({'generation': session.state()}))
+        return session
+
+    def start(self, turn, cached=None, ticket=None):
+        """Start a generation in a background thread and return its session"""
+        session = self.add(GenerationSession(turn, cached, ticket))
+        Thread(target=self._run, args=(session,), name=f"generation-{session.id}", daemon=True).start()
+        return session
+
+    def get(self, session_id):
+        with self._lock:
+            return self._sessions.get(session_id)
+
+    def _run(self, session):
+        turn = session.turn
+        response = None
+        error = None
+        try:
+            if session.cached:
+                chunks = response_cache.replay(*session.cached)
+            else:
+                # Cancelling a queued generation gives up its place in line
+                session.stop = lambda: generation_scheduler.release(session.ticket)
+                for frame in wait_for_slot(session.ticket):
+                    session.emit(frame)
+                if session.cancelled.is_set():
+                    return
+                turn.timer.start()
+                response = ollama_client.chat(turn.payload)
+                session.stop = response.close  # Unblocks the stream if it is waiting for the next chunk
+                if session.cancelled.is_set():
+                    return
+                if response.status_code != 200:
+                    raise RuntimeError(ollama_error(response.status_code, response.text))
+                chunks = iter_ndjson(response)
+            session.begin()
+            # Chunks are read in a second thread, so coalesced text goes out on time between them
+            for chunk in iter_with_deadline(chunks, turn.formatter.deadline, f"generation-{session.id}-reader"):
+                if session.cancelled.is_set():
+                    break
+                if chunk is None:
+                    session.emit(turn.flush_due())
+                    continue
+                if session.feed(chunk):
+                    turn.checkpoint()
+                if turn.done is not None:
+                    break
+        except Exception as e:
+            if not session.cancelled.is_set():
+                logger.error(f"Error generating response: {str(e)}")
+                error = str(e)
+        finally:
+            if session.ticket is not None:
+                generation_scheduler.release(session.ticket)
+            if response is not None:
+                response.close()
+            session.finish(error)
+
+    def cancel(self, session_id):
+        """Stop a generation, keeping what it has written so far; returns its state, or None if unknown"""
+        session = self.get(session_id)
+        if session is None:
+            return None
+        if not session.finished:
+            if not session.cancelled.is_set():
+                session.cancelled.set()
+                if session.stop is not None:
+                    session.stop()
+            with session.changed:
+                session.changed.wait_for(lambda: session.finished, timeout=2)
+        return session.state()
+
+    def follow(self, session, after=0):
+        """Yield a session's SSE frames after event ``after`` until it finishes"""
+        while True:
+            with session.changed:
+                session.changed.wait_for(lambda: session.seq > after or session.finished, GENERATION_HEARTBEAT)
+                frames = session.frames_after(after)
+                after = session.seq
+                finished = session.finished
+            if frames:
+                yield frames
+            elif finished:
+                return
+            else:
+                yield ': keep-alive\n\n'
+
+    def stats(self):
+        with self._lock:
+            sessions = list(self._sessions.values())
+        return {
+            'running': sum(1 for session in sessions if not session.finished),
+            'finished': sum(1 for session in sessions if session.finished)
+        }
+
+generation_sessions = GenerationSessions()
+
+def last_event_id(headers, args):
+    """Event id a reconnecting client has seen, from ``Last-Event-ID`` or a ``last_event_id`` parameter"""
+    value = headers.get('Last-Event-ID') or args.get('last_event_id') or '0'
+    return int(value) if value.isdigit() else 0
+
+def stream_turn(legacy):
+    """Start a generation for the JSON request body and stream it as SSE.
+
+    The generation is a session of its own: it goes on if the client goes away,
+    and the client can come back through ``/generations/<id>/events``.
+    """
+    try:
+        data = request.get_json(silent=True) or {}
+        model = data.get('model', session.get('model', 'llama2'))
+        
+        if not data.get('prompt'):
+            return jsonify({'error': 'No prompt provided'}), 400
+            
+        logger.info(f"Received chat request with model: {model}")
+        
+        # Check Ollama connection first
+        ollama_status, error = check_ollama_status()
+        if not ollama_status:
+            return jsonify({"error": f"Ollama service not available: {error}"}), 503
+
+        turn = GenerationTurn(data, model, legacy)
+        cached = response_cache.get(turn.cache_key) if turn.cache_key else None
+        ticket = None
+        if not cached:
+            try:
+                ticket = generation_scheduler.admit(model, client_key())
+            except QueueFull as e:
+                return queue_rejection(e)
+
+        generation = generation_sessions.start(turn, cached, ticket)
+        return Response(timed_stream(generation_sessions.follow(generation), model), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no',
+                                 'X-Generation-Id': generation.id})
+
+    except Exception as e:
+        logger.error(f"Error in chat endpoint: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/generations/<session_id>')
+def get_generation(session_id):
+    generation = generation_sessions.get(session_id)
+    if generation is None:
+        return jsonify({'error': 'No such generation'}), 404
+    return jsonify(generation.state())
+
+@app.route('/generations/<session_id>/events')
+def generation_events(session_id):
+    """Watch a generation as SSE, from the event after ``Last-Event-ID`` until it finishes.
+
+    Several clients can watch the same generation. A generation started by
+    another process (e.g. another prefork worker) is not known here; its
+    checkpointed answer can be read from the chat instead.
+    """
+    generation = generation_sessions.get(session_id)
+    if generation is None:
+        return jsonify({'error': 'No such generation'}), 404
+    frames = generation_sessions.follow(generation, last_event_id(request.headers, request.args))
+    return Response(timed_stream(frames, generation.turn.model), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/generations/<session_id>/cancel', methods=['POST'])
+def cancel_generation(session_id):
+    """Stop a generation and its Ollama request; the answer so far is kept"""
+    state = generation_sessions.cancel(session_id)
+    if state is None:
+        return jsonify({'error': 'No such generation'}), 404
+    return jsonify(state)
+
+THINKING_LINE_INDICATORS = (
+    "Let me think", "I'm thinking", "Let's see", "I'll analyze", "Let me analyze", "I'll check", "Let me check",
+    "First,", "Second,", "Third,", "Finally,", "Now,", "Next,", "Then,",
+)
 
 def format_response(response):
     """Format the response to handle special tags and markdown."""
@@ -291,26 +2541,8 @@ def format_response(response):
     in_thinking = False
     
     for line in lines:
-        # Check for thinking indicators
-        thinking_indicators = [
-            "Let me think",
-            "I'm thinking",
-            "Let's see",
-            "I'll analyze",
-            "Let me analyze",
-            "I'll check",
-            "Let me check",
-            "First,",
-            "Second,",
-            "Third,",
-            "Finally,",
-            "Now,",
-            "Next,",
-            "Then,",
-        ]
-        
         # If line starts with any thinking indicator, wrap it in think tags
-        if any(line.strip().startswith(indicator) for indicator in thinking_indicators):
+        if line.lstrip().startswith(THINKING_LINE_INDICATORS):
             if not in_thinking:
                 formatted_lines.append("<think>")
                 in_thinking = True
@@ -328,92 +2560,253 @@ def format_response(response):
     return '\n'.join(formatted_lines)
 
 @app.route('/query', methods=['POST'])
-def query(model, prompt):
-    try:
-        # Check Ollama connection first
-        ollama_status, error = check_ollama_status()
-        if not ollama_status:
-            return jsonify({"error": f"Ollama service not available: {error}"}), 503
+def query():
+    """/chat with the legacy ``chunk`` frames and inline thinking markup"""
+    return stream_turn(legacy=True)
 
-        def generate():
-            try:
-                response = requests.post(
-                    f"{OLLAMA_BASE_URL}/api/generate",
-                    json={
-                        "model": model,
-                        "prompt": prompt,
-                        "stream": True,
-                        "options": {
-                            "num_predict": 2048,
-                            "temperature": 0.7,
-                            "top_k": 40,
-                            "top_p": 0.9
-                        }
-                    },
-                    stream=True,
-                    timeout=(5, 300)
-                )
-                
-                if response.status_code == 200:
-                    full_response = ""
-                    
-                    for line in response.iter_lines():
-                        if line:
-                            try:
-                                chunk = json.loads(line)
-                                if 'response' in chunk:
-                                    chunk_text = format_chunk_with_thinking(chunk['response'])
-                                    full_response += chunk_text
-                                    yield f"data: {json.dumps({'chunk': chunk_text})}\n\n"
-                                
-                                if chunk.get('done', False):
-                                    try:
-                                        save_chat(model, prompt, full_response)
-                                    except Exception as e:
-                                        logger.error(f"Error saving chat: {str(e)}")
-                                    yield f"data: {json.dumps({'done': True})}\n\n"
-                                    break
-                            except json.JSONDecodeError:
-                                continue
-                else:
-                    error_msg = f"Ollama returned status code {response.status_code}"
-                    logger.error(error_msg)
-                    yield f"data: {json.dumps({'error': error_msg})}\n\n"
-                    
-            except Exception as e:
-                logger.error(f"Error generating response: {str(e)}")
-                yield f"data: {json.dumps({'error': str(e)})}\n\n"
-        
-        return Response(generate(), mimetype='text/event-stream')
+CHAT_HISTORY_PAGE_SIZE = 50
+CHAT_HISTORY_MAX_PAGE_SIZE = 200
+CHAT_TITLE_LENGTH = 35
+HISTORY_CHANGE_LOG_SIZE = 10000  # Change feed entries kept before clients must reload the sidebar
 
-    except Exception as e:
-        logger.error(f"Server error: {str(e)}")
-        return jsonify({"error": str(e)}), 500
+def chat_title(prompt):
+    """Sidebar title for a chat: its first prompt truncated to CHAT_TITLE_LENGTH characters"""
+    if len(prompt) > CHAT_TITLE_LENGTH:
+        return prompt[:CHAT_TITLE_LENGTH - 3] + '...'
+    return prompt
+
+def get_history_version(conn):
+    """Current history version: the sequence number of the latest chat_changes entry"""
+    row = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'chat_changes'").fetchone()
+    return row[0] if row else 0
+
+def encode_history_cursor(timestamp, chat_id):
+    """Opaque keyset cursor pointing just past (timestamp, id)"""
+    return base64.urlsafe_b64encode(f"{timestamp}|{chat_id}".encode()).decode()
+
+def decode_history_cursor(cursor):
+    timestamp, chat_id = base64.urlsafe_b64decode(cursor.encode()).decode().rsplit('|', 1)
+    return timestamp, int(chat_id)
 
 @app.route('/chat_history')
 def get_chat_history():
-    """Get chat history."""
+    """Get one page of chat history, newest first.
+
+    Query parameters: ``limit`` (page size), ``cursor`` (``next_cursor`` from the
+    previous page) and ``view`` (``summary`` by default, ``full`` to include the
+    first prompt and the latest response).
+    """
     try:
+        limit = min(max(request.args.get('limit', CHAT_HISTORY_PAGE_SIZE, type=int), 1), CHAT_HISTORY_MAX_PAGE_SIZE)
+        full = request.args.get('view', 'summary') == 'full'
+        cursor = request.args.get('cursor')
+        
+        # Summaries only read the start of the title, never the messages
+        latest_response = "(SELECT content FROM messages WHERE chat_id = chats.id AND role = 'assistant' ORDER BY seq DESC LIMIT 1)"
+        columns = f'id, model, title, {latest_response}, timestamp' if full else f'id, model, substr(title, 1, {CHAT_TITLE_LENGTH + 1}), NULL, timestamp'
+        params = []
+        where = ''
+        if cursor:
+            try:
+                params.extend(decode_history_cursor(cursor))
+            except (ValueError, UnicodeDecodeError):
+                return jsonify({'error': 'Invalid cursor'}), 400
+            where = 'WHERE (timestamp, id) < (?, ?)'
+        params.append(limit + 1)
+        
         conn = get_db()
+        # Read the version first: changes racing with this page are replayed by /chat_history/changes
+        version = get_history_version(conn)
         cur = conn.cursor()
-        cur.execute('SELECT id, model, prompt, response, timestamp FROM chats ORDER BY timestamp DESC')
+        cur.execute(f'SELECT {columns} FROM chats {where} ORDER BY timestamp DESC, id DESC LIMIT ?', params)
         chats = cur.fetchall()
         
+        has_more = len(chats) > limit
+        chats = chats[:limit]
+        
         # Convert to list of dicts for JSON serialization
         chat_list = []
         for chat in chats:
-            chat_list.append({
+            item = {
                 'id': chat[0],
                 'model': chat[1],
-                'prompt': chat[2],
-                'response': chat[3],
+                'title': chat_title(chat[2]),
                 'timestamp': chat[4]
-            })
+            }
+            if full:
+                item['prompt'] = chat[2]
+                item['response'] = chat[3]
+            chat_list.append(item)
         
-        return jsonify(chat_list)
+        return jsonify({
+            'chats': chat_list,
+            'next_cursor': encode_history_cursor(chats[-1][4], chats[-1][0]) if has_more else None,
+            'version': version
+        })
     except Exception as e:
         logger.error(f"Error getting chat history: {str(e)}")
-        return jsonify([])
+        return jsonify({'chats': [], 'next_cursor': None, 'version': 0})
+
+@app.route('/chat_history/changes')
+def get_chat_history_changes():
+    """Get the chats inserted, updated or deleted since a history version.
+
+    Returns ``{'version', 'reset', 'changes'}``. ``reset`` tells the client to
+    drop its list (history was cleared, or ``since`` is older than the change log)
+    before applying ``changes``.
+    """
+    try:
+        since = request.args.get('since', 0, type=int)
+        conn = get_db()
+        version = get_history_version(conn)
+        oldest = conn.execute('SELECT MIN(version) FROM chat_changes').fetchone()[0]
+        if since > version or (oldest is not None and since < oldest - 1):
+            return jsonify({'version': version, 'reset': True, 'changes': []})
+        
+        rows = conn.execute(
+            'SELECT version, chat_id, op FROM chat_changes WHERE version > ? AND version <= ? ORDER BY version',
+            (since, version)
+        ).fetchall()
+        
+        # Collapse the log to the net effect per chat
+        reset = False
+        latest = {}
+        for _, chat_id, op in rows:
+            if op == 'clear':
+                reset = True
+                latest = {}
+            elif op == 'update' and latest.get(chat_id) == 'insert':
+                continue
+            else:
+                latest[chat_id] = op
+        
+        if len(latest) > CHAT_HISTORY_MAX_PAGE_SIZE:
+            return jsonify({'version': version, 'reset': True, 'changes': []})
+        
+        live_ids = [chat_id for chat_id, op in latest.items() if op != 'delete']
+        summaries = {}
+        if live_ids:
+            placeholders = ','.join('?' * len(live_ids))
+            for chat in conn.execute(
+                f'SELECT id, model, substr(title, 1, {CHAT_TITLE_LENGTH + 1}), timestamp FROM chats WHERE id IN ({placeholders})',
+                live_ids
+            ):
+                summaries[chat[0]] = {'id': chat[0], 'model': chat[1], 'title': chat_title(chat[2]), 'timestamp': chat[3]}
+        
+        changes = []
+        for chat_id, op in latest.items():
+            if op != 'delete' and chat_id in summaries:
+                changes.append({'op': op, 'chat': summaries[chat_id]})
+            else:
+                changes.append({'op': 'delete', 'id': chat_id})
+        
+        return jsonify({'version': version, 'reset': reset, 'changes': changes})
+    except Exception as e:
+        logger.error(f"Error getting chat history changes: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+SEARCH_AVAILABLE = True
+SEARCH_PAGE_SIZE = 20
+# Control characters mark highlights in snippet() output so the rest of the text can be HTML-escaped
+SNIPPET_OPEN, SNIPPET_CLOSE = '\x02', '\x03'
+
+def build_fts_query(text):
+    """Turn free text into an FTS5 query: every word must match, the last one as a prefix"""
+    terms = [term.replace('"', '""') for term in text.split()]
+    if not terms:
+        return None
+    return ' '.join(f'"{term}"' for term in terms[:-1]) + (' ' if len(terms) > 1 else '') + f'"{terms[-1]}"*'
+
+def format_snippet(snippet):
+    """Escape an FTS5 snippet and turn its match markers into <mark> tags"""
+    return html.escape(snippet or '').replace(SNIPPET_OPEN, '<mark>').replace(SNIPPET_CLOSE, '</mark>')
+
+def search_chats(conn, text, model=None, date_from=None, date_to=None, limit=SEARCH_PAGE_SIZE, offset=0):
+    """Rank chats matching ``text`` with bm25, user message matches weighing twice as much as answers"""
+    fts_query = build_fts_query(text)
+    if fts_query is None:
+        return []
+    
+    filters = ''
+    params = [fts_query]
+    if model:
+        filters += ' AND c.model = ?'
+        params.append(model)
+    if date_from:
+        filters += ' AND c.timestamp >= ?'
+        params.append(date_from)
+    if date_to:
+        filters += ' AND c.timestamp < ?'
+        params.append(date_to)
+    params.extend([limit, offset])
+    
+    # Rank conversations by their best-matching message (SQLite returns the bare columns
+    # of the row that produced MIN), then build snippets only for the rows on this page.
+    # bm25() cannot appear inside an aggregate; the hidden rank column is the same score
+    rows = conn.execute(f'''
+        SELECT c.id, c.model, substr(c.title, 1, {CHAT_TITLE_LENGTH + 1}), c.timestamp, m.id, m.role,
+               MIN(messages_fts.rank * CASE m.role WHEN 'user' THEN 2.0 ELSE 1.0 END) AS score
+        FROM messages_fts
+        JOIN messages m ON m.id = messages_fts.rowid
+        JOIN chats c ON c.id = m.chat_id
+        WHERE messages_fts MATCH ?{filters}
+        GROUP BY c.id
+        ORDER BY score
+        LIMIT ? OFFSET ?
+    ''', params).fetchall()
+    if not rows:
+        return []
+    
+    placeholders = ','.join('?' * len(rows))
+    snippets = dict(conn.execute(f'''
+        SELECT rowid, snippet(messages_fts, 0, ?, ?, '...', 24)
+        FROM messages_fts
+        WHERE messages_fts MATCH ? AND rowid IN ({placeholders})
+    ''', [SNIPPET_OPEN, SNIPPET_CLOSE, fts_query] + [row[4] for row in rows]).fetchall())
+    
+    return [{
+        'id': row[0],
+        'model': row[1],
+        'title': chat_title(row[2]),
+        'timestamp': row[3],
+        'score': round(-row[6], 4),
+        'role': row[5],
+        'snippet': format_snippet(snippets.get(row[4], ''))
+    } for row in rows]
+
+@app.route('/search')
+def search():
+    """Full-text search over stored chats.
+
+    Query parameters: ``q`` (required), ``model``, ``from`` and ``to`` (ISO
+    timestamps, ``to`` exclusive), ``limit`` and ``offset``. Snippets are
+    HTML-escaped with matches wrapped in ``<mark>``.
+    """
+    if not SEARCH_AVAILABLE:
+        return jsonify({'error': 'Full-text search is not available in this SQLite build'}), 501
+    text = request.args.get('q', '').strip()
+    if not text:
+        return jsonify({'error': 'No search query provided'}), 400
+    try:
+        limit = min(max(request.args.get('limit', SEARCH_PAGE_SIZE, type=int), 1), CHAT_HISTORY_MAX_PAGE_SIZE)
+        offset = max(request.args.get('offset', 0, type=int), 0)
+        started = time.monotonic()
+        results = search_chats(
+            get_db(), text,
+            model=request.args.get('model'),
+            date_from=request.args.get('from'),
+            date_to=request.args.get('to'),
+            limit=limit + 1,
+            offset=offset
+        )
+        return jsonify({
+            'results': results[:limit],
+            'next_offset': offset + limit if len(results) > limit else None,
+            'took_ms': round((time.monotonic() - started) * 1000, 2)
+        })
+    except Exception as e:
+        logger.error(f"Error searching chats: {str(e)}")
+        return jsonify({'error': str(e)}), 500
 
 @app.route('/clear_history', methods=['POST'])
 def clear_history():
@@ -422,6 +2815,9 @@ def clear_history():
         conn = get_db()
         cur = conn.cursor()
         cur.execute('DELETE FROM chats')
+        # One 'clear' tombstone replaces the per-row delete entries
+        cur.execute("INSERT INTO chat_changes (chat_id, op) VALUES (NULL, 'clear')")
+        cur.execute('DELETE FROM chat_changes WHERE version < ?', (cur.lastrowid,))
         conn.commit()
         logger.info("Chat history cleared successfully")
         return jsonify({'status': 'success'})
@@ -444,17 +2840,15 @@ def save_chat():
         timestamp = datetime.now().isoformat()
         
         # Save to database
-        conn = get_db()
-        cursor = conn.cursor()
-        cursor.execute(
-            'INSERT INTO chats (model, prompt, response, timestamp) VALUES (?, ?, ?, ?)',
-            (model, prompt, response, timestamp)
-        )
+        conn = get_db()
+        conn.execute('BEGIN IMMEDIATE')
+        chat_id = create_chat(conn, model, prompt, timestamp)
+        append_messages(conn, chat_id, [
+            {'role': 'user', 'content': prompt, 'model': model},
+            {'role': 'assistant', 'content': response, 'model': model}
+        ])
         conn.commit()
         
-        # Get the ID of the newly created chat
-        chat_id = cursor.lastrowid
-        
         return jsonify({
             'id': chat_id,
             'timestamp': timestamp
@@ -466,21 +2860,25 @@ def save_chat():
 
 @app.route('/chat/<int:chat_id>')
 def get_chat(chat_id):
-    """Get a specific chat."""
+    """Get a specific chat with all of its messages."""
     try:
         conn = get_db()
         cur = conn.cursor()
-        cur.execute('SELECT model, prompt, response, timestamp FROM chats WHERE id = ?', (chat_id,))
+        cur.execute('SELECT model, title, timestamp, updated_at FROM chats WHERE id = ?', (chat_id,))
         chat = cur.fetchone()
         
         if chat is None:
             return jsonify({'error': 'Chat not found'}), 404
-            
+        
+        messages = load_messages(conn, chat_id)
+        responses = [m['content'] for m in messages if m['role'] == 'assistant']
         return jsonify({
             'model': chat[0],
             'prompt': chat[1],
-            'response': chat[2],
-            'timestamp': chat[3]
+            'response': responses[-1] if responses else '',
+            'timestamp': chat[2],
+            'updated_at': chat[3],
+            'messages': messages
         })
     except Exception as e:
         logger.error(f"Error getting chat {chat_id}: {str(e)}")
@@ -504,142 +2902,1267 @@ def delete_chat():
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+EXPORT_DIR = os.getenv('GURIA_EXPORT_DIR', os.path.join(tempfile.gettempdir(), 'guria-exports'))
+EXPORT_WORKERS = int(os.getenv('GURIA_EXPORT_WORKERS', '2'))
+EXPORT_CACHE_FILES = int(os.getenv('GURIA_EXPORT_CACHE_FILES', '200'))  # Rendered PDFs kept on disk
+EXPORT_JOB_TTL = 3600  # Seconds a finished job stays queryable
+PDF_PAGE_SIZES = {'letter': letter, 'a4': A4}
+PDF_CODE_BLOCK = re.compile(r'<pre><code.*?>(.*?)</code></pre>', re.DOTALL)
+
+def build_pdf_styles():
+    """Paragraph styles for PDF exports; built once and shared by every export"""
+    styles = getSampleStyleSheet()
+    styles.add(ParagraphStyle(
+        name='CodeBlock',
+        parent=styles['Normal'],
+        fontName='Courier',
+        fontSize=9,
+        leading=12,
+        leftIndent=36,
+        textColor=colors.white,
+        backColor=colors.Color(0.1, 0.1, 0.1),  # Dark background (almost black)
+        borderPadding=8,
+        borderColor=colors.Color(0.15, 0.15, 0.15)  # Slightly lighter border
+    ))
+    return styles
+
+PDF_STYLES = build_pdf_styles()
+
+def message_flowables(message):
+    """Platypus flowables for one chat message"""
+    if message['role'] == 'user':
+        return [
+            Paragraph("User:", PDF_STYLES['Heading2']),
+            Spacer(1, 6),
+            Paragraph(html.escape(message['content']), PDF_STYLES['Normal']),
+            Spacer(1, 12)
+        ]
+
+    flowables = [Paragraph("Assistant:", PDF_STYLES['Heading2']), Spacer(1, 6)]
+    # Convert markdown to HTML and lift code blocks out as preformatted text
+    html_response = markdown2.markdown(message['content'])
+    current_pos = 0
+    for match in PDF_CODE_BLOCK.finditer(html_response):
+        text_before = html_response[current_pos:match.start()]
+        if text_before:
+            flowables.append(Paragraph(html.unescape(text_before), PDF_STYLES['Normal']))
+            flowables.append(Spacer(1, 6))
+        flowables.append(Preformatted(html.unescape(match.group(1)), PDF_STYLES['CodeBlock']))
+        flowables.append(Spacer(1, 6))
+        current_pos = match.end()
+    if current_pos < len(html_response):
+        flowables.append(Paragraph(html.unescape(html_response[current_pos:]), PDF_STYLES['Normal']))
+    flowables.append(Spacer(1, 12))
+    return flowables
+
+def render_chat_pdf(messages, path, page_size='letter', progress=None):
+    """Write a PDF of ``messages`` to ``path``, reporting completion (0-1) to ``progress``"""
+    flowables = [
+        Paragraph("Chat Export", PDF_STYLES['Title']),
+        Spacer(1, 12),
+        Paragraph(f"Generated on: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}", PDF_STYLES['Normal']),
+        Spacer(1, 24)
+    ]
+    for index, message in enumerate(messages):
+        flowables.extend(message_flowables(message))
+        if progress:
+            progress(0.5 * (index + 1) / len(messages))
+
+    doc = SimpleDocTemplate(path, pagesize=PDF_PAGE_SIZES[page_size],
+                            rightMargin=72, leftMargin=72, topMargin=72, bottomMargin=72)
+    estimate = {'size': 1}
+
+    def on_build(kind, value):
+        if kind == 'SIZE_EST':
+            estimate['size'] = max(value, 1)
+        elif kind == 'PROGRESS' and progress:
+            progress(0.5 + 0.5 * min(value / estimate['size'], 1))
+    doc.setProgressCallBack(on_build)
+    doc.build(flowables)
+
+class ExportJobs:
+    """PDF exports rendered on a small thread pool and cached on disk.
+
+    A job's id is the hash of what it renders (chat, content and options), so
+    repeating an export reuses the running job or the finished file. Job state is
+    per process, but finished files are shared through EXPORT_DIR.
+    """
+
+    def __init__(self, directory=EXPORT_DIR, workers=EXPORT_WORKERS, max_files=EXPORT_CACHE_FILES):
+        self.directory = directory
+        self.workers = workers
+        self.max_files = max_files
+        self._lock = threading.Lock()
+        self._jobs = {}
+        self._executor = None
+
+    @staticmethod
+    def job_id(source, messages, options):
+        """Cache key for an export: the source, a hash of the messages and the export options"""
+        content_hash = hashlib.sha256(
+            json.dumps([(m['role'], m['content']) for m in messages]).encode()).hexdigest()
+        return hashlib.sha256(json.dumps([source, content_hash, options], sort_keys=True).encode()).hexdigest()[:32]
+
+    def path(self, job_id):
+        return os.path.join(self.directory, f"{job_id}.pdf")
+
+    def submit(self, source, messages, options):
+        """Start an export, or return the running or finished one with the same content"""
+        job_id = self.job_id(source, messages, options)
+        path = self.path(job_id)
+        with self._lock:
+            self._expire()
+            job = self._jobs.get(job_id)
+            if job and (job['status'] in ('queued', 'running') or (job['status'] == 'done' and os.path.exists(path))):
+                return self._public(job)
+            job = {'id': job_id, 'status': 'queued', 'progress': 0.0, 'error': None, 'finished_at': None}
+            self._jobs[job_id] = job
+            if os.path.exists(path):
+                os.utime(path)  # Most recently used
+                job.update(status='done', progress=1.0, finished_at=time.time())
+                return self._public(job)
+            if self._executor is None:
+                # Created on first use so forked workers get their own threads
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='pdf-export')
+            job['future'] = self._executor.submit(self._run, job, messages, options)
+            return self._public(job)
+
+    @staticmethod
+    def _public(job):
+        return {key: value for key, value in job.items() if key != 'future'}
+
+    def _run(self, job, messages, options):
+        path = self.path(job['id'])
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+
+        def progress(fraction):
+            job['progress'] = round(fraction, 3)
+
+        job['status'] = 'running'
+        started = time.monotonic()
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            render_chat_pdf(messages, tmp_path, options['page_size'], progress)
+            os.replace(tmp_path, path)
+            job.update(status='done', progress=1.0)
+            metrics.observe('export_render_seconds', 'chat', time.monotonic() - started)
+            logger.info(f"Exported PDF {job['id']} ({len(messages)} messages) in {time.monotonic() - started:.2f}s")
+            self._prune()
+        except Exception as e:
+            logger.error(f"Error exporting PDF {job['id']}: {str(e)}")
+            job.update(status='error', error=str(e))
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        finally:
+            job['finished_at'] = time.time()
+
+    def status(self, job_id):
+        """Job state, or None if this process does not know the job and no file exists for it.
+
+        A finished job whose file has since been pruned from the cache (by any
+        process) is ``expired``; submitting the export again renders it anew.
+        """
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is not None:
+                if job['status'] == 'done' and not os.path.exists(self.path(job_id)):
+                    job.update(status='expired', progress=0.0, error='The exported file is no longer cached')
+                return self._public(job)
+        if os.path.exists(self.path(job_id)):
+            return {'id': job_id, 'status': 'done', 'progress': 1.0, 'error': None}
+        return None
+
+    def _expire(self):
+        cutoff = time.time() - EXPORT_JOB_TTL
+        for job_id in [j for j, job in self._jobs.items() if job['finished_at'] and job['finished_at'] < cutoff]:
+            del self._jobs[job_id]
+
+    def _prune(self):
+        """Delete the least recently used PDFs beyond max_files"""
+        try:
+            files = [entry for entry in os.scandir(self.directory) if entry.name.endswith('.pdf')]
+        except FileNotFoundError:
+            return
+        if len(files) <= self.max_files:
+            return
+        files.sort(key=lambda entry: entry.stat().st_mtime)
+        for entry in files[:len(files) - self.max_files]:
+            try:
+                os.remove(entry.path)
+            except FileNotFoundError:
+                pass
+
+export_jobs = ExportJobs()
+
+def export_options(data):
+    """Validated export options from a request body"""
+    page_size = str((data or {}).get('page_size', 'letter')).lower()
+    if page_size not in PDF_PAGE_SIZES:
+        raise ValueError(f"Unsupported page size: {page_size}")
+    return {'page_size': page_size}
+
+def export_source(data, chat_id=None):
+    """``(source, messages)`` to export: a saved chat or raw content from the request body.
+
+    Returns ``(None, error_response)`` when there is nothing to export.
+    """
+    if chat_id is None:
+        chat_id = (data or {}).get('chat_id')
+    if chat_id is None:
+        content = (data or {}).get('content', '')
+        if not content:
+            return None, (jsonify({'error': 'No content provided'}), 400)
+        return 'content', [{'role': 'assistant', 'content': content}]
+
+    conn = get_db()
+    if not conn.execute('SELECT 1 FROM chats WHERE id = ?', (chat_id,)).fetchone():
+        return None, (jsonify({'error': 'Chat not found'}), 404)
+    return f"chat:{chat_id}", load_messages(conn, chat_id)
+
+def export_job_response(job):
+    payload = dict(job, job_url=url_for('get_export_job', job_id=job['id']))
+    if job['status'] == 'done':
+        payload['download_url'] = url_for('download_export', job_id=job['id'])
+    return payload
+
+@app.route('/export_jobs', methods=['POST'])
+def create_export_job():
+    """Start a background PDF export of a chat (``chat_id``) or of raw ``content``.
+
+    Returns the job with its progress; poll GET /export_jobs/<id> and fetch the
+    file from its ``download_url`` once ``status`` is ``done``.
+    """
+    try:
+        data = request.get_json(silent=True) or {}
+        options = export_options(data)
+        source, messages = export_source(data)
+        if source is None:
+            return messages
+        job = export_jobs.submit(source, messages, options)
+        return jsonify(export_job_response(job)), 200 if job['status'] == 'done' else 202
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        logger.error(f"Error starting PDF export: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/export_jobs/<job_id>')
+def get_export_job(job_id):
+    job = export_jobs.status(job_id)
+    if job is None:
+        return jsonify({'error': 'Export job not found'}), 404
+    return jsonify(export_job_response(job))
+
+@app.route('/export_jobs/<job_id>/download')
+def download_export(job_id):
+    """Stream a finished export from disk; supports Range and conditional requests"""
+    path = export_jobs.path(job_id)
+    if not re.fullmatch(r'[0-9a-f]{32}', job_id) or not os.path.exists(path):
+        return jsonify({'error': 'Export not found'}), 404
+    return send_file(path, mimetype='application/pdf', as_attachment=True,
+                     download_name='chat_export.pdf', conditional=True, max_age=EXPORT_JOB_TTL)
+
 @app.route('/export_pdf', methods=['POST'])
 @app.route('/export_pdf/<int:chat_id>', methods=['GET'])
 def export_pdf(chat_id=None):
+    """Download a cached PDF export, or start rendering it and return ``202`` with the job to poll"""
     try:
-        from reportlab.lib import colors
-        from reportlab.lib.pagesizes import letter
-        from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
-        from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Preformatted
-        from reportlab.lib.units import inch
-        import io
-        import re
-        import markdown2
-        import html
-
-        if chat_id is None:
-            # Handle POST request with content in body
-            data = request.get_json()
-            content = data.get('content', '')
-            if not content:
-                return jsonify({'error': 'No content provided'}), 400
-            user_content = ""
-            assistant_content = content
-        else:
-            # Handle GET request with chat_id
-            conn = get_db()
-            cursor = conn.cursor()
-            cursor.execute('SELECT prompt, response FROM chats WHERE id = ?', (chat_id,))
-            chat = cursor.fetchone()
-            
-            if not chat:
-                return jsonify({'error': 'Chat not found'}), 404
-                
-            user_content = chat[0]
-            assistant_content = chat[1]
-
-        # Create PDF buffer
-        buffer = io.BytesIO()
-        
-        # Create the PDF document
-        doc = SimpleDocTemplate(
-            buffer,
-            pagesize=letter,
-            rightMargin=72,
-            leftMargin=72,
-            topMargin=72,
-            bottomMargin=72
-        )
-
-        # Get styles
-        styles = getSampleStyleSheet()
-        
-        # Create custom styles
-        styles.add(ParagraphStyle(
-            name='CodeBlock',
-            parent=styles['Normal'],
-            fontName='Courier',
-            fontSize=9,
-            leading=12,
-            leftIndent=36,
-            textColor=colors.white,
-            backColor=colors.Color(0.1, 0.1, 0.1),  # Dark background (almost black)
-            borderPadding=8,
-            borderColor=colors.Color(0.15, 0.15, 0.15)  # Slightly lighter border
-        ))
-
-        # Create content
-        content = []
-        
-        # Add title
-        title = Paragraph("Chat Export", styles['Title'])
-        content.append(title)
-        content.append(Spacer(1, 12))
-        
-        # Add timestamp
-        timestamp = Paragraph(f"Generated on: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}", styles['Normal'])
-        content.append(timestamp)
-        content.append(Spacer(1, 24))
-
-        if user_content:
-            # Process and add user message
-            content.append(Paragraph("User:", styles['Heading2']))
-            content.append(Spacer(1, 6))
-            user_message = html.escape(user_content)
-            content.append(Paragraph(user_message, styles['Normal']))
-            content.append(Spacer(1, 12))
-
-        # Process and add assistant message
-        content.append(Paragraph("Assistant:", styles['Heading2']))
-        content.append(Spacer(1, 6))
-        
-        # Convert markdown to HTML and handle code blocks
-        html_response = markdown2.markdown(assistant_content)
-        
-        # Extract and process code blocks
-        code_pattern = re.compile(r'<pre><code.*?>(.*?)</code></pre>', re.DOTALL)
-        last_end = 0
-        current_pos = 0
-        
-        for match in code_pattern.finditer(html_response):
-            # Add text before code block
-            text_before = html_response[current_pos:match.start()]
-            if text_before:
-                text_before = html.unescape(text_before)
-                content.append(Paragraph(text_before, styles['Normal']))
-                content.append(Spacer(1, 6))
-            
-            # Add code block
-            code = html.unescape(match.group(1))
-            content.append(Preformatted(code, styles['CodeBlock']))
-            content.append(Spacer(1, 6))
-            
-            current_pos = match.end()
-            
-        # Add remaining text after last code block
-        if current_pos < len(html_response):
-            remaining_text = html_response[current_pos:]
-            remaining_text = html.unescape(remaining_text)
-            content.append(Paragraph(remaining_text, styles['Normal']))
-
-        # Build PDF
-        doc.build(content)
-        
-        # Get PDF from buffer
-        buffer.seek(0)
-        
-        return send_file(
-            buffer,
-            mimetype='application/pdf',
-            as_attachment=True,
-            download_name='chat_export.pdf'
-        )
+        data = request.get_json(silent=True) if chat_id is None else {}
+        source, messages = export_source(data, chat_id)
+        if source is None:
+            return messages
+        job = export_jobs.submit(source, messages, export_options(data))
+        if job['status'] == 'done':
+            return download_export(job['id'])
+        # Rendering never holds a request thread; the client polls the job like one from /export_jobs
+        payload = export_job_response(job)
+        return jsonify(payload), 202, {'Location': payload['job_url'], 'Retry-After': '1'}
         
     except Exception as e:
         logger.error(f"Error exporting PDF: {str(e)}")
         return jsonify({'error': 'Failed to export PDF'}), 500
 
+BULK_EXPORT_FORMATS = {'md': 'text/markdown', 'jsonl': 'application/x-ndjson', 'pdf': 'application/pdf'}
+BULK_EXPORT_ARCHIVES = {'zip': 'application/zip', 'tar': 'application/x-tar', 'tar.gz': 'application/gzip'}
+BULK_EXPORT_BATCH = 200  # Chats read per query while streaming an archive
+BULK_EXPORT_PROCESSES = int(os.getenv('GURIA_EXPORT_PROCESSES', str(min(os.cpu_count() or 2, 4))))
+BULK_EXPORT_CHUNK = 64 * 1024
+_export_process_pool = {'executor': None}
+_export_process_lock = threading.Lock()
+
+def export_process_pool():
+    """Worker processes shared by bulk PDF exports, started on first use.
+
+    Workers are spawned rather than forked so they never inherit the server's
+    threads or open database connections.
+    """
+    with _export_process_lock:
+        if _export_process_pool['executor'] is None:
+            _export_process_pool['executor'] = ProcessPoolExecutor(
+                max_workers=BULK_EXPORT_PROCESSES, mp_context=multiprocessing.get_context('spawn'))
+        return _export_process_pool['executor']
+
+def render_chat_pdf_file(messages, path, page_size='letter'):
+    """Render a chat into ``path`` via a temporary file, returning the seconds it took.
+
+    Runs inside an export worker process, so the caller records the timing.
+    """
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    started = time.monotonic()
+    try:
+        render_chat_pdf(messages, tmp_path, page_size)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return time.monotonic() - started
+
+def bulk_export_filters(data):
+    """Validated filter and output options for a bulk export"""
+    data = data or {}
+    export_format = str(data.get('format', 'md')).lower()
+    if export_format not in BULK_EXPORT_FORMATS:
+        raise ValueError(f"Unsupported export format: {export_format}")
+    archive = str(data.get('archive', 'zip')).lower()
+    if archive not in BULK_EXPORT_ARCHIVES:
+        raise ValueError(f"Unsupported archive type: {archive}")
+
+    ids = data.get('ids') or []
+    if isinstance(ids, str):
+        ids = [part for part in ids.split(',') if part.strip()]
+    try:
+        ids = [int(chat_id) for chat_id in ids]
+    except (TypeError, ValueError):
+        raise ValueError('ids must be a list of chat ids')
+
+    dates = {}
+    for key in ('from', 'to'):
+        value = data.get(key)
+        if value:
+            try:
+                dates[key] = datetime.fromisoformat(str(value)).isoformat()
+            except ValueError:
+                raise ValueError(f"Invalid '{key}' date: {value}")
+    if 'to' in dates and len(str(data['to'])) == 10:
+        dates['to'] = f"{str(data['to'])}T23:59:59.999999"  # A bare date includes the whole day
+
+    return {
+        'format': export_format,
+        'archive': archive,
+        'ids': ids,
+        'from': dates.get('from'),
+        'to': dates.get('to'),
+        'model': data.get('model') or None,
+        'page_size': export_options(data)['page_size'],
+    }
+
+def iter_export_chats(filters, batch_size=BULK_EXPORT_BATCH):
+    """Yield ``(chat, messages)`` for every chat matching ``filters``, oldest first.
+
+    Chats are read in keyset-paginated batches and each chat's messages are
+    loaded only when it is reached, so memory does not grow with the number of
+    chats. A connection is borrowed per query and never held while the caller
+    is writing to the client.
+    """
+    clauses, params = ['(timestamp, id) > (?, ?)'], []
+    if filters['ids']:
+        clauses.append(f"id IN ({','.join('?' * len(filters['ids']))})")
+        params.extend(filters['ids'])
+    if filters['from']:
+        clauses.append('timestamp >= ?')
+        params.append(filters['from'])
+    if filters['to']:
+        clauses.append('timestamp <= ?')
+        params.append(filters['to'])
+    if filters['model']:
+        clauses.append('model = ?')
+        params.append(filters['model'])
+    sql = f"SELECT id, model, title, timestamp FROM chats WHERE {' AND '.join(clauses)} ORDER BY timestamp, id LIMIT ?"
+
+    last = ('', 0)
+    while True:
+        with db_connection() as conn:
+            rows = conn.execute(sql, (*last, *params, batch_size)).fetchall()
+        for row in rows:
+            chat = {'id': row[0], 'model': row[1], 'title': row[2], 'timestamp': row[3]}
+            with db_connection() as conn:
+                messages = load_messages(conn, chat['id'])
+            yield chat, messages
+        if len(rows) < batch_size:
+            return
+        last = (rows[-1][3], rows[-1][0])
+
+def chat_markdown(chat, messages):
+    """A chat as Markdown, in the same layout as the single-chat export"""
+    parts = [f"# {chat['title']}\n\n- Model: {chat['model']}\n- Created: {chat['timestamp']}\n"]
+    for message in messages:
+        parts.append(f"### {'User' if message['role'] == 'user' else 'Assistant'}\n{message['content']}\n")
+    return '\n'.join(parts)
+
+def chat_jsonl(chat, messages):
+    """A chat as JSON Lines, one message per line"""
+    header = {'chat_id': chat['id'], 'title': chat['title'], 'chat_model': chat['model'], 'chat_timestamp': chat['timestamp']}
+    return ''.join(json.dumps({**header, **message}, ensure_ascii=False) + '\n' for message in messages)
+
+def export_member_name(chat, extension):
+    slug = re.sub(r'[^A-Za-z0-9]+', '-', unicodedata.normalize('NFKD', chat['title'] or '')
+                  .encode('ascii', 'ignore').decode()).strip('-').lower()[:48]
+    return f"chat-{chat['id']}{'-' + slug if slug else ''}.{extension}"
+
+def export_mtime(chat):
+    try:
+        return datetime.fromisoformat(chat['timestamp']).timestamp()
+    except (TypeError, ValueError):
+        return time.time()
+
+class ArchiveBuffer:
+    """Write-only, unseekable file object whose bytes are drained into the response"""
+
+    def __init__(self):
+        self._chunks = []
+        self._offset = 0
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self._offset += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._offset
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+class ZipStream:
+    """Zip archive written member by member to a stream, without seeking back"""
+
+    def __init__(self):
+        self.buffer = ArchiveBuffer()
+        self.zip = zipfile.ZipFile(self.buffer, 'w')
+
+    def add(self, name, chunks, mtime, compress=True, size=None):
+        """Write one member from an iterable of byte chunks, yielding output as it is produced"""
+        info = zipfile.ZipInfo(name, date_time=time.localtime(mtime)[:6])
+        info.compress_type = zipfile.ZIP_DEFLATED if compress else zipfile.ZIP_STORED
+        with self.zip.open(info, 'w', force_zip64=True) as member:
+            for chunk in chunks:
+                member.write(chunk)
+                data = self.buffer.drain()
+                if data:
+                    yield data
+        yield self.buffer.drain()
+
+    def close(self):
+        self.zip.close()
+        return self.buffer.drain()
+
+class TarStream:
+    """Tar archive (optionally gzipped) written as headers and data blocks, without seeking"""
+
+    def __init__(self, gzip=False):
+        self.offset = 0
+        self.compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if gzip else None
+
+    def _out(self, data):
+        self.offset += len(data)
+        return self.compressor.compress(data) if self.compressor else data
+
+    def add(self, name, chunks, mtime, compress=True, size=None):
+        """Write one member; ``size`` must be given because the header precedes the data"""
+        info = tarfile.TarInfo(name)
+        info.size, info.mtime, info.mode = size, int(mtime), 0o644
+        yield self._out(info.tobuf(format=tarfile.PAX_FORMAT))
+        for chunk in chunks:
+            yield self._out(chunk)
+        yield self._out(b'\0' * (-size % tarfile.BLOCKSIZE))
+
+    def close(self):
+        end = b'\0' * (2 * tarfile.BLOCKSIZE)
+        end += b'\0' * (-(self.offset + len(end)) % tarfile.RECORDSIZE)
+        data = self._out(end)
+        return data + self.compressor.flush() if self.compressor else data
+
+def read_chunks(path):
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(BULK_EXPORT_CHUNK)
+            if not chunk:
+                return
+            yield chunk
+
+def iter_export_pdfs(chats, page_size, workdir):
+    """Yield ``(chat, path)`` in order while rendering up to two PDFs per worker process ahead.
+
+    PDFs already in the single-chat export cache are reused as they are.
+    """
+    pending = deque()
+    executor = None
+    window = 2 * BULK_EXPORT_PROCESSES
+    try:
+        for chat, messages in chats:
+            cached = export_jobs.path(export_jobs.job_id(f"chat:{chat['id']}", messages, {'page_size': page_size}))
+            if os.path.exists(cached):
+                pending.append((chat, cached, None))
+            else:
+                executor = executor or export_process_pool()
+                path = os.path.join(workdir, f"{chat['id']}.pdf")
+                payload = [{'role': m['role'], 'content': m['content']} for m in messages]
+                pending.append((chat, path, executor.submit(render_chat_pdf_file, payload, path, page_size)))
+            while len(pending) >= window:
+                yield _finish_export_pdf(pending.popleft())
+        while pending:
+            yield _finish_export_pdf(pending.popleft())
+    finally:
+        for _, _, future in pending:
+            if future is not None:
+                future.cancel()
+
+def _finish_export_pdf(item):
+    chat, path, future = item
+    if future is not None:
+        metrics.observe('export_render_seconds', 'bulk', future.result())
+    return chat, path, future is not None
+
+def stream_bulk_export(filters):
+    """Generate the bytes of an archive holding one file per matching chat"""
+    gzip = filters['archive'] == 'tar.gz'
+    archive = ZipStream() if filters['archive'] == 'zip' else TarStream(gzip=gzip)
+    chats = iter_export_chats(filters)
+    count = 0
+    started = time.monotonic()
+
+    if filters['format'] == 'pdf':
+        with tempfile.TemporaryDirectory(prefix='guria-bulk-') as workdir:
+            for chat, path, temporary in iter_export_pdfs(chats, filters['page_size'], workdir):
+                yield from archive.add(export_member_name(chat, 'pdf'), read_chunks(path), export_mtime(chat),
+                                       compress=False, size=os.path.getsize(path))
+                if temporary:
+                    os.remove(path)
+                count += 1
+    else:
+        render = chat_markdown if filters['format'] == 'md' else chat_jsonl
+        for chat, messages in chats:
+            data = render(chat, messages).encode('utf-8')
+            yield from archive.add(export_member_name(chat, filters['format']), [data], export_mtime(chat),
+                                   size=len(data))
+            count += 1
+    yield archive.close()
+    logger.info(f"Bulk export streamed {count} chats as {filters['format']}/{filters['archive']} "
+                f"in {time.monotonic() - started:.2f}s")
+
+@app.route('/export', methods=['GET', 'POST'])
+def bulk_export():
+    """Stream an archive of many chats, one Markdown, JSONL or PDF file per chat.
+
+    Filters (query string or JSON body): ``ids``, ``from``/``to`` dates and
+    ``model``; output: ``format`` (md, jsonl, pdf) and ``archive`` (zip, tar,
+    tar.gz). The archive is produced while it is downloaded.
+    """
+    try:
+        data = request.get_json(silent=True) if request.method == 'POST' else request.args.to_dict()
+        filters = bulk_export_filters(data)
+        filename = f"chats-{datetime.now().strftime('%Y%m%d-%H%M%S')}.{filters['archive']}"
+        return Response(stream_bulk_export(filters), mimetype=BULK_EXPORT_ARCHIVES[filters['archive']],
+                        headers={'Content-Disposition': f'attachment; filename="{filename}"',
+                                 'X-Accel-Buffering': 'no'})
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        logger.error(f"Error starting bulk export: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+IMPORT_BATCH_MESSAGES = int(os.getenv('GURIA_IMPORT_BATCH_MESSAGES', '20000'))  # Messages per import transaction
+IMPORT_ROLES = ('user', 'assistant', 'system')
+_import_lock = threading.Lock()
+
+class ImportInProgress(Exception):
+    """Raised when an import is started while another one is still running"""
+
+def chat_content_hash(messages):
+    """Identity of a conversation for deduplication: the role and text of every turn, in order"""
+    digest = hashlib.sha256()
+    for message in messages:
+        digest.update(message['role'].encode())
+        digest.update(b'\0')
+        digest.update(message['content'].encode())
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+def import_timestamp(value, default):
+    try:
+        return datetime.fromisoformat(str(value)).isoformat() if value else default
+    except ValueError:
+        return default
+
+def parse_import_chat(record):
+    """Normalize one imported chat, ``{"title", "model", "timestamp", "messages": [...]}``; None if unusable"""
+    if not isinstance(record, dict) or not isinstance(record.get('messages'), list):
+        return None
+    now = datetime.now().isoformat()
+    timestamp = import_timestamp(record.get('timestamp'), None)
+    messages = []
+    for message in record['messages']:
+        if (not isinstance(message, dict) or message.get('role') not in IMPORT_ROLES
+                or not isinstance(message.get('content'), str)):
+            return None
+        messages.append({
+            'role': message['role'],
+            'content': message['content'],
+            'model': message.get('model'),
+            'prompt_tokens': message.get('prompt_tokens'),
+            'completion_tokens': message.get('completion_tokens'),
+            'duration_ms': message.get('duration_ms'),
+            'created_at': import_timestamp(message.get('created_at') or message.get('timestamp'), timestamp or now),
+        })
+    if not messages:
+        return None
+    timestamp = timestamp or messages[0]['created_at']
+    return {
+        'title': str(record.get('title') or next((m['content'] for m in messages if m['role'] == 'user'),
+                                                 messages[0]['content'])),
+        'model': str(record.get('model') or next((m['model'] for m in messages if m['model']), None) or 'unknown'),
+        'timestamp': timestamp,
+        'updated_at': max(timestamp, messages[-1]['created_at']),
+        'messages': messages,
+        'hash': chat_content_hash(messages),
+    }
+
+def iter_jsonl_chats(stream, stats):
+    """Yield raw chat records from JSON Lines.
+
+    A line is either a whole chat (an object with ``messages``) or one message
+    as written by ``/export?format=jsonl``; consecutive message lines sharing a
+    ``chat_id`` are joined into one chat.
+    """
+    group, group_id = None, None
+    for line in stream:
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError:
+            stats['invalid'] += 1
+            continue
+        if isinstance(record, dict) and 'messages' in record:
+            if group:
+                yield group
+                group, group_id = None, None
+            yield record
+            continue
+        if not isinstance(record, dict) or 'chat_id' not in record:
+            stats['invalid'] += 1
+            continue
+        if group is None or record['chat_id'] != group_id:
+            if group:
+                yield group
+            group_id = record['chat_id']
+            group = {'title': record.get('title'), 'model': record.get('chat_model'),
+                     'timestamp': record.get('chat_timestamp'), 'messages': []}
+        group['messages'].append(record)
+    if group:
+        yield group
+
+class RawReader(io.RawIOBase):
+    """Expose a plain ``read()`` stream, such as gunicorn's request body, as raw I/O for io.BufferedReader"""
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self.fileobj.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+def iter_import_records(fileobj, stats):
+    """Yield raw chat records from JSONL, optionally gzipped, or from a zip/tar/tar.gz of JSONL files"""
+    stream = fileobj if hasattr(fileobj, 'peek') else io.BufferedReader(RawReader(fileobj))
+    head = stream.peek(512)[:512]
+    if head.startswith(b'PK\x03\x04'):
+        if not stream.seekable():
+            spooled = tempfile.TemporaryFile()
+            shutil.copyfileobj(stream, spooled, BULK_EXPORT_CHUNK)
+            spooled.seek(0)
+            stream = spooled
+        with zipfile.ZipFile(stream) as archive:
+            for info in archive.infolist():
+                if info.filename.endswith('.jsonl'):
+                    with archive.open(info) as member:
+                        yield from iter_jsonl_chats(member, stats)
+        return
+    if head.startswith(b'\x1f\x8b'):
+        stream = gzip.GzipFile(fileobj=stream)
+        head = stream.peek(512)[:512]
+    if head[257:262] == b'ustar':
+        with tarfile.open(fileobj=stream, mode='r|') as archive:
+            for member in archive:
+                if member.isfile() and member.name.endswith('.jsonl'):
+                    yield from iter_jsonl_chats(archive.extractfile(member), stats)
+        return
+    yield from iter_jsonl_chats(stream, stats)
+
+def backfill_chat_hashes(conn):
+    """Hash stored chats that have none yet (never hashed, or appended to since), in one ordered scan"""
+    conn.execute('BEGIN IMMEDIATE')
+    rows = conn.execute(
+        '''SELECT chat_id, role, content FROM messages
+           WHERE chat_id IN (SELECT id FROM chats WHERE id NOT IN (SELECT chat_id FROM chat_hashes))
+           ORDER BY chat_id, seq''')
+    hashes, chat_id, messages = [], None, []
+    for row in rows:
+        if row[0] != chat_id:
+            if messages:
+                hashes.append((chat_content_hash(messages), chat_id))
+            chat_id, messages = row[0], []
+        messages.append({'role': row[1], 'content': row[2]})
+    if messages:
+        hashes.append((chat_content_hash(messages), chat_id))
+    conn.executemany('INSERT OR IGNORE INTO chat_hashes (content_hash, chat_id) VALUES (?, ?)', hashes)
+    conn.commit()
+    return len(hashes)
+
+@contextmanager
+def deferred_chat_maintenance(conn):
+    """Suspend per-row index upkeep during a bulk load and catch up once at the end.
+
+    FTS indexing and the sidebar change feed are always deferred: new messages are
+    indexed in one statement afterwards and clients are told to reload, unless
+    nothing was committed. Messages that existed before the load stay indexed
+    row by row, so chats edited or deleted meanwhile keep the index consistent.
+    The timestamp index is only dropped when loading into an empty database, where
+    building it once is cheaper than maintaining it row by row; the unique
+    (chat_id, seq) index always stays, as chats can still be written meanwhile.
+    """
+    conn.execute('BEGIN IMMEDIATE')
+    start_id = conn.execute('SELECT COALESCE(MAX(id), 0) FROM messages').fetchone()[0]
+    drop_indexes = start_id == 0
+    conn.execute('DROP TRIGGER IF EXISTS chats_log_insert')
+    if SEARCH_AVAILABLE:
+        for statement in deferred_search_triggers(start_id):
+            conn.execute(statement)
+    if drop_indexes:
+        conn.execute('DROP INDEX IF EXISTS idx_chats_timestamp')
+    conn.commit()
+    try:
+        yield
+    finally:
+        # One write transaction, so no concurrent message is indexed twice or missed
+        started = time.monotonic()
+        if conn.in_transaction:
+            conn.rollback()
+        conn.execute('BEGIN IMMEDIATE')
+        if drop_indexes:
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_chats_timestamp ON chats (timestamp)')
+        # Rows committed meanwhile, by the import or by chats running alongside it, missed the triggers
+        committed = conn.execute('SELECT COALESCE(MAX(id), 0) FROM messages').fetchone()[0] > start_id
+        if committed and SEARCH_AVAILABLE:
+            conn.execute('INSERT INTO messages_fts (rowid, content) SELECT id, content FROM messages WHERE id > ?',
+                         (start_id,))
+        if SEARCH_AVAILABLE:
+            for name in SEARCH_TRIGGERS:
+                conn.execute(f'DROP TRIGGER IF EXISTS {name}')
+        schema = CHANGE_FEED_SCHEMA + (SEARCH_INDEX_SCHEMA if SEARCH_AVAILABLE else '')
+        for statement in re.findall(r'CREATE TRIGGER.*?END;', schema, re.DOTALL):
+            conn.execute(statement)
+        if committed:
+            conn.execute("INSERT INTO chat_changes (chat_id, op) VALUES (NULL, 'clear')")
+        conn.commit()
+        logger.info(f"Rebuilt indexes after import in {time.monotonic() - started:.2f}s")
+
+SEARCH_TRIGGERS = ('messages_fts_insert', 'messages_fts_delete', 'messages_fts_update')
+
+def deferred_search_triggers(start_id):
+    """Statements swapping the FTS triggers for ones that leave messages newer than ``start_id`` alone.
+
+    Those messages are indexed in bulk once the load ends, so they must not be
+    indexed, or removed from the index, one by one before that.
+    """
+    statements = [f'DROP TRIGGER IF EXISTS {name}' for name in SEARCH_TRIGGERS]
+    for statement in re.findall(r'CREATE TRIGGER.*?END;', SEARCH_INDEX_SCHEMA, re.DOTALL):
+        if 'messages_fts_insert' not in statement:
+            statements.append(statement.replace(' BEGIN', f' WHEN OLD.id <= {int(start_id)} BEGIN', 1))
+    return statements
+
+def insert_chat_batch(conn, chats, stats):
+    """Insert parsed chats not already stored, with one executemany per table, in one transaction"""
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        known = set()
+        hashes = list({chat['hash'] for chat in chats})
+        for start in range(0, len(hashes), 500):
+            chunk = hashes[start:start + 500]
+            known.update(row[0] for row in conn.execute(
+                f"SELECT content_hash FROM chat_hashes WHERE content_hash IN ({','.join('?' * len(chunk))})", chunk))
+
+        # AUTOINCREMENT never reuses ids, so start past both the sequence and the current maximum
+        next_id = conn.execute(
+            "SELECT MAX(COALESCE((SELECT seq FROM sqlite_sequence WHERE name = 'chats'), 0), "
+            "COALESCE((SELECT MAX(id) FROM chats), 0)) + 1").fetchone()[0]
+        new_chats = []
+        for chat in chats:
+            if chat['hash'] in known:
+                stats['duplicates'] += 1
+                continue
+            known.add(chat['hash'])
+            chat['id'] = next_id
+            next_id += 1
+            new_chats.append(chat)
+
+        conn.executemany(
+            'INSERT INTO chats (id, model, title, timestamp, updated_at, message_count) VALUES (?, ?, ?, ?, ?, ?)',
+            [(c['id'], c['model'], c['title'], c['timestamp'], c['updated_at'], len(c['messages'])) for c in new_chats])
+        conn.executemany(
+            '''INSERT INTO messages (chat_id, seq, role, content, model, prompt_tokens, completion_tokens, duration_ms, created_at)
+               VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+            ((c['id'], seq, m['role'], m['content'], m['model'], m['prompt_tokens'], m['completion_tokens'],
+              m['duration_ms'], m['created_at'])
+             for c in new_chats for seq, m in enumerate(c['messages'], 1)))
+        conn.executemany('INSERT INTO chat_hashes (content_hash, chat_id) VALUES (?, ?)',
+                         [(c['hash'], c['id']) for c in new_chats])
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    stats['chats'] += len(new_chats)
+    stats['messages'] += sum(len(c['messages']) for c in new_chats)
+
+def import_chats(fileobj, batch_messages=IMPORT_BATCH_MESSAGES):
+    """Stream chats from JSONL or an export archive into the database.
+
+    Rows are inserted in transactions of about ``batch_messages`` messages, chats
+    whose content is already stored are skipped, and index maintenance is deferred
+    to the end. Returns counts and the throughput in rows per second.
+    """
+    if not _import_lock.acquire(blocking=False):
+        raise ImportInProgress('Another import is already running')
+    stats = {'chats': 0, 'messages': 0, 'duplicates': 0, 'invalid': 0}
+    started = time.monotonic()
+    try:
+        with db_connection() as conn:
+            backfill_chat_hashes(conn)
+            with deferred_chat_maintenance(conn):
+                batch, batch_size = [], 0
+                for record in iter_import_records(fileobj, stats):
+                    chat = parse_import_chat(record)
+                    if chat is None:
+                        stats['invalid'] += 1
+                        continue
+                    batch.append(chat)
+                    batch_size += len(chat['messages'])
+                    if batch_size >= batch_messages:
+                        insert_chat_batch(conn, batch, stats)
+                        logger.info(f"Imported {stats['chats']} chats ({stats['messages']} messages) so far")
+                        batch, batch_size = [], 0
+                if batch:
+                    insert_chat_batch(conn, batch, stats)
+    finally:
+        _import_lock.release()
+
+    elapsed = time.monotonic() - started
+    stats['seconds'] = round(elapsed, 3)
+    stats['rows_per_second'] = round((stats['chats'] + stats['messages']) / elapsed, 1) if elapsed else None
+    logger.info(f"Imported {stats['chats']} chats and {stats['messages']} messages in {elapsed:.2f}s "
+                f"({stats['rows_per_second']} rows/s); skipped {stats['duplicates']} duplicates, {stats['invalid']} invalid")
+    return stats
+
+@app.route('/import', methods=['POST'])
+def import_chats_route():
+    """Import chats from JSONL or an export archive (zip, tar, tar.gz), sent as the body or a ``file`` upload"""
+    try:
+        upload = request.files.get('file')
+        stats = import_chats(upload.stream if upload else request.stream)
+        return jsonify(stats)
+    except ImportInProgress as e:
+        return jsonify({'error': str(e)}), 409
+    except (ValueError, zipfile.BadZipFile, tarfile.TarError, OSError) as e:
+        return jsonify({'error': f"Unreadable import file: {str(e)}"}), 400
+    except Exception as e:
+        logger.error(f"Error importing chats: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+def load_flask_session(cookie_header):
+    """Decode the signed Flask session cookie outside of a Flask request"""
+    from http.cookies import SimpleCookie
+    
+    cookies = SimpleCookie()
+    try:
+        cookies.load(cookie_header or '')
+    except Exception:
+        return {}
+    morsel = cookies.get(app.config.get('SESSION_COOKIE_NAME', 'session'))
+    serializer = app.session_interface.get_signing_serializer(app)
+    if morsel is None or serializer is None:
+        return {}
+    try:
+        return serializer.loads(morsel.value, max_age=int(app.permanent_session_lifetime.total_seconds()))
+    except Exception:
+        return {}
+
+ASGI_WSGI_THREADS = int(os.getenv('GURIA_ASGI_WSGI_THREADS', '16'))  # Threads serving Flask routes under --async-streaming
+
+def create_asgi_app():
+    """Build an ASGI app that streams generations on the event loop and hands every other route to Flask.
+
+    /chat and /query start generation sessions as tasks on the loop, and they and
+    /generations/<id>/events are watched from it; the rest of /generations is Flask's.
+    """
+    import asyncio
+    import httpx
+    from urllib.parse import parse_qs
+    from a2wsgi import WSGIMiddleware
+    
+    # Flask routes run on their own thread pool, so a slow one (a PDF render, an
+    # import) blocks only its thread instead of every other non-stream request
+    wsgi_app = WSGIMiddleware(app, workers=ASGI_WSGI_THREADS)
+    state = {'client': None, 'tasks': set()}
+    connect_timeout, read_timeout = OLLAMA_TIMEOUTS['generate']
+    
+    def get_client():
+        # Created lazily so the client binds to the worker's running event loop
+        if state['client'] is None:
+            state['client'] = httpx.AsyncClient(
+                base_url=OLLAMA_BASE_URL,
+                timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+                limits=httpx.Limits(max_connections=None, max_keepalive_connections=OLLAMA_POOL_SIZE)
+            )
+        return state['client']
+    
+    async def read_body(receive):
+        body = b''
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return None
+            body += message.get('body', b'')
+            if not message.get('more_body', False):
+                return body
+    
+    async def send_json(send, status, payload, headers=()):
+        body = json.dumps(payload).encode()
+        await send({
+            'type': 'http.response.start',
+            'status': status,
+            'headers': [(b'content-type', b'application/json'), (b'content-length', str(len(body)).encode())] + list(headers)
+        })
+        await send({'type': 'http.response.body', 'body': body})
+    
+    async def wait_for_ticket(ticket, emit):
+        """Async counterpart of wait_for_slot: emit queue positions until the ticket is granted"""
+        loop = asyncio.get_running_loop()
+        granted = loop.create_future()
+        generation_scheduler.on_grant(ticket, lambda: loop.call_soon_threadsafe(
+            lambda: granted.done() or granted.set_result(True)))
+        deadline = loop.time() + QUEUE_TIMEOUT
+        last_position = None
+        while not granted.done():
+            if loop.time() >= deadline:
+                raise TimeoutError(f"Timed out after {QUEUE_TIMEOUT:.0f}s waiting for {ticket.model}")
+            position = generation_scheduler.position(ticket)
+            if position and position != last_position:
+                last_position = position
+                await emit({'queue': {'position': position}})
+            await asyncio.wait({granted}, timeout=QUEUE_POSITION_INTERVAL)
+    
+    async def aiter_with_deadline(items, deadline):
+        """Async counterpart of iter_with_deadline; the pending read is kept, not cancelled, when the deadline passes"""
+        items = items.__aiter__()
+        pending = None
+        try:
+            while True:
+                due = deadline()
+                if pending is None and due is None:
+                    try:
+                        item = await items.__anext__()
+                    except StopAsyncIteration:
+                        return
+                    yield item
+                    continue
+                if pending is None:
+                    pending = asyncio.ensure_future(items.__anext__())
+                done, _ = await asyncio.wait({pending}, timeout=None if due is None else max(due - time.monotonic(), 0))
+                if not done:
+                    yield None
+                    continue
+                task, pending = pending, None
+                try:
+                    item = task.result()
+                except StopAsyncIteration:
+                    return
+                yield item
+        finally:
+            if pending is not None:
+                pending.cancel()
+    
+    async def run_generation(session):
+        """Async counterpart of GenerationSessions._run: stream the answer from Ollama into the session"""
+        async def emit(payload):
+            session.emit(sse_event(payload))
+        
+        turn = session.turn
+        error = None
+        try:
+            if session.cached:
+                session.begin()
+                for chunk_data in response_cache.replay(*session.cached, delay=0):
+                    session.feed(chunk_data)
+                    if RESPONSE_CACHE_REPLAY_DELAY:
+                        await asyncio.sleep(RESPONSE_CACHE_REPLAY_DELAY)
+                        session.emit(turn.flush_due())
+                return
+            
+            await wait_for_ticket(session.ticket, emit)
+            turn.timer.start()
+            async with get_client().stream('POST', '/api/chat', json=dict(turn.payload, stream=True)) as response:
+                metrics.observe('ollama_request_seconds', 'generate', time.monotonic() - turn.timer.started)
+                if response.status_code != 200:
+                    raise RuntimeError(ollama_error(response.status_code, await response.aread()))
+                session.begin()
+                async for line in aiter_with_deadline(response.aiter_lines(), turn.formatter.deadline):
+                    if line is None:
+                        session.emit(turn.flush_due())
+                        continue
+                    if not line:
+                        continue
+                    try:
+                        chunk_data = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    if session.feed(chunk_data):
+                        await asyncio.to_thread(turn.checkpoint)
+                    if turn.done is not None:
+                        break
+        except asyncio.CancelledError:
+            pass  # Cancelled through /generations/<id>/cancel
+        except Exception as e:
+            logger.error(f"Error generating response: {str(e)}")
+            error = str(e)
+        finally:
+            if session.ticket is not None:
+                generation_scheduler.release(session.ticket)
+            await asyncio.to_thread(session.finish, error)
+    
+    def start_generation(turn, cached, ticket):
+        """Register a session and run it as a task that outlives the request that started it"""
+        loop = asyncio.get_running_loop()
+        session = generation_sessions.add(GenerationSession(turn, cached, ticket))
+        task = loop.create_task(run_generation(session))
+        # The loop only keeps weak references to tasks
+        state['tasks'].add(task)
+        task.add_done_callback(state['tasks'].discard)
+        session.stop = lambda: loop.call_soon_threadsafe(task.cancel)
+        return session
+    
+    async def stream_endpoint(scope, receive, send, legacy):
+        body = await read_body(receive)
+        if body is None:
+            return
+        try:
+            data = json.loads(body or b'{}')
+        except json.JSONDecodeError:
+            return await send_json(send, 400, {'error': 'Invalid JSON body'})
+        
+        headers = dict(scope.get('headers', []))
+        session_data = load_flask_session(headers.get(b'cookie', b'').decode('latin-1'))
+        model = data.get('model', session_data.get('model', 'llama2'))
+        
+        if not data.get('prompt'):
+            return await send_json(send, 400, {'error': 'No prompt provided'})
+        
+        logger.info(f"Received chat request with model: {model}")
+        
+        ollama_status, error = await asyncio.to_thread(check_ollama_status)
+        if not ollama_status:
+            return await send_json(send, 503, {'error': f'Ollama service not available: {error}'})
+        
+        turn = await asyncio.to_thread(GenerationTurn, data, model, legacy)
+        cached = await asyncio.to_thread(response_cache.get, turn.cache_key) if turn.cache_key else None
+        ticket = None
+        if not cached:
+            client = session_data.get('client_id') or (scope.get('client') or ('unknown',))[0]
+            try:
+                ticket = generation_scheduler.admit(model, client)
+            except QueueFull as e:
+                return await send_json(send, 429, {'error': str(e), 'retry_after': e.retry_after},
+                                       headers=[(b'retry-after', str(e.retry_after).encode())])
+        session = start_generation(turn, cached, ticket)
+        await watch_generation(receive, send, session, 0, headers=[(b'x-generation-id', session.id.encode())])
+    
+    async def watch_generation(receive, send, session, after, headers=()):
+        """Async counterpart of GenerationSessions.follow: send a session's frames until it finishes or the client leaves"""
+        await send({
+            'type': 'http.response.start',
+            'status': 200,
+            'headers': [(b'content-type', b'text/event-stream; charset=utf-8'), (b'cache-control', b'no-cache'),
+                        (b'x-accel-buffering', b'no')] + list(headers)
+        })
+        
+        loop = asyncio.get_running_loop()
+        woken = asyncio.Event()
+        def listener():
+            loop.call_soon_threadsafe(woken.set)
+        with session.changed:
+            session.listeners.add(listener)
+        
+        async def wait_for_disconnect():
+            while True:
+                message = await receive()
+                if message['type'] == 'http.disconnect':
+                    return
+        
+        disconnect = asyncio.ensure_future(wait_for_disconnect())
+        writing = 0.0
+        try:
+            while True:
+                with session.changed:
+                    frames = session.frames_after(after)
+                    after = session.seq
+                    finished = session.finished
+                    woken.clear()
+                if not frames and finished:
+                    break
+                if not frames:
+                    waiter = asyncio.ensure_future(woken.wait())
+                    await asyncio.wait({waiter, disconnect}, timeout=GENERATION_HEARTBEAT,
+                                       return_when=asyncio.FIRST_COMPLETED)
+                    waiter.cancel()
+                    if disconnect.done():
+                        # The generation carries on; the client can come back with Last-Event-ID
+                        return
+                    if woken.is_set():
+                        continue
+                    frames = ': keep-alive\n\n'
+                started = time.monotonic()
+                await send({'type': 'http.response.body', 'body': frames.encode(), 'more_body': True})
+                writing += time.monotonic() - started
+            await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+        except OSError:
+            pass  # The client went away mid-write
+        finally:
+            with session.changed:
+                session.listeners.discard(listener)
+            disconnect.cancel()
+            metrics.observe('sse_write_seconds', session.turn.model, writing)
+    
+    async def generation_events(scope, receive, send, session_id):
+        session = generation_sessions.get(session_id)
+        if session is None:
+            return await send_json(send, 404, {'error': 'No such generation'})
+        headers = dict(scope.get('headers', []))
+        args = {key: values[0] for key, values in parse_qs(scope.get('query_string', b'').decode('latin-1')).items()}
+        after = last_event_id({'Last-Event-ID': headers.get(b'last-event-id', b'').decode('latin-1')}, args)
+        await watch_generation(receive, send, session, after)
+    
+    async def asgi_app(scope, receive, send):
+        if scope['type'] == 'lifespan':
+            while True:
+                message = await receive()
+                if message['type'] == 'lifespan.startup':
+                    ollama_health.start()
+                    await send({'type': 'lifespan.startup.complete'})
+                elif message['type'] == 'lifespan.shutdown':
+                    if state['client'] is not None:
+                        await state['client'].aclose()
+                    await send({'type': 'lifespan.shutdown.complete'})
+                    return
+        
+        if scope['type'] == 'http' and scope['method'] == 'POST' and scope['path'] in ('/chat', '/query'):
+            return await stream_endpoint(scope, receive, send, legacy=scope['path'] == '/query')
+        
+        parts = scope['path'].split('/') if scope['type'] == 'http' and scope['method'] == 'GET' else []
+        if len(parts) == 4 and parts[1] == 'generations' and parts[3] == 'events':
+            return await generation_events(scope, receive, send, parts[2])
+        
+        return await wsgi_app(scope, receive, send)
+    
+    return asgi_app
+
+class ProcessLock:
+    """Exclusive lock on a file, taken without waiting and held until the process exits.
+
+    Elects one prefork worker for jobs that must not run in every worker. POSIX
+    record locks are not inherited across fork and are dropped when the holder
+    dies, so when the elected worker is recycled another one takes over.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+
+    def acquire(self):
+        """Whether this process holds the lock, taking it if it is free"""
+        import fcntl
+        
+        if self._file is not None:
+            return True
+        lock_file = open(self.path, 'a')
+        try:
+            fcntl.lockf(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+        self._file = lock_file
+        logger.info(f"Process {os.getpid()} took {self.path}")
+        return True
+
+def run_prefork_server(args, ssl_context):
+    """Serve the app from a gunicorn pre-fork master with several worker processes"""
+    from gunicorn.app.base import BaseApplication
+    
+    class GuriaServer(BaseApplication):
+        def __init__(self, application, options):
+            self.application = application
+            self.options = options
+            super().__init__()
+        
+        def load_config(self):
+            for key, value in self.options.items():
+                self.cfg.set(key, value)
+        
+        def load(self):
+            return self.application
+    
+    # The master only forks workers; residency (preloading, evictions) runs in one elected worker
+    residency_lock = ProcessLock(f"{os.path.abspath(DB_PATH)}.residency.lock")
+    
+    def post_fork(server, worker):
+        # Background threads start here rather than in the master, so no worker inherits their locks
+        ollama_client.reset()
+        db_pool.reset()
+        ollama_health.start()
+        model_residency.start(leader=residency_lock.acquire)
+    
+    options = {
+        'bind': f"0.0.0.0:{args.port}",
+        'workers': args.workers,
+        'threads': args.threads,
+        'worker_class': 'uvicorn.workers.UvicornWorker' if args.async_streaming else 'gthread',
+        # init_db already ran in this process; workers fork from it and start their threads in post_fork
+        'preload_app': True,
+        'post_fork': post_fork,
+        'max_requests': args.max_requests,
+        'max_requests_jitter': args.max_requests_jitter,
+        'graceful_timeout': args.graceful_timeout,
+        # Streams can legitimately stay silent until Ollama produces the first token
+        'timeout': int(OLLAMA_TIMEOUTS['generate'][1]) + 30,
+        'backlog': args.backlog,
+        'keepalive': args.keep_alive,
+        'loglevel': 'debug' if args.debug else 'info'
+    }
+    if ssl_context:
+        options['certfile'], options['keyfile'] = ssl_context
+    
+    application = create_asgi_app() if args.async_streaming else app
+    db_pool.close_all()
+    logger.info(f"Starting pre-fork server with {args.workers} workers x {args.threads} threads")
+    GuriaServer(application, options).run()
+
 def is_port_in_use(port):
     """Check if a port is in use"""
     with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
@@ -688,82 +4211,278 @@ def get_local_ip():
     except:
         return "localhost"
 
+DB_PATH = os.getenv('GURIA_DB_PATH', 'chats.db')
+DB_POOL_SIZE = int(os.getenv('GURIA_DB_POOL_SIZE', '16'))  # Max connections open at once across requests and streams
+DB_BUSY_TIMEOUT_MS = int(os.getenv('GURIA_DB_BUSY_TIMEOUT_MS', '5000'))
+DB_CACHE_KB = int(os.getenv('GURIA_DB_CACHE_KB', '16384'))  # Page cache per connection
+DB_MMAP_BYTES = int(os.getenv('GURIA_DB_MMAP_BYTES', str(256 * 1024 * 1024)))
+
+class SQLitePool:
+    """Bounded pool of tuned SQLite connections shared by request handlers and streaming threads"""
+
+    def __init__(self, path=DB_PATH, size=DB_POOL_SIZE):
+        self.path = path
+        self.size = size
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+        self._wal_checked = False
+
+    def _connect(self):
+        # Connections are handed from thread to thread, but only ever used by one at a time
+        conn = sqlite3.connect(self.path, timeout=DB_BUSY_TIMEOUT_MS / 1000, check_same_thread=False)
+        if not self._wal_checked:
+            mode = conn.execute('PRAGMA journal_mode=WAL').fetchone()[0]
+            if mode.lower() != 'wal':
+                logger.warning(f"SQLite journal mode is {mode}, WAL could not be enabled")
+            self._wal_checked = True
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute(f'PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS}')
+        conn.execute(f'PRAGMA cache_size=-{DB_CACHE_KB}')
+        conn.execute(f'PRAGMA mmap_size={DB_MMAP_BYTES}')
+        conn.execute('PRAGMA temp_store=MEMORY')
+        conn.execute('PRAGMA foreign_keys=ON')
+        return conn
+
+    def acquire(self):
+        """Borrow a connection, waiting at most the busy timeout for a free slot"""
+        if not self._slots.acquire(timeout=DB_BUSY_TIMEOUT_MS / 1000):
+            raise sqlite3.OperationalError(f"All {self.size} database connections are in use")
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        try:
+            return self._connect()
+        except Exception:
+            self._slots.release()
+            raise
+
+    def release(self, conn):
+        """Return a borrowed connection, discarding any transaction left open"""
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+            self._idle.put(conn)
+        except sqlite3.Error:
+            conn.close()
+        finally:
+            self._slots.release()
+
+    def close_all(self):
+        """Close every idle connection"""
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+    def reset(self):
+        """Forget connections opened before a fork; SQLite handles must not cross process boundaries"""
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(self.size)
+
+db_pool = SQLitePool()
+
 def get_db():
-    return sqlite3.connect('chats.db')
+    """Return the connection bound to the current app context, borrowing one from the pool on first use"""
+    if 'db' not in g:
+        g.db = db_pool.acquire()
+    return g.db
+
+@app.teardown_appcontext
+def close_db(exception=None):
+    """Return the app context's connection to the pool"""
+    conn = g.pop('db', None)
+    if conn is not None:
+        db_pool.release(conn)
+
+@contextmanager
+def db_connection():
+    """Borrow a connection that also works outside an app context, e.g. inside a streaming generator"""
+    if has_app_context():
+        yield get_db()
+        return
+    conn = db_pool.acquire()
+    try:
+        yield conn
+    finally:
+        db_pool.release(conn)
+
+# chats holds one row per conversation; its turns live in append-only messages
+CHAT_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS chats (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    model TEXT NOT NULL,
+    title TEXT NOT NULL,
+    timestamp TEXT NOT NULL,
+    updated_at TEXT NOT NULL,
+    message_count INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS idx_chats_timestamp ON chats (timestamp);
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    chat_id INTEGER NOT NULL REFERENCES chats (id) ON DELETE CASCADE,
+    seq INTEGER NOT NULL,
+    role TEXT NOT NULL,
+    content TEXT NOT NULL,
+    model TEXT,
+    prompt_tokens INTEGER,
+    completion_tokens INTEGER,
+    duration_ms REAL,
+    created_at TEXT NOT NULL
+);
+CREATE UNIQUE INDEX IF NOT EXISTS idx_messages_chat_seq ON messages (chat_id, seq);
+CREATE TABLE IF NOT EXISTS chat_hashes (
+    content_hash TEXT PRIMARY KEY,
+    chat_id INTEGER NOT NULL REFERENCES chats (id) ON DELETE CASCADE
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS idx_chat_hashes_chat ON chat_hashes (chat_id);
+CREATE TRIGGER IF NOT EXISTS messages_hash_invalidate AFTER INSERT ON messages BEGIN
+    DELETE FROM chat_hashes WHERE chat_id = NEW.chat_id;
+END;
+CREATE TRIGGER IF NOT EXISTS messages_hash_invalidate_update AFTER UPDATE OF content ON messages BEGIN
+    DELETE FROM chat_hashes WHERE chat_id = NEW.chat_id;
+END;
+'''
+
+# Change feed for incremental sidebar updates; every write to chats bumps the history version
+CHANGE_FEED_SCHEMA = f'''
+CREATE TABLE IF NOT EXISTS chat_changes (
+    version INTEGER PRIMARY KEY AUTOINCREMENT,
+    chat_id INTEGER,
+    op TEXT NOT NULL
+);
+CREATE TRIGGER IF NOT EXISTS chats_log_insert AFTER INSERT ON chats BEGIN
+    INSERT INTO chat_changes (chat_id, op) VALUES (NEW.id, 'insert');
+END;
+CREATE TRIGGER IF NOT EXISTS chats_log_update AFTER UPDATE ON chats BEGIN
+    INSERT INTO chat_changes (chat_id, op) VALUES (NEW.id, 'update');
+END;
+CREATE TRIGGER IF NOT EXISTS chats_log_delete AFTER DELETE ON chats BEGIN
+    INSERT INTO chat_changes (chat_id, op) VALUES (OLD.id, 'delete');
+END;
+CREATE TRIGGER IF NOT EXISTS chat_changes_prune AFTER INSERT ON chat_changes BEGIN
+    DELETE FROM chat_changes WHERE version <= NEW.version - {HISTORY_CHANGE_LOG_SIZE};
+END;
+'''
+
+SEARCH_INDEX_SCHEMA = '''
+CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+    content, content='messages', content_rowid='id', tokenize='porter unicode61'
+);
+CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN
+    INSERT INTO messages_fts (rowid, content) VALUES (NEW.id, NEW.content);
+END;
+CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages BEGIN
+    INSERT INTO messages_fts (messages_fts, rowid, content) VALUES ('delete', OLD.id, OLD.content);
+END;
+CREATE TRIGGER IF NOT EXISTS messages_fts_update AFTER UPDATE OF content ON messages BEGIN
+    INSERT INTO messages_fts (messages_fts, rowid, content) VALUES ('delete', OLD.id, OLD.content);
+    INSERT INTO messages_fts (rowid, content) VALUES (NEW.id, NEW.content);
+END;
+'''
 
 def init_db():
-    """Initialize the database."""
+    """Initialize the database, migrating older layouts in place."""
     try:
-        # First, try to drop the existing table
-        conn = get_db()
-        cur = conn.cursor()
-        cur.execute('DROP TABLE IF EXISTS chats')
-        conn.commit()
+        with db_connection() as conn:
+            cur = conn.cursor()
+            columns = [row[1] for row in cur.execute('PRAGMA table_info(chats)')]
+            if 'response' in columns:
+                migrate_single_turn_chats(conn)
 
-        # Create the table with the new schema
-        cur.execute('''
-        CREATE TABLE IF NOT EXISTS chats (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            model TEXT NOT NULL,
-            prompt TEXT NOT NULL,
-            response TEXT NOT NULL,
-            timestamp TEXT NOT NULL
-        )
-        ''')
-        conn.commit()
+            cur.executescript(CHAT_SCHEMA)
+            cur.executescript(RESPONSE_CACHE_SCHEMA)
+            cur.executescript(MODEL_PULL_SCHEMA)
+            # Contexts returned by /api/generate; /api/chat is sent the history as messages instead
+            cur.execute('DROP TABLE IF EXISTS chat_contexts')
+
+            cur.executescript(CHANGE_FEED_SCHEMA)
+            conn.commit()
+
+            init_search_index(conn)
         logger.info("Database initialized successfully")
     except Exception as e:
         logger.error(f"Error initializing database: {str(e)}")
 
+def migrate_single_turn_chats(conn):
+    """Split the old one-row-per-chat layout (prompt, response columns) into chats plus messages"""
+    started = time.monotonic()
+    logger.info("Migrating chats to the conversation/messages schema...")
+    # Triggers and the FTS index are tied to the old table; init_db recreates them afterwards
+    conn.executescript(f'''
+    BEGIN;
+    DROP TRIGGER IF EXISTS chats_log_insert;
+    DROP TRIGGER IF EXISTS chats_log_update;
+    DROP TRIGGER IF EXISTS chats_log_delete;
+    DROP TRIGGER IF EXISTS chats_fts_insert;
+    DROP TRIGGER IF EXISTS chats_fts_delete;
+    DROP TRIGGER IF EXISTS chats_fts_update;
+    DROP TABLE IF EXISTS chats_fts;
+    DROP INDEX IF EXISTS idx_chats_timestamp;
+    ALTER TABLE chats RENAME TO chats_single_turn;
+    {CHAT_SCHEMA}
+    INSERT INTO chats (id, model, title, timestamp, updated_at, message_count)
+        SELECT id, model, prompt, timestamp, timestamp, 2 FROM chats_single_turn;
+    INSERT INTO messages (chat_id, seq, role, content, model, created_at)
+        SELECT id, 1, 'user', prompt, model, timestamp FROM chats_single_turn ORDER BY id;
+    INSERT INTO messages (chat_id, seq, role, content, model, created_at)
+        SELECT id, 2, 'assistant', response, model, timestamp FROM chats_single_turn ORDER BY id;
+    DROP TABLE chats_single_turn;
+    COMMIT;
+    ''')
+    # Cached sidebars refer to the old layout
+    if conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'chat_changes'").fetchone():
+        conn.execute("INSERT INTO chat_changes (chat_id, op) VALUES (NULL, 'clear')")
+        conn.commit()
+    logger.info(f"Migrated chats in {time.monotonic() - started:.2f}s")
+
+def init_search_index(conn):
+    """Create the FTS5 index over messages and backfill it if it is out of sync with the table"""
+    global SEARCH_AVAILABLE
+    try:
+        # Recreated, in case an import was interrupted while it had them swapped out
+        conn.executescript(''.join(f'DROP TRIGGER IF EXISTS {name};' for name in SEARCH_TRIGGERS) + SEARCH_INDEX_SCHEMA)
+    except sqlite3.OperationalError as e:
+        SEARCH_AVAILABLE = False
+        logger.warning(f"Full-text search disabled, SQLite FTS5 is not available: {str(e)}")
+        return
+    
+    SEARCH_AVAILABLE = True
+    indexed = conn.execute('SELECT count(*) FROM messages_fts_docsize').fetchone()[0]
+    stored = conn.execute('SELECT count(*) FROM messages').fetchone()[0]
+    if indexed != stored:
+        rebuild_search_index(conn)
+
+def rebuild_search_index(conn):
+    """Re-index every message from scratch"""
+    started = time.monotonic()
+    conn.execute("INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')")
+    conn.commit()
+    logger.info(f"Search index rebuilt in {time.monotonic() - started:.2f}s")
+
 def initialize_ollama_model(model_name):
     """Initialize and pull the model if not already available"""
     try:
         logger.info(f"Checking if model {model_name} is available...")
         # Check if model exists
-        response = requests.get(f"{OLLAMA_BASE_URL}/api/tags")
-        if response.status_code != 200:
-            raise Exception(f"Failed to get model list: {response.text}")
+        status = ollama_health.probe()
+        if not status['up']:
+            raise Exception(f"Failed to get model list: {status['error']}")
             
-        models = response.json().get('models', [])
-        model_exists = any(m['name'] == model_name for m in models)
-        
-        if not model_exists:
+        if not model_available(model_name, status['models']):
             logger.info(f"Model {model_name} not found. Pulling from Ollama...")
-            try:
-                # Use subprocess to run ollama pull command
-                import subprocess
-                result = subprocess.run(['ollama', 'pull', model_name], 
-                                     capture_output=True, 
-                                     text=True)
-                if result.returncode != 0:
-                    raise Exception(f"Failed to pull model via CLI: {result.stderr}")
-                logger.info(f"Successfully pulled model {model_name}")
-            except subprocess.SubprocessError as e:
-                # Fallback to API if CLI fails
-                logger.warning(f"CLI pull failed, trying API: {str(e)}")
-                response = requests.post(
-                    f"{OLLAMA_BASE_URL}/api/pull",
-                    json={"name": model_name},
-                )
-                if response.status_code != 200:
-                    raise Exception(f"Failed to pull model via API: {response.text}")
-                logger.info(f"Successfully pulled model {model_name} via API")
-        
-        # Warm up the model with a simple query
-        logger.info(f"Warming up model {model_name}...")
-        response = requests.post(
-            f"{OLLAMA_BASE_URL}/api/generate",
-            json={
-                "model": model_name,
-                "prompt": "Hello",
-                "stream": False
-            },
-        )
+            model_pulls.start(model_name)
+            job = model_pulls.wait(model_name)
+            if job['status'] != 'done':
+                raise Exception(f"Failed to pull model: {job['error'] or job['status']}")
         
-        if response.status_code != 200:
-            raise Exception(f"Failed to initialize model: {response.text}")
+        # Load the model now, evicting idle ones if it would not fit
+        logger.info(f"Loading model {model_name}...")
+        model_residency.load(model_name)
             
         logger.info(f"Model {model_name} initialized successfully")
+        ollama_health.refresh()
         return True
         
     except Exception as e:
@@ -832,9 +4551,8 @@ def shutdown_server():
         logger.info("Starting server shutdown sequence...")
         
         # Close database connections
-        if 'db' in g:
-            g.db.close()
-            logger.info("Database connection closed")
+        db_pool.close_all()
+        logger.info("Database connections closed")
         
         # Kill Ollama if it's running
         try:
@@ -899,18 +4617,9 @@ def signal_handler(sig, frame):
     
     print("Shutting down Guria...")
     try:
-        # Clean up database connections
-        with app.app_context():
-            if hasattr(g, 'db'):
-                g.db.close()
-                print("Database connections closed")
-        
-        # Clean up any temporary files
-        db_path = os.path.join(os.path.dirname(__file__), 'chats.db')
-        if os.path.exists(db_path + '-journal'):
-            logger.info("Removing stale database journal file")
-            os.remove(db_path + '-journal')
-            print("Temporary database files cleaned up")
+        # Clean up database connections; closing the last one checkpoints the WAL
+        db_pool.close_all()
+        print("Database connections closed")
             
     except Exception as e:
         logger.error(f"Error during cleanup: {str(e)}")
@@ -928,6 +4637,20 @@ if __name__ == '__main__':
         parser.add_argument('--port', type=int, default=7860, help='Port to run the server on')
         parser.add_argument('--force-http', action='store_true', help='Force HTTP mode (not recommended)')
         parser.add_argument('--debug', action='store_true', help='Enable debug mode (not recommended for production)')
+        parser.add_argument('--async-streaming', action='store_true',
+                            help='Serve /chat and /query streams from an asyncio event loop (requires uvicorn, httpx and a2wsgi)')
+        parser.add_argument('--server', choices=['dev', 'prefork'], default='dev',
+                            help='dev: single-process Werkzeug server; prefork: multi-worker gunicorn server (requires gunicorn)')
+        parser.add_argument('--workers', type=int, default=min(4, os.cpu_count() or 1), help='Worker processes in prefork mode')
+        parser.add_argument('--threads', type=int, default=8, help='Threads per worker in prefork mode')
+        parser.add_argument('--max-requests', type=int, default=1000,
+                            help='Gracefully recycle a worker after this many requests (0 disables recycling)')
+        parser.add_argument('--max-requests-jitter', type=int, default=100, help='Random jitter added to --max-requests')
+        parser.add_argument('--graceful-timeout', type=int, default=30, help='Seconds a recycled worker gets to finish its requests')
+        parser.add_argument('--backlog', type=int, default=2048, help='Maximum number of pending connections')
+        parser.add_argument('--keep-alive', type=int, default=5, help='Seconds to hold idle client keep-alive connections open')
+        parser.add_argument('--import-chats', metavar='PATH',
+                            help='Import chats from JSONL or an export archive (- for stdin) and exit')
         args = parser.parse_args()
 
         # Set Flask environment
@@ -940,12 +4663,23 @@ if __name__ == '__main__':
             format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
         )
 
-        # Initialize the application
-        init_app()
+        if args.import_chats:
+            init_db()
+            if args.import_chats == '-':
+                stats = import_chats(sys.stdin.buffer)
+            else:
+                with open(args.import_chats, 'rb') as f:
+                    stats = import_chats(f)
+            print(json.dumps(stats, indent=2))
+            return
 
         # Initialize the database
         init_db()
 
+        # Initialize the application; prefork workers start it after the fork instead
+        if args.server != 'prefork':
+            init_app()
+
         # Check for SSL certificates
         cert_path = os.path.join(os.path.dirname(__file__), 'ssl', 'cert.pem')
         key_path = os.path.join(os.path.dirname(__file__), 'ssl', 'key.pem')
@@ -983,18 +4717,26 @@ if __name__ == '__main__':
             print(" Note: Running in HTTP mode. This is less secure but suitable for local development.\n")
 
         try:
-            # Clear any existing database lock
-            db_path = os.path.join(os.path.dirname(__file__), 'chats.db')
-            if os.path.exists(db_path + '-journal'):
-                logger.info("Removing stale database journal file")
-                os.remove(db_path + '-journal')
-        
-            app.run(
-                host='0.0.0.0',
-                port=args.port,
-                ssl_context=ssl_context,
-                debug=args.debug
-            )
+            if args.server == 'prefork':
+                run_prefork_server(args, ssl_context)
+            elif args.async_streaming:
+                import uvicorn
+                logger.info("Serving streaming endpoints from the asyncio event loop")
+                uvicorn.run(
+                    create_asgi_app(),
+                    host='0.0.0.0',
+                    port=args.port,
+                    ssl_certfile=ssl_context[0] if ssl_context else None,
+                    ssl_keyfile=ssl_context[1] if ssl_context else None,
+                    log_level='debug' if args.debug else 'info'
+                )
+            else:
+                app.run(
+                    host='0.0.0.0',
+                    port=args.port,
+                    ssl_context=ssl_context,
+                    debug=args.debug
+                )
         except Exception as e:
             logger.error(f"Error starting Flask app: {str(e)}")
             if 'address already in use' in str(e).lower():
@@ -0,0 +1,448 @@
+"""Load test GURIA against the mock Ollama server.
+
+Starts benchmarks/mock_ollama.py and the app on free ports with a scratch
+database seeded through /import, then runs --clients concurrent clients for
+--duration seconds. Each client loops over a weighted mix of requests:
+streaming /chat turns (new chats and follow-ups), /chat_history pages,
+/chat/<id> and /export_pdf/<id>. Reports p50/p95/p99 latency per request type,
+time to first token for /chat, and the server's CPU use and peak RSS
+(including worker processes).
+
+A run can be saved as the baseline for its scenario and later runs compared
+against it; the comparison exits with status 1 if anything regressed by more
+than --tolerance. Baselines are machine-specific, so compare on the machine
+that recorded them.
+
+    python benchmarks/load_test.py --clients 8 --duration 30 --save-baseline
+    python benchmarks/load_test.py --clients 8 --duration 30 --compare
+    python benchmarks/load_test.py --server-args "--server prefork --workers 4" --compare
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import shlex
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+import psutil
+import requests
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+BASELINE_PATH = os.path.join(HERE, 'baselines', 'load_test.json')
+DEFAULT_MIX = ['chat=40', 'history=30', 'get_chat=20', 'export_pdf=10']
+FOLLOW_UP_RATIO = 0.5  # Share of /chat turns that continue an existing chat
+EXPORT_POLL_INTERVAL = 0.02  # Seconds between polls of an export job that is still rendering
+PROMPTS = ['Explain how a hash map works', 'Write a function that merges two sorted lists',
+           'What is the difference between a process and a thread?', 'Summarize the plot of Hamlet',
+           'How do I read a CSV file in Python?', 'Suggest names for a cat']
+WORDS = ['the', 'model', 'answer', 'is', 'that', 'we', 'can', 'return', 'a', 'value', 'from', 'each', 'call',
+         'so', 'data', 'in', 'list', 'sorted', 'first', 'then', 'check', 'result', 'function', 'because']
+PERCENTILES = (50, 95, 99)
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of a non-empty list"""
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, int(round(pct / 100 * len(ordered))) - 1))]
+
+
+def latency_summary(values):
+    return {f"p{pct}": round(percentile(values, pct) * 1000, 1) for pct in PERCENTILES} if values else None
+
+
+def seed_records(rng, chats, turns, model):
+    """JSONL for /import: ``chats`` chats of ``turns`` question/answer pairs"""
+    lines = []
+    for i in range(chats):
+        messages = []
+        for _ in range(turns):
+            messages.append({'role': 'user', 'content': rng.choice(PROMPTS)})
+            messages.append({'role': 'assistant', 'content': ' '.join(rng.choice(WORDS) for _ in range(120))})
+        lines.append(json.dumps({'title': f"Seeded chat {i}", 'model': model, 'messages': messages}))
+    return '\n'.join(lines).encode()
+
+
+def run_chat(session, base, rng, chat_ids, model):
+    """One streamed /chat turn; returns (time to first token, ok)"""
+    chat_id = rng.choice(chat_ids) if chat_ids and rng.random() < FOLLOW_UP_RATIO else None
+    prompt = f"{rng.choice(PROMPTS)} (#{rng.getrandbits(32):08x})"  # Unique, so the response cache never answers
+    started = time.monotonic()
+    ttft = None
+    ok = True
+    body = {'prompt': prompt, 'model': model, 'chat_id': chat_id, 'segments': True}
+    with session.post(f"{base}/chat", json=body, stream=True, timeout=600) as response:
+        if response.status_code != 200:
+            return None, False
+        for line in response.iter_lines():
+            if not line.startswith(b'data: '):
+                continue
+            data = json.loads(line[6:])
+            if ttft is None and (data.get('response') or data.get('thinking')):
+                ttft = time.monotonic() - started
+            if 'error' in data:
+                ok = False
+            if data.get('chat_id') and data['chat_id'] != chat_id:
+                chat_ids.append(data['chat_id'])
+    return ttft, ok and ttft is not None
+
+
+def run_history(session, base, rng, chat_ids, model):
+    response = session.get(f"{base}/chat_history", timeout=60)
+    return None, response.status_code == 200
+
+
+def run_get_chat(session, base, rng, chat_ids, model):
+    response = session.get(f"{base}/chat/{rng.choice(chat_ids)}", timeout=60)
+    return None, response.status_code == 200
+
+
+def run_export_pdf(session, base, rng, chat_ids, model):
+    """Export a chat, polling the job until the PDF is rendered if it was not cached"""
+    response = session.get(f"{base}/export_pdf/{rng.choice(chat_ids)}", timeout=60)
+    deadline = time.monotonic() + 300
+    while response.status_code == 202 and time.monotonic() < deadline:
+        time.sleep(EXPORT_POLL_INTERVAL)
+        job = session.get(base + response.json()['job_url'], timeout=60).json()
+        if job['status'] == 'done':
+            response = session.get(base + job['download_url'], timeout=60)
+        elif job['status'] in ('error', 'expired'):
+            return None, False
+    return None, response.status_code == 200 and response.content.startswith(b'%PDF')
+
+
+OPERATIONS = {'chat': run_chat, 'history': run_history, 'get_chat': run_get_chat, 'export_pdf': run_export_pdf}
+
+
+def client_loop(base, mix, deadline, results, chat_ids, model, seed, reported):
+    rng = random.Random(seed)
+    session = requests.Session()
+    names, weights = zip(*mix.items())
+    while time.monotonic() < deadline:
+        name = rng.choices(names, weights)[0]
+        started = time.monotonic()
+        try:
+            ttft, ok = OPERATIONS[name](session, base, rng, chat_ids, model)
+        except Exception as e:
+            # Counted as an error instead of ending the client; each kind is printed once
+            ttft, ok = None, False
+            if (name, type(e)) not in reported:
+                reported.add((name, type(e)))
+                print(f"{name} failed: {e!r}", file=sys.stderr)
+        results.append((name, time.monotonic() - started, ttft, ok))
+
+
+class ResourceSampler:
+    """Samples CPU time and RSS of a process and its children (prefork workers, export processes)"""
+
+    def __init__(self, pid, interval=0.5):
+        self.process = psutil.Process(pid)
+        self.interval = interval
+        self.cpu = {}  # pid -> last seen CPU seconds, so exited children still count
+        self.peak_rss = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def sample(self):
+        rss = 0
+        try:
+            processes = [self.process] + self.process.children(recursive=True)
+        except psutil.NoSuchProcess:
+            return
+        for process in processes:
+            try:
+                times = process.cpu_times()
+                self.cpu[process.pid] = times.user + times.system
+                rss += process.memory_info().rss
+            except psutil.NoSuchProcess:
+                continue
+        self.peak_rss = max(self.peak_rss, rss)
+
+    def cpu_seconds(self):
+        return sum(self.cpu.values())
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.sample()
+
+    def start(self):
+        self.sample()
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self.sample()
+
+
+def wait_ready(base, server, log_path, timeout=90):
+    """Wait until the app reports Ollama as up"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if server is not None and server.poll() is not None:
+            break
+        try:
+            if requests.get(f"{base}/health", timeout=2).status_code == 200:
+                return
+        except requests.RequestException:
+            pass
+        time.sleep(0.5)
+    with open(log_path, errors='replace') as f:
+        tail = f.read()[-3000:]
+    raise RuntimeError(f"Server did not become ready; log tail:\n{tail}")
+
+
+def stop_process(process):
+    if process is None or process.poll() is not None:
+        return
+    try:
+        children = psutil.Process(process.pid).children(recursive=True)
+    except psutil.NoSuchProcess:
+        children = []
+    process.terminate()
+    try:
+        process.wait(15)
+    except subprocess.TimeoutExpired:
+        process.kill()
+    for child in children:
+        try:
+            child.kill()
+        except psutil.NoSuchProcess:
+            pass
+
+
+def run_load(args, base, chat_ids, sampler):
+    mix = {}
+    for item in args.mix:
+        name, weight = item.split('=')
+        if name not in OPERATIONS:
+            raise SystemExit(f"Unknown operation in --mix: {name} (choose from {', '.join(OPERATIONS)})")
+        mix[name] = float(weight)
+
+    results = []
+    reported = set()
+    cpu_before = sampler.cpu_seconds() if sampler else None
+    started = time.monotonic()
+    deadline = started + args.duration
+    threads = [threading.Thread(target=client_loop, args=(base, mix, deadline, results, chat_ids, args.model,
+                                                          args.seed + i, reported)) for i in range(args.clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - started
+    if sampler:
+        sampler.sample()
+
+    summary = {'requests': {}, 'ttft': None, 'server': None}
+    for name in mix:
+        rows = [row for row in results if row[0] == name]
+        summary['requests'][name] = dict(
+            count=len(rows),
+            errors=sum(1 for row in rows if not row[3]),
+            rps=round(len(rows) / elapsed, 2),
+            **(latency_summary([row[1] for row in rows if row[3]]) or {})
+        )
+    summary['ttft'] = latency_summary([row[2] for row in results if row[0] == 'chat' and row[2] is not None])
+    if sampler:
+        summary['server'] = {
+            'cpu_percent': round((sampler.cpu_seconds() - cpu_before) / elapsed * 100, 1),
+            'peak_rss_mb': round(sampler.peak_rss / 2 ** 20, 1)
+        }
+    try:
+        server_metrics = requests.get(f"{base}/metrics/summary", params={'model': args.model}, timeout=10).json()
+        summary['server_metrics'] = server_metrics['models'].get(args.model)
+    except (requests.RequestException, ValueError, KeyError):
+        summary['server_metrics'] = None
+    summary['elapsed'] = round(elapsed, 1)
+    return summary
+
+
+def print_summary(summary):
+    print(f"\n{'request':<12} {'count':>7} {'errors':>7} {'req/s':>8} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    for name, row in summary['requests'].items():
+        print(f"{name:<12} {row['count']:>7} {row['errors']:>7} {row['rps']:>8.2f} "
+              + ' '.join(f"{row.get(f'p{pct}', float('nan')):>9.1f}" for pct in PERCENTILES))
+    if summary['ttft']:
+        print(f"{'chat ttft':<12} {'':>7} {'':>7} {'':>8} " + ' '.join(f"{summary['ttft'][f'p{pct}']:>9.1f}" for pct in PERCENTILES))
+    if summary['server']:
+        print(f"\nserver: {summary['server']['cpu_percent']:.1f}% CPU (100% = one core), "
+              f"peak RSS {summary['server']['peak_rss_mb']:.1f} MB")
+    metrics = summary.get('server_metrics') or {}
+    if metrics:
+        parts = [f"{name} p95 {metrics[name]['p95'] * 1000:.1f} ms" for name in
+                 ('queue_wait_seconds', 'time_to_first_token_seconds', 'db_write_seconds', 'sse_write_seconds')
+                 if metrics.get(name) and metrics[name]['p95'] is not None]
+        print('server-side: ' + ', '.join(parts))
+
+
+def compare(summary, baseline, tolerance, min_delta_ms):
+    """Print changes against ``baseline``; returns the list of regressions.
+
+    A metric regresses when it is worse by more than ``tolerance`` (relative) and by
+    more than an absolute slack, so millisecond jitter on fast requests is ignored.
+    """
+    checks = []
+    for name, row in summary['requests'].items():
+        base_row = baseline['requests'].get(name)
+        if not base_row:
+            continue
+        for key in ('p50', 'p95', 'p99'):
+            if key in row and key in base_row:
+                checks.append((f"{name} {key} ms", base_row[key], row[key], True, min_delta_ms))
+        checks.append((f"{name} req/s", base_row['rps'], row['rps'], False, 0))
+    if summary['ttft'] and baseline.get('ttft'):
+        for key in ('p50', 'p95'):
+            checks.append((f"chat ttft {key} ms", baseline['ttft'][key], summary['ttft'][key], True, min_delta_ms))
+    if summary['server'] and baseline.get('server'):
+        checks.append(('server cpu %', baseline['server']['cpu_percent'], summary['server']['cpu_percent'], True, 5))
+        checks.append(('server peak rss MB', baseline['server']['peak_rss_mb'], summary['server']['peak_rss_mb'], True, 10))
+
+    regressions = []
+    print(f"\n{'metric':<24} {'baseline':>10} {'now':>10} {'change':>8}")
+    for label, before, now, lower_is_better, slack in checks:
+        change = (now - before) / before if before else 0.0
+        if lower_is_better:
+            worse = change > tolerance and now - before > slack
+        else:
+            worse = change < -tolerance and before - now > slack
+        if worse:
+            regressions.append(label)
+        print(f"{label:<24} {before:>10.1f} {now:>10.1f} {change:>+7.0%}{'  REGRESSION' if worse else ''}")
+    for name, row in summary['requests'].items():
+        before = baseline['requests'].get(name, {}).get('errors', 0)
+        if row['errors'] > before:
+            regressions.append(f"{name} errors")
+            print(f"{name + ' errors':<24} {before:>10} {row['errors']:>10}  REGRESSION")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test GURIA against a mock Ollama server')
+    parser.add_argument('--clients', type=int, default=8, help='Concurrent simulated users')
+    parser.add_argument('--duration', type=float, default=30, help='Seconds to run the load')
+    parser.add_argument('--mix', nargs='+', default=DEFAULT_MIX, help='Request mix as name=weight pairs')
+    parser.add_argument('--model', default='llama2:latest')
+    parser.add_argument('--seed-chats', type=int, default=200, help='Chats imported before the run')
+    parser.add_argument('--seed-turns', type=int, default=4, help='Question/answer pairs per seeded chat')
+    parser.add_argument('--server-args', default='', help='Extra app.py arguments, e.g. "--server prefork --workers 4"')
+    parser.add_argument('--url', help='Load an already running server instead of starting one (no CPU/RSS figures)')
+    parser.add_argument('--tokens-per-second', type=float, default=50, help='Mock decode speed')
+    parser.add_argument('--first-token-delay', type=float, default=0.2, help='Mock prefill delay in seconds')
+    parser.add_argument('--response-tokens', type=int, default=80, help='Mock answer length in words')
+    parser.add_argument('--parallel', type=int, default=4, help='Mock generations served at once per model')
+    parser.add_argument('--scenario', help='Baseline key (default: derived from --server-args and --clients)')
+    parser.add_argument('--baseline', default=BASELINE_PATH, help='Baseline file')
+    parser.add_argument('--save-baseline', action='store_true', help='Store this run as the scenario baseline')
+    parser.add_argument('--compare', action='store_true', help='Compare with the scenario baseline')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='Allowed relative slowdown before a regression is reported')
+    parser.add_argument('--min-delta-ms', type=float, default=5, help='Latency changes smaller than this are never regressions')
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    scenario = args.scenario or '-'.join(['dev' if not args.server_args else
+                                          args.server_args.replace('--', '').replace(' ', '-'), f"c{args.clients}"])
+    rng = random.Random(args.seed)
+    mock = server = None
+    sampler = None
+    with tempfile.TemporaryDirectory(prefix='guria-load-') as workdir:
+        log_path = os.path.join(workdir, 'server.log')
+        try:
+            if args.url:
+                base = args.url.rstrip('/')
+                with open(log_path, 'w'):
+                    pass
+            else:
+                mock_port, port = free_port(), free_port()
+                mock = subprocess.Popen(
+                    [sys.executable, os.path.join(HERE, 'mock_ollama.py'), '--port', str(mock_port),
+                     '--tokens-per-second', str(args.tokens_per_second), '--first-token-delay', str(args.first_token_delay),
+                     '--response-tokens', str(args.response_tokens), '--parallel', str(args.parallel),
+                     '--models', args.model, '--seed', str(args.seed)],
+                    stdout=subprocess.DEVNULL)
+                env = dict(os.environ,
+                           OLLAMA_BASE_URL=f"http://127.0.0.1:{mock_port}",
+                           GURIA_DB_PATH=os.path.join(workdir, 'chats.db'),
+                           GURIA_EXPORT_DIR=os.path.join(workdir, 'exports'))
+                with open(log_path, 'w') as log:
+                    server = subprocess.Popen(
+                        [sys.executable, os.path.join(ROOT, 'app.py'), '--force-http', '--port', str(port),
+                         *shlex.split(args.server_args)],
+                        cwd=ROOT, env=env, stdout=log, stderr=subprocess.STDOUT)
+                base = f"http://127.0.0.1:{port}"
+            wait_ready(base, server, log_path)
+
+            response = requests.post(f"{base}/import", data=seed_records(rng, args.seed_chats, args.seed_turns, args.model),
+                                     headers={'Content-Type': 'application/x-ndjson'}, timeout=300)
+            if not response.ok:
+                raise SystemExit(f"Seed import failed with {response.status_code}: {response.text[:500]}")
+            imported = response.json()
+            chat_ids = [chat['id'] for chat in requests.get(f"{base}/chat_history", params={'limit': 100}, timeout=60).json()['chats']]
+            if not chat_ids:
+                raise SystemExit('No chats in /chat_history after the seed import')
+            started = time.monotonic()
+            requests.post(f"{base}/initialize_model", json={'model': args.model}, timeout=300)
+            print(f"Scenario {scenario}: imported {imported.get('chats')} chats, "
+                  f"model ready in {time.monotonic() - started:.1f}s; "
+                  f"running {args.clients} clients for {args.duration:.0f}s")
+
+            if server is not None:
+                sampler = ResourceSampler(server.pid)
+                sampler.start()
+            summary = run_load(args, base, chat_ids, sampler)
+        finally:
+            if sampler:
+                sampler.stop()
+            stop_process(server)
+            stop_process(mock)
+
+    print_summary(summary)
+    summary.update(config={
+        'clients': args.clients, 'duration': args.duration, 'mix': args.mix, 'model': args.model,
+        'seed_chats': args.seed_chats, 'seed_turns': args.seed_turns, 'server_args': args.server_args,
+        'tokens_per_second': args.tokens_per_second, 'first_token_delay': args.first_token_delay,
+        'response_tokens': args.response_tokens, 'parallel': args.parallel,
+    }, machine={'cpus': os.cpu_count(), 'python': platform.python_version(), 'platform': platform.platform()},
+        recorded_at=datetime.now().isoformat(timespec='seconds'))
+
+    baselines = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baselines = json.load(f)
+    regressions = []
+    if args.compare:
+        if scenario in baselines:
+            regressions = compare(summary, baselines[scenario], args.tolerance, args.min_delta_ms)
+        else:
+            print(f"\nNo baseline for scenario {scenario} in {args.baseline}")
+    errors = sum(row['errors'] for row in summary['requests'].values())
+    if args.save_baseline and errors:
+        print(f"\nNot saving baseline {scenario}: the run had {errors} failed request(s)")
+        sys.exit(1)
+    if args.save_baseline:
+        baselines[scenario] = summary
+        os.makedirs(os.path.dirname(args.baseline), exist_ok=True)
+        with open(args.baseline, 'w') as f:
+            json.dump(baselines, f, indent=2, sort_keys=True)
+            f.write('\n')
+        print(f"\nSaved baseline {scenario} to {args.baseline}")
+    if regressions:
+        print(f"\n{len(regressions)} regression(s): {', '.join(regressions)}")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,272 @@
+"""Local stand-in for the Ollama API, for load tests without a GPU.
+
+Serves /api/tags, /api/ps, /api/version, /api/generate, /api/chat and /api/pull.
+Generations stream deterministic text at a configurable token rate after a
+first-token (prefill) delay, with an extra load delay the first time a model is
+used or after it was unloaded, and finish with the same timing fields as a
+real ``done`` chunk. Like Ollama, each model serves --parallel requests at a
+time and queues the rest. Pulls stream download progress for --pull-seconds.
+
+    python benchmarks/mock_ollama.py --port 11435 --tokens-per-second 40 --first-token-delay 0.3
+    OLLAMA_BASE_URL=http://localhost:11435 python app.py --force-http
+"""
+import argparse
+import hashlib
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+WORDS = ['the', 'model', 'answer', 'is', 'that', 'we', 'can', 'return', 'a', 'value', 'from', 'each', 'call',
+         'so', 'data', 'in', 'list', 'sorted', 'first', 'then', 'check', 'result', 'function', 'because']
+DEFAULT_MODELS = ['llama2:latest', 'deepseek-r1:7b', 'deepseek-r1:14b', 'mistral:latest']
+MODEL_SIZE = 4 << 30
+
+
+class MockOllama:
+    """Shared state of the mock: installed and loaded models and per-model concurrency"""
+
+    def __init__(self, args):
+        self.args = args
+        self.lock = threading.Lock()
+        self.installed = {name: MODEL_SIZE for name in args.models}
+        self.loaded = {}
+        self.slots = {}
+        self.requests = 0
+
+    @staticmethod
+    def canonical(model):
+        return model if ':' in model else f"{model}:latest"
+
+    def slot(self, model):
+        with self.lock:
+            if model not in self.slots:
+                self.slots[model] = threading.Semaphore(self.args.parallel)
+            return self.slots[model]
+
+    def load(self, model, keep_alive):
+        """Mark ``model`` loaded, sleeping for the load delay if it was not; returns the load time in seconds"""
+        with self.lock:
+            cold = model not in self.loaded
+            self.loaded[model] = keep_alive
+        if cold:
+            time.sleep(self.args.load_delay)
+            return self.args.load_delay
+        return 0.001
+
+    def tokens(self, prompt, think):
+        """Deterministic tokens for a prompt: 1 to --max-chunk characters each, like Ollama's output"""
+        rng = random.Random(f"{self.args.seed}:{prompt}")
+        words = [rng.choice(WORDS) for _ in range(self.args.response_tokens)]
+        text = ' '.join(words)
+        if think:
+            split = len(text) // 3
+            text = f"<think>\n{text[:split]}\n</think>\n\n{text[split:]}"
+        tokens = []
+        while text:
+            size = rng.randint(self.args.min_chunk, self.args.max_chunk)
+            tokens.append(text[:size])
+            text = text[size:]
+        return tokens
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    mock = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, payload, status=200):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def start_stream(self):
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-ndjson')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+
+    def send_line(self, payload):
+        data = (json.dumps(payload) + '\n').encode()
+        self.wfile.write(b'%x\r\n%s\r\n' % (len(data), data))
+        self.wfile.flush()
+
+    def end_stream(self):
+        self.wfile.write(b'0\r\n\r\n')
+        self.wfile.flush()
+
+    def read_json(self):
+        length = int(self.headers.get('Content-Length', 0))
+        try:
+            return json.loads(self.rfile.read(length) or b'{}')
+        except json.JSONDecodeError:
+            return {}
+
+    def do_GET(self):
+        mock = self.mock
+        if self.path == '/api/tags':
+            with mock.lock:
+                models = [{'name': name, 'model': name, 'size': size, 'digest': hashlib.sha256(name.encode()).hexdigest()}
+                          for name, size in mock.installed.items()]
+            self.send_json({'models': models})
+        elif self.path == '/api/ps':
+            with mock.lock:
+                models = [{'name': name, 'model': name, 'size': mock.installed.get(name, MODEL_SIZE),
+                           'size_vram': 0, 'keep_alive': keep_alive} for name, keep_alive in mock.loaded.items()]
+            self.send_json({'models': models})
+        elif self.path == '/api/version':
+            self.send_json({'version': '0.0.0-mock'})
+        else:
+            self.send_json({'error': 'not found'}, 404)
+
+    def do_POST(self):
+        body = self.read_json()
+        if self.path in ('/api/generate', '/api/chat'):
+            self.generate(body, chat=self.path == '/api/chat')
+        elif self.path == '/api/pull':
+            self.pull(body)
+        else:
+            self.send_json({'error': 'not found'}, 404)
+
+    def generate(self, body, chat):
+        mock = self.mock
+        model = mock.canonical(body.get('model', ''))
+        with mock.lock:
+            mock.requests += 1
+            installed = model in mock.installed
+        if not installed:
+            return self.send_json({'error': f"model '{body.get('model')}' not found, try pulling it first"}, 404)
+        if body.get('keep_alive') == 0:
+            with mock.lock:
+                mock.loaded.pop(model, None)
+            return self.send_json({'model': model, 'response': '', 'done': True, 'done_reason': 'unload'})
+
+        if chat:
+            messages = body.get('messages') or []
+            prompt = ''.join(str(m.get('content', '')) for m in messages)
+        else:
+            prompt = body.get('prompt', '')
+        if not prompt and not (chat and body.get('messages')):
+            # A request without a prompt only loads the model
+            load_seconds = mock.load(model, body.get('keep_alive'))
+            return self.send_json({'model': model, 'response': '', 'done': True, 'done_reason': 'load',
+                                   'load_duration': int(load_seconds * 1e9)})
+
+        with mock.slot(model):
+            started = time.monotonic()
+            load_seconds = mock.load(model, body.get('keep_alive'))
+            tokens = mock.tokens(prompt, mock.args.think and 'r1' in model)
+            time.sleep(mock.args.first_token_delay)
+            prompt_eval = time.monotonic() - started - load_seconds
+
+            def chunk(text, done=False):
+                payload = {'model': model, 'created_at': time.strftime('%Y-%m-%dT%H:%M:%SZ'), 'done': done}
+                if chat:
+                    payload['message'] = {'role': 'assistant', 'content': text}
+                else:
+                    payload['response'] = text
+                return payload
+
+            if not body.get('stream', True):
+                time.sleep(len(tokens) / mock.args.tokens_per_second)
+                response = chunk(''.join(tokens), done=True)
+            else:
+                self.start_stream()
+                decode_started = time.monotonic()
+                try:
+                    for i, token in enumerate(tokens):
+                        # Pace against the start so rounding in sleep() does not slow the stream down
+                        delay = decode_started + i / mock.args.tokens_per_second - time.monotonic()
+                        if delay > 0:
+                            time.sleep(delay)
+                        self.send_line(chunk(token))
+                except (BrokenPipeError, ConnectionResetError):
+                    return
+                response = chunk('', done=True)
+            eval_seconds = max(time.monotonic() - started - load_seconds - prompt_eval, 1e-6)
+            response.update({
+                'done_reason': 'stop',
+                'total_duration': int((time.monotonic() - started) * 1e9),
+                'load_duration': int(load_seconds * 1e9),
+                'prompt_eval_count': max(len(prompt) // 4, 1),
+                'prompt_eval_duration': int(prompt_eval * 1e9),
+                'eval_count': len(tokens),
+                'eval_duration': int(eval_seconds * 1e9),
+            })
+            if not chat:
+                response['context'] = list(range(1, 17))
+            if body.get('stream', True):
+                self.send_line(response)
+                self.end_stream()
+            else:
+                self.send_json(response)
+
+    def pull(self, body):
+        mock = self.mock
+        model = mock.canonical(body.get('name') or body.get('model', ''))
+        digest = 'sha256:' + hashlib.sha256(model.encode()).hexdigest()
+        steps = max(int(mock.args.pull_seconds / 0.1), 1)
+        if not body.get('stream', True):
+            time.sleep(mock.args.pull_seconds)
+        else:
+            self.start_stream()
+            try:
+                self.send_line({'status': 'pulling manifest'})
+                for step in range(steps + 1):
+                    self.send_line({'status': f"pulling {digest[7:19]}", 'digest': digest,
+                                    'total': MODEL_SIZE, 'completed': MODEL_SIZE * step // steps})
+                    time.sleep(mock.args.pull_seconds / steps)
+                for status in ('verifying sha256 digest', 'writing manifest', 'success'):
+                    self.send_line({'status': status})
+                self.end_stream()
+            except (BrokenPipeError, ConnectionResetError):
+                return
+        with mock.lock:
+            mock.installed[model] = MODEL_SIZE
+        if not body.get('stream', True):
+            self.send_json({'status': 'success'})
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description='Mock Ollama server for load tests')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=11435)
+    parser.add_argument('--models', nargs='+', default=DEFAULT_MODELS, help='Installed models')
+    parser.add_argument('--tokens-per-second', type=float, default=40, help='Decode speed of each generation')
+    parser.add_argument('--first-token-delay', type=float, default=0.3, help='Seconds of prefill before the first token')
+    parser.add_argument('--load-delay', type=float, default=2.0, help='Seconds to load a model that is not loaded')
+    parser.add_argument('--response-tokens', type=int, default=200, help='Words per answer')
+    parser.add_argument('--min-chunk', type=int, default=1, help='Shortest token in characters')
+    parser.add_argument('--max-chunk', type=int, default=4, help='Longest token in characters')
+    parser.add_argument('--parallel', type=int, default=4, help='Generations served at once per model, like OLLAMA_NUM_PARALLEL')
+    parser.add_argument('--pull-seconds', type=float, default=5, help='Duration of a model pull')
+    parser.add_argument('--think', action='store_true', help='Wrap the first third of answers from r1 models in <think> tags')
+    parser.add_argument('--seed', type=int, default=42)
+    return parser
+
+
+def serve(args):
+    handler = type('MockHandler', (Handler,), {'mock': MockOllama(args)})
+    server = ThreadingHTTPServer((args.host, args.port), handler)
+    server.daemon_threads = True
+    return server
+
+
+def main():
+    args = build_parser().parse_args()
+    server = serve(args)
+    print(f"Mock Ollama listening on http://{args.host}:{args.port}", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+"""Measure /search query latency as the chats table grows.
+
+Builds a throwaway database with synthetic chats, then times ranked FTS5
+queries (with and without filters) at each row count.
+
+    python benchmarks/search_benchmark.py --rows 1000 10000 100000
+"""
+import argparse
+import os
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+VOCABULARY_SIZE = 20000
+MODELS = ["deepseek-r1:7b", "deepseek-r1:8b", "deepseek-r1:14b", "deepseek-coder-v2"]
+
+
+def build_vocabulary(rng, size):
+    """Pseudo-words with Zipf-like weights, so a few terms are common and most are rare"""
+    letters = 'abcdefghijklmnopqrstuvwxyz'
+    words = [''.join(rng.choice(letters) for _ in range(rng.randint(3, 9))) for _ in range(size)]
+    weights = [1 / (rank + 1) for rank in range(size)]
+    return words, weights
+
+
+def random_text(rng, vocabulary, words):
+    return ' '.join(rng.choices(vocabulary[0], weights=vocabulary[1], k=words))
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark full-text search latency versus row count')
+    parser.add_argument('--rows', type=int, nargs='+', default=[1000, 10000, 100000], help='Row counts to measure at')
+    parser.add_argument('--queries', type=int, default=200, help='Queries per row count')
+    parser.add_argument('--response-words', type=int, default=300, help='Words per synthetic response')
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='guria-search-bench-')
+    os.environ['GURIA_DB_PATH'] = os.path.join(workdir, 'chats.db')
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import app as guria
+    guria.logger.setLevel('WARNING')
+    guria.init_db()
+
+    rng = random.Random(args.seed)
+    vocabulary = build_vocabulary(rng, VOCABULARY_SIZE)
+    # Selective queries look for a topic; common queries hit words found in a large share of chats
+    selective_words = (vocabulary[0][1000:], [1] * (VOCABULARY_SIZE - 1000))
+    common_words = (vocabulary[0][20:200], [1] * 180)
+    inserted = 0
+    print(f"{'rows':>10} {'db MB':>8} {'insert/s':>10} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} "
+          f"{'filtered p95':>13} {'common p50':>11} {'common p95':>11}")
+    for target in sorted(args.rows):
+        started = time.monotonic()
+        with guria.db_connection() as conn:
+            while inserted < target:
+                batch = min(5000, target - inserted)
+                conn.execute('BEGIN')
+                for _ in range(batch):
+                    model = rng.choice(MODELS)
+                    timestamp = f"2025-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}T12:00:00"
+                    prompt = random_text(rng, vocabulary, 12)
+                    chat_id = guria.create_chat(conn, model, prompt, timestamp)
+                    guria.append_messages(conn, chat_id, [
+                        {'role': 'user', 'content': prompt, 'model': model},
+                        {'role': 'assistant', 'content': random_text(rng, vocabulary, args.response_words), 'model': model}
+                    ])
+                conn.commit()
+                inserted += batch
+        insert_rate = target / max(time.monotonic() - started, 1e-9) if target else 0
+
+        plain, filtered, common = [], [], []
+        with guria.db_connection() as conn:
+            for i in range(args.queries):
+                text = random_text(rng, selective_words, rng.randint(1, 2))
+                t0 = time.perf_counter()
+                guria.search_chats(conn, text)
+                plain.append((time.perf_counter() - t0) * 1000)
+
+                t0 = time.perf_counter()
+                guria.search_chats(conn, text, model=rng.choice(MODELS), date_from='2025-03-01', date_to='2025-09-01')
+                filtered.append((time.perf_counter() - t0) * 1000)
+
+                t0 = time.perf_counter()
+                guria.search_chats(conn, random_text(rng, common_words, 1))
+                common.append((time.perf_counter() - t0) * 1000)
+
+        size_mb = os.path.getsize(os.environ['GURIA_DB_PATH']) / 1024 / 1024
+        print(f"{target:>10} {size_mb:>8.1f} {insert_rate:>10.0f} {statistics.median(plain):>8.2f} "
+              f"{percentile(plain, 95):>8.2f} {percentile(plain, 99):>8.2f} {percentile(filtered, 95):>13.2f} "
+              f"{statistics.median(common):>11.2f} {percentile(common, 95):>11.2f}")
+
+    guria.db_pool.close_all()
+    shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
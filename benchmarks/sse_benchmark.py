@@ -0,0 +1,79 @@
+"""Compare per-token SSE framing with coalesced frames.
+
+Replays synthetic token streams (1-4 characters per token, like Ollama's
+output) through StreamCoalescer on a simulated clock and reports frames and
+bytes per second of stream, plus the server CPU spent framing each token.
+
+    python benchmarks/sse_benchmark.py --tokens 2000 --rates 20 60 150
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+WORDS = ['the', 'model', 'def', 'return', 'self', 'value', 'data', 'for', 'in', 'if', 'print', 'x', '=', '(', ')', ':']
+
+
+def token_stream(rng, count):
+    """Short token strings with the length mix of a typical code/chat answer"""
+    tokens = []
+    for _ in range(count):
+        word = rng.choice(WORDS)
+        tokens.append(word if len(word) <= 4 else word[:rng.randint(1, 4)])
+        if rng.random() < 0.3:
+            tokens[-1] = ' ' + tokens[-1]
+    return tokens
+
+
+def run_stream(guria, tokens, rate, window_ms):
+    """Frame one stream arriving at ``rate`` tokens/s; returns (frames, bytes, cpu seconds)"""
+    now = [0.0]
+    coalescer = guria.StreamCoalescer('response', window_ms / 1000, clock=lambda: now[0])
+    frames = 0
+    size = 0
+    started = time.process_time()
+    for token in tokens:
+        now[0] += 1 / rate
+        if window_ms:
+            frame = coalescer.add(token)
+        else:
+            frame = guria.sse_event({'response': token})
+        if frame:
+            frames += 1
+            size += len(frame.encode())
+    frame = coalescer.flush()
+    if frame:
+        frames += 1
+        size += len(frame.encode())
+    return frames, size, time.process_time() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark SSE frame coalescing')
+    parser.add_argument('--tokens', type=int, default=2000, help='Tokens per stream')
+    parser.add_argument('--rates', type=float, nargs='+', default=[20, 60, 150], help='Token rates (tokens/s) to simulate')
+    parser.add_argument('--windows', type=float, nargs='+', default=[0, 30, 50], help='Coalescing windows in ms (0 = per-token frames)')
+    parser.add_argument('--repeat', type=int, default=20, help='Streams per measurement, for stable CPU timings')
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import app as guria
+    guria.logger.setLevel('WARNING')
+
+    tokens = token_stream(random.Random(args.seed), args.tokens)
+    print(f"{'tok/s':>7} {'window ms':>10} {'frames':>8} {'frames/s':>9} {'bytes/s':>9} {'bytes/tok':>10} {'cpu us/tok':>11}")
+    for rate in args.rates:
+        duration = args.tokens / rate
+        for window_ms in args.windows:
+            cpu = 0.0
+            for _ in range(args.repeat):
+                frames, size, elapsed = run_stream(guria, tokens, rate, window_ms)
+                cpu += elapsed
+            print(f"{rate:>7.0f} {window_ms:>10.0f} {frames:>8} {frames / duration:>9.1f} {size / duration:>9.0f} "
+                  f"{size / args.tokens:>10.1f} {cpu / args.repeat / args.tokens * 1e6:>11.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,159 @@
+"""Compare the streaming thinking parser with per-chunk pattern matching.
+
+Replays a token stream through the old per-chunk formatter (a list of 20
+regexes built and matched for every chunk), the old client-side approach
+(re-scanning the whole text for <think> tags on every frame) and
+ThinkingStreamParser, and reports CPU microseconds per token. The default
+stream is a synthetic deepseek-r1 style answer with its <think> tags split
+across tokens; --stream replays a recorded Ollama /api/chat (or /api/generate)
+NDJSON file.
+
+    python benchmarks/thinking_benchmark.py --tokens 4000
+    python benchmarks/thinking_benchmark.py --stream recorded.ndjson
+"""
+import argparse
+import json
+import os
+import random
+import re
+import sys
+import time
+
+WORDS = ['the', 'user', 'wants', 'a', 'function', 'that', 'returns', 'value', 'so', 'we', 'check',
+         'each', 'item', 'and', 'list', 'is', 'sorted', 'first', 'then', 'return', 'x', '=', '(', ')', ':']
+OPENERS = ["Let's break this down", 'First, let us', 'We need to', 'To solve this', 'Here is how']
+
+
+def legacy_format_chunk(chunk):
+    """The per-chunk formatter /query used before ThinkingStreamParser"""
+    thinking_patterns = [
+        (r"Let(?:')?s break this down", "[thinking]Let's break this down"),
+        (r"First,? let(?:')?s", "[thinking]First, let's"),
+        (r"Let(?:')?s start", "[thinking]Let's start"),
+        (r"Let(?:')?s analyze", "[thinking]Let's analyze"),
+        (r"Let(?:')?s consider", "[thinking]Let's consider"),
+        (r"Let(?:')?s look at", "[thinking]Let's look at"),
+        (r"Let(?:')?s examine", "[thinking]Let's examine"),
+        (r"Let(?:')?s understand", "[thinking]Let's understand"),
+        (r"Let(?:')?s think about", "[thinking]Let's think about"),
+        (r"Let(?:')?s approach", "[thinking]Let's approach"),
+        (r"Here(?:')?s how", "[thinking]Here's how"),
+        (r"We need to", "[thinking]We need to"),
+        (r"We should", "[thinking]We should"),
+        (r"We can", "[thinking]We can"),
+        (r"I(?:')?ll help you", "[thinking]I'll help you"),
+        (r"To solve this", "[thinking]To solve this"),
+        (r"To address this", "[thinking]To address this"),
+        (r"To implement this", "[thinking]To implement this"),
+        (r"To create this", "[thinking]To create this"),
+        (r"To handle this", "[thinking]To handle this"),
+    ]
+    for pattern, replacement in thinking_patterns:
+        if re.match(pattern, chunk.strip(), re.IGNORECASE):
+            parts = chunk.split('\n', 1)
+            if len(parts) > 1:
+                return f"{replacement}{parts[0][len(pattern):]}\n[/thinking]\n{parts[1]}"
+            return f"{replacement}{chunk[len(pattern):]}\n[/thinking]\n"
+    return chunk
+
+
+def tokenize(text, rng):
+    """Split text into 1-4 character tokens, like Ollama's output"""
+    tokens = []
+    while text:
+        size = rng.randint(1, 4)
+        tokens.append(text[:size])
+        text = text[size:]
+    return tokens
+
+
+def synthetic_stream(rng, count):
+    """A deepseek-r1 style answer: a <think> block, then lines that sometimes open with a thinking phrase"""
+    words = []
+    while len(words) < count:
+        if rng.random() < 0.1:
+            words.append('\n' + rng.choice(OPENERS))
+        words.append(rng.choice(WORDS))
+    thought = ' '.join(words[:count // 3])
+    answer = ' '.join(words[count // 3:count])
+    return tokenize(f'<think>\n{thought}\n</think>\n\n{answer}', rng)
+
+
+def recorded_stream(path):
+    """The answer tokens of a recorded /api/chat or /api/generate NDJSON stream"""
+    tokens = []
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                chunk = json.loads(line)
+                token = chunk['message'].get('content') if chunk.get('message') else chunk.get('response')
+                if token:
+                    tokens.append(token)
+    return tokens
+
+
+def run_legacy_chunks(guria, tokens):
+    for token in tokens:
+        legacy_format_chunk(token)
+
+
+def run_full_text_scan(guria, tokens):
+    """What the browser did per frame: look for the tags in the whole text so far and slice it"""
+    text = ''
+    for token in tokens:
+        text += token
+        start = text.find('<think>')
+        if start != -1:
+            end = text.find('</think>', start)
+            text[start + 7:end if end != -1 else len(text)]
+            if end != -1:
+                text[end + 8:]
+
+
+def run_parser_segments(guria, tokens):
+    parser = guria.ThinkingStreamParser()
+    for token in tokens:
+        parser.feed(token)
+    parser.close()
+
+
+def run_parser_markup(guria, tokens):
+    parser = guria.ThinkingStreamParser(phrases=True)
+    for token in tokens:
+        guria.thinking_markup(parser.feed(token))
+    guria.thinking_markup(parser.close())
+
+
+RUNNERS = [
+    ('per-chunk regex list (old /query)', run_legacy_chunks),
+    ('full-text tag scan (old client)', run_full_text_scan),
+    ('parser, segments (/chat)', run_parser_segments),
+    ('parser, phrase markup (/query)', run_parser_markup),
+]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark thinking-section detection on a token stream')
+    parser.add_argument('--tokens', type=int, default=4000, help='Words in the synthetic stream')
+    parser.add_argument('--stream', help='Recorded Ollama NDJSON stream to replay instead')
+    parser.add_argument('--repeat', type=int, default=10, help='Replays per measurement, for stable CPU timings')
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import app as guria
+    guria.logger.setLevel('WARNING')
+
+    tokens = recorded_stream(args.stream) if args.stream else synthetic_stream(random.Random(args.seed), args.tokens)
+    print(f"{len(tokens)} tokens, {sum(map(len, tokens))} characters")
+    print(f"{'method':<36} {'cpu us/tok':>11}")
+    for name, run in RUNNERS:
+        started = time.process_time()
+        for _ in range(args.repeat):
+            run(guria, tokens)
+        elapsed = time.process_time() - started
+        print(f"{name:<36} {elapsed / args.repeat / len(tokens) * 1e6:>11.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -664,6 +664,18 @@ while [[ $# -gt 0 ]]; do
             PORT="$2"
             shift 2
             ;;
+        --server)
+            SERVER_MODE="$2"
+            shift 2
+            ;;
+        --workers)
+            WORKERS="$2"
+            shift 2
+            ;;
+        --async-streaming)
+            ASYNC_STREAMING=true
+            shift
+            ;;
         *)
             echo "Unknown option: $1"
             exit 1
@@ -685,6 +697,15 @@ fi
 if [ "$DEBUG_MODE" = true ]; then
     CMD="$CMD --debug"
 fi
+if [ ! -z "$SERVER_MODE" ]; then
+    CMD="$CMD --server \"$SERVER_MODE\""
+fi
+if [ ! -z "$WORKERS" ]; then
+    CMD="$CMD --workers \"$WORKERS\""
+fi
+if [ "$ASYNC_STREAMING" = true ]; then
+    CMD="$CMD --async-streaming"
+fi
 
 # Run the command
 eval "$CMD"
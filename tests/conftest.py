@@ -0,0 +1,26 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault('GURIA_DB_PATH', os.path.join(tempfile.mkdtemp(prefix='guria-test-'), 'chats.db'))
+
+import app as guria  # noqa: E402
+
+
+@pytest.fixture
+def db(tmp_path):
+    """The app module on a fresh database of its own"""
+    guria.db_pool.close_all()
+    guria.db_pool.path = str(tmp_path / 'chats.db')
+    guria.init_db()
+    yield guria
+    guria.db_pool.close_all()
+
+
+@pytest.fixture
+def client(db):
+    return db.app.test_client()
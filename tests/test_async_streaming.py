@@ -0,0 +1,103 @@
+"""Concurrency test for --async-streaming: token streams mixed with plain Flask routes.
+
+Starts the mock Ollama server and the app with --async-streaming on free ports,
+then streams /chat answers while other clients read /chat_history and
+/chat/<id>. Every request must succeed. Needs the optional async server
+packages (uvicorn, httpx, a2wsgi) and is skipped without them.
+"""
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import pytest
+import requests
+
+pytest.importorskip('uvicorn')
+pytest.importorskip('httpx')
+pytest.importorskip('a2wsgi')
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+from load_test import free_port, seed_records, stop_process, wait_ready  # noqa: E402
+
+MODEL = 'llama2:latest'
+STREAMS = 8
+READERS = 8
+DURATION = 8
+
+
+@pytest.fixture(scope='module')
+def server():
+    with tempfile.TemporaryDirectory(prefix='guria-test-') as workdir:
+        mock_port, port = free_port(), free_port()
+        mock = subprocess.Popen(
+            [sys.executable, os.path.join(ROOT, 'benchmarks', 'mock_ollama.py'), '--port', str(mock_port),
+             '--tokens-per-second', '100', '--first-token-delay', '0.05', '--load-delay', '0',
+             '--response-tokens', '150', '--parallel', str(STREAMS), '--models', MODEL],
+            stdout=subprocess.DEVNULL)
+        env = dict(os.environ,
+                   OLLAMA_BASE_URL=f"http://127.0.0.1:{mock_port}",
+                   GURIA_DB_PATH=os.path.join(workdir, 'chats.db'),
+                   GURIA_EXPORT_DIR=os.path.join(workdir, 'exports'),
+                   GURIA_MODEL_CONCURRENCY=str(STREAMS))
+        log_path = os.path.join(workdir, 'server.log')
+        with open(log_path, 'w') as log:
+            app = subprocess.Popen(
+                [sys.executable, os.path.join(ROOT, 'app.py'), '--force-http', '--port', str(port), '--async-streaming'],
+                cwd=ROOT, env=env, stdout=log, stderr=subprocess.STDOUT)
+        base = f"http://127.0.0.1:{port}"
+        try:
+            wait_ready(base, app, log_path)
+            import random
+            response = requests.post(f"{base}/import", data=seed_records(random.Random(1), 20, 4, MODEL),
+                                     headers={'Content-Type': 'application/x-ndjson'}, timeout=60)
+            assert response.status_code == 200, response.text
+            yield base
+        finally:
+            stop_process(app)
+            stop_process(mock)
+
+
+def stream_answer(base, failures):
+    with requests.post(f"{base}/chat", json={'prompt': f"question {time.monotonic()}", 'model': MODEL},
+                       stream=True, timeout=60) as response:
+        if response.status_code != 200:
+            failures.append(f"/chat {response.status_code}")
+            return
+        frames = [json.loads(line[6:]) for line in response.iter_lines() if line.startswith(b'data: ')]
+    if not frames or not frames[-1].get('done'):
+        failures.append(f"/chat ended with {frames[-1:] }")
+
+
+def test_streams_do_not_break_other_routes(server):
+    chat_ids = [chat['id'] for chat in requests.get(f"{server}/chat_history", params={'limit': 100}).json()['chats']]
+    assert chat_ids
+    failures = []
+    reads = []
+    deadline = time.monotonic() + DURATION
+
+    def streamer():
+        while time.monotonic() < deadline:
+            stream_answer(server, failures)
+
+    def reader(index):
+        session = requests.Session()
+        while time.monotonic() < deadline:
+            path = '/chat_history' if index % 2 else f"/chat/{chat_ids[len(reads) % len(chat_ids)]}"
+            response = session.get(server + path, timeout=30)
+            reads.append(path)
+            if response.status_code != 200:
+                failures.append(f"{path} {response.status_code}: {response.text[:200]}")
+
+    threads = [threading.Thread(target=streamer) for _ in range(STREAMS)]
+    threads += [threading.Thread(target=reader, args=(index,)) for index in range(READERS)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert reads
+    assert not failures, failures[:5]
@@ -0,0 +1,63 @@
+def save(client, prompt):
+    response = client.post('/save_chat', json={'model': 'llama2', 'prompt': prompt, 'response': 'ok'})
+    assert response.status_code == 200
+    return response.get_json()['id']
+
+
+def test_pages_follow_the_cursor_without_gaps_or_repeats(db, client):
+    ids = [save(client, f"question {n}") for n in range(7)]
+    with db.db_connection() as conn:
+        # Chats sharing a timestamp are ordered by id, so the cursor needs both
+        conn.execute("UPDATE chats SET timestamp = '2026-01-01T00:00:00' WHERE id IN (?, ?, ?)", ids[2:5])
+        conn.commit()
+
+    seen, cursor = [], None
+    while True:
+        page = client.get('/chat_history', query_string={'limit': 2, **({'cursor': cursor} if cursor else {})}).get_json()
+        seen += [chat['id'] for chat in page['chats']]
+        cursor = page['next_cursor']
+        if cursor is None:
+            break
+    assert seen == [ids[6], ids[5], ids[1], ids[0], ids[4], ids[3], ids[2]]
+    assert client.get('/chat_history?cursor=not-a-cursor').status_code == 400
+
+
+def test_changes_since_a_version_are_collapsed_per_chat(db, client):
+    kept = save(client, 'kept')
+    version = client.get('/chat_history').get_json()['version']
+    added = save(client, 'added')
+    client.post('/delete_chat', json={'chat_id': kept})
+
+    changes = client.get('/chat_history/changes', query_string={'since': version}).get_json()
+    assert changes['reset'] is False
+    assert changes['version'] > version
+    assert {(change['op'], change.get('id') or change['chat']['id']) for change in changes['changes']} == {
+        ('insert', added), ('delete', kept)}
+    assert client.get('/chat_history/changes', query_string={'since': changes['version']}).get_json()['changes'] == []
+
+
+def test_changes_reset_after_a_clear_or_an_unknown_version(db, client):
+    client.post('/clear_history')
+    first = save(client, 'first')
+    changes = client.get('/chat_history/changes', query_string={'since': 0}).get_json()
+    assert changes['reset'] is True
+    assert [(change['op'], change['chat']['id']) for change in changes['changes']] == [('insert', first)]
+
+    save(client, 'before')
+    version = client.get('/chat_history').get_json()['version']
+    client.post('/clear_history')
+    after = save(client, 'after')
+
+    changes = client.get('/chat_history/changes', query_string={'since': version}).get_json()
+    assert changes['reset'] is True
+    # The client drops its list and reloads it
+    assert [chat['id'] for chat in client.get('/chat_history').get_json()['chats']] == [after]
+
+    latest = changes['version']
+    assert client.get('/chat_history/changes', query_string={'since': latest + 5}).get_json()['reset'] is True
+    with db.db_connection() as conn:
+        # As if the change log had been pruned past the client's version
+        conn.execute('DELETE FROM chat_changes WHERE version < ?', (latest,))
+        conn.commit()
+    stale = client.get('/chat_history/changes', query_string={'since': version}).get_json()
+    assert stale == {'version': latest, 'reset': True, 'changes': []}
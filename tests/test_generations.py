@@ -0,0 +1,123 @@
+import json
+import threading
+import time
+
+import pytest
+
+
+class FakeChatResponse:
+    """Streams ``pieces`` of an answer as /api/chat chunks; without ``finish`` it then hangs until closed"""
+
+    status_code = 200
+    text = ''
+
+    def __init__(self, pieces, finish=True):
+        self.pieces = pieces
+        self.finish = finish
+        self.closed = threading.Event()
+
+    def iter_lines(self):
+        for piece in self.pieces:
+            yield json.dumps({'message': {'role': 'assistant', 'content': piece}, 'done': False}).encode()
+        if not self.finish:
+            self.closed.wait(10)
+            raise OSError('closed')
+        yield json.dumps({'message': {'role': 'assistant', 'content': ''}, 'done': True,
+                          'eval_count': len(self.pieces)}).encode()
+
+    def close(self):
+        self.closed.set()
+
+
+@pytest.fixture
+def ollama(db, monkeypatch):
+    """The app with Ollama replaced by a fake that answers with ``ollama.responses``, in order"""
+    class FakeOllama:
+        responses = []
+
+        def chat(self, payload, stream=True):
+            return self.responses.pop(0)
+
+    fake = FakeOllama()
+    monkeypatch.setattr(db, 'ollama_client', fake)
+    monkeypatch.setattr(db, 'check_ollama_status', lambda: (True, None))
+    monkeypatch.setattr(db, 'generation_scheduler', db.GenerationScheduler())
+    monkeypatch.setattr(db, 'generation_sessions', db.GenerationSessions())
+    return fake
+
+
+def events(body):
+    """``(id, payload)`` for every data frame of an SSE body; id is None for frames sent without one"""
+    out = []
+    for frame in body.split('\n\n'):
+        fields = dict(line.split(': ', 1) for line in frame.splitlines() if not line.startswith(':'))
+        if 'data' in fields:
+            out.append((int(fields['id']) if 'id' in fields else None, json.loads(fields['data'])))
+    return out
+
+
+def start_generation(db, client, prompt='hi'):
+    response = client.post('/chat', json={'prompt': prompt, 'model': 'llama2', 'coalesce_ms': 0})
+    assert response.status_code == 200
+    generation = db.generation_sessions.get(response.headers['X-Generation-Id'])
+    return response, generation
+
+
+def wait_until(predicate, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline
+        time.sleep(0.02)
+
+
+def test_reconnecting_with_last_event_id_resumes_after_that_event(db, client, ollama):
+    ollama.responses.append(FakeChatResponse(['one ', 'two ', 'three ', 'four']))
+    response, generation = start_generation(db, client)
+    wait_until(lambda: generation.finished)
+    response.close()
+
+    everything = events(client.get(f"/generations/{generation.id}/events").get_data(as_text=True))
+    assert [event_id for event_id, _ in everything] == list(range(1, len(everything) + 1))
+    assert ''.join(payload.get('response', '') for _, payload in everything) == 'one two three four'
+    assert everything[-1][1] == {'done': True, 'chat_id': generation.turn.chat_id}
+
+    resumed = events(client.get(f"/generations/{generation.id}/events",
+                                headers={'Last-Event-ID': '3'}).get_data(as_text=True))
+    assert resumed == everything[3:]
+    by_parameter = events(client.get(f"/generations/{generation.id}/events?last_event_id=3").get_data(as_text=True))
+    assert by_parameter == everything[3:]
+
+
+def test_resuming_past_the_ring_buffer_resets_to_the_whole_answer(db):
+    generation = db.GenerationSession(turn=None, buffer_frames=3)
+    for piece in 'abcde':
+        generation.emit(db.sse_event({'response': piece}))
+
+    with generation.changed:
+        assert events(generation.frames_after(3)) == [(4, {'response': 'd'}), (5, {'response': 'e'})]
+        assert events(generation.frames_after(0)) == [(2, {'response': 'ab'}), (3, {'response': 'c'}),
+                                                      (4, {'response': 'd'}), (5, {'response': 'e'})]
+        stale = events(generation.frames_after(1))
+    assert stale[0] == (None, {'reset': True})
+    assert ''.join(payload.get('response', '') for _, payload in stale[1:]) == 'abcde'
+
+
+def test_cancelling_keeps_the_partial_answer(db, client, ollama):
+    upstream = FakeChatResponse(['partial ', 'answer'], finish=False)
+    ollama.responses.append(upstream)
+    response, generation = start_generation(db, client, prompt='tell me a story')
+    wait_until(lambda: generation.turn.text == 'partial answer')
+
+    cancelled = client.post(f"/generations/{generation.id}/cancel")
+    assert cancelled.status_code == 200
+    assert cancelled.get_json()['status'] == 'cancelled'
+    assert upstream.closed.is_set()
+    response.close()
+
+    chat_id = cancelled.get_json()['chat_id']
+    stored = client.get(f"/chat/{chat_id}").get_json()
+    assert stored['prompt'] == 'tell me a story'
+    assert stored['response'] == 'partial answer'
+    last = events(client.get(f"/generations/{generation.id}/events").get_data(as_text=True))[-1]
+    assert last[1] == {'cancelled': True, 'chat_id': chat_id}
+    assert client.post('/generations/unknown/cancel').status_code == 404
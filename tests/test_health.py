@@ -0,0 +1,29 @@
+import threading
+import time
+
+
+def test_snapshot_does_not_wait_for_the_first_probe(db, monkeypatch):
+    release = threading.Event()
+
+    def hung_tags(*args, **kwargs):
+        release.wait(5)
+        raise db.requests.exceptions.ConnectionError('refused')
+
+    monkeypatch.setattr(db.ollama_client, 'tags', hung_tags)
+    monitor = db.OllamaHealthMonitor(timeout=5)
+    monkeypatch.setattr(db, 'ollama_health', monitor)
+    try:
+        started = time.monotonic()
+        status = monitor.snapshot()
+        assert time.monotonic() - started < 0.5
+        assert status['status'] == 'unknown'
+        assert db.check_ollama_status()[0] is None
+
+        response = db.app.test_client().get('/health')
+        assert response.status_code == 503
+        assert response.get_json()['status'] == 'unknown'
+    finally:
+        release.set()
+    assert monitor.wait(5)
+    assert monitor.snapshot()['status'] == 'down'
+    assert db.check_ollama_status()[0] is False
@@ -0,0 +1,148 @@
+import io
+import json
+import threading
+
+import pytest
+
+
+def chat_record(title, *turns):
+    messages = []
+    for prompt, answer in turns:
+        messages += [{'role': 'user', 'content': prompt}, {'role': 'assistant', 'content': answer}]
+    return json.dumps({'title': title, 'model': 'llama2', 'messages': messages}) + '\n'
+
+
+class PausedUpload:
+    """Upload body that sends ``head``, then blocks until ``resume`` is set before sending ``tail``"""
+
+    def __init__(self, head, tail=b''):
+        self.parts = [head, tail]
+        self.waiting = threading.Event()
+        self.resume = threading.Event()
+
+    def read(self, size=-1):
+        if not self.parts:
+            return b''
+        if len(self.parts) == 1:
+            self.waiting.set()
+            assert self.resume.wait(10)
+        return self.parts.pop(0)
+
+
+def fts_integrity(conn):
+    conn.execute("INSERT INTO messages_fts (messages_fts, rank) VALUES ('integrity-check', 1)")
+
+
+def search_ids(conn, text):
+    return sorted(row[0] for row in conn.execute('SELECT rowid FROM messages_fts WHERE messages_fts MATCH ?', (text,)))
+
+
+def run_import(db, upload, **kwargs):
+    result = {}
+    thread = threading.Thread(target=lambda: result.update(db.import_chats(upload, **kwargs)))
+    thread.start()
+    return thread, result
+
+
+@pytest.mark.parametrize('existing', [False, True])
+def test_checkpointed_generation_during_import_keeps_search_index_intact(db, existing):
+    older_id = db.store_chat_response('llama2', 'older question', 'older answer')[1] if existing else None
+    upload = PausedUpload(chat_record('imported', ('zebra question', 'zebra answer')).encode(),
+                          chat_record('later', ('yak question', 'yak answer')).encode())
+    thread, result = run_import(db, upload, batch_messages=1)
+    try:
+        assert upload.waiting.wait(10)
+        # A generation checkpoints its partial answer, then finishes, while the import is running
+        chat_id, message_id = db.store_chat_response('llama2', 'quokka question', 'partial')
+        db.update_chat_response(message_id, 'llama2', 'quokka answer complete')
+        if existing:
+            db.update_chat_response(older_id, 'llama2', 'older answer edited')
+    finally:
+        upload.resume.set()
+        thread.join(10)
+
+    assert result['chats'] == 2
+    with db.db_connection() as conn:
+        fts_integrity(conn)
+        assert search_ids(conn, 'partial') == []
+        assert search_ids(conn, 'complete') == [message_id]
+        assert len(search_ids(conn, 'zebra')) == 2
+        if existing:
+            assert search_ids(conn, 'edited') == [older_id]
+        assert conn.execute('SELECT count(*) FROM messages_fts_docsize').fetchone()[0] == \
+            conn.execute('SELECT count(*) FROM messages').fetchone()[0]
+
+
+def test_import_into_empty_database_keeps_unique_message_order(db):
+    upload = PausedUpload(chat_record('imported', ('first question', 'first answer')).encode())
+    thread, result = run_import(db, upload, batch_messages=1)
+    try:
+        assert upload.waiting.wait(10)
+        with db.db_connection() as conn:
+            indexes = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+        assert 'idx_messages_chat_seq' in indexes
+        chat_id = db.store_chat_response('llama2', 'live question', 'live answer')[0]
+        db.store_chat_response('llama2', 'follow-up', 'second answer', chat_id)
+    finally:
+        upload.resume.set()
+        thread.join(10)
+
+    assert result['chats'] == 1
+    with db.db_connection() as conn:
+        assert conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'idx_chats_timestamp'").fetchone()
+        assert [row[0] for row in conn.execute('SELECT seq FROM messages WHERE chat_id = ? ORDER BY seq', (chat_id,))] \
+            == [1, 2, 3, 4]
+
+
+def schema(conn):
+    return sorted(conn.execute("SELECT type, name, sql FROM sqlite_master WHERE type IN ('trigger', 'index')"))
+
+
+def test_importing_the_same_chats_twice_skips_them(db, client):
+    body = chat_record('one', ('alpha question', 'alpha answer')) + \
+        chat_record('two', ('beta question', 'beta answer'), ('more', 'still beta'))
+    first = client.post('/import', data=body, headers={'Content-Type': 'application/x-ndjson'}).get_json()
+    assert (first['chats'], first['messages'], first['duplicates']) == (2, 6, 0)
+
+    again = body + chat_record('one renamed', ('alpha question', 'alpha answer')) + '{"messages": "nope"}\n'
+    second = client.post('/import', data=again, headers={'Content-Type': 'application/x-ndjson'}).get_json()
+    assert (second['chats'], second['duplicates'], second['invalid']) == (0, 3, 1)
+    with db.db_connection() as conn:
+        assert conn.execute('SELECT count(*) FROM chats').fetchone()[0] == 2
+
+
+def test_triggers_and_indexes_are_restored_after_an_import(db, client):
+    with db.db_connection() as conn:
+        before = schema(conn)
+    body = chat_record('imported', ('gamma question', 'gamma answer'))
+    assert client.post('/import', data=body, headers={'Content-Type': 'application/x-ndjson'}).status_code == 200
+    with db.db_connection() as conn:
+        assert schema(conn) == before
+
+    # Chats written after the import are logged and indexed again
+    version = client.get('/chat_history').get_json()['version']
+    chat_id, message_id = db.store_chat_response('llama2', 'delta question', 'delta answer')
+    changes = client.get('/chat_history/changes', query_string={'since': version}).get_json()['changes']
+    assert [change['chat']['id'] for change in changes] == [chat_id]
+    with db.db_connection() as conn:
+        assert search_ids(conn, 'delta') == [message_id - 1, message_id]
+        fts_integrity(conn)
+
+
+def test_triggers_are_restored_when_an_import_fails(db):
+    class BrokenUpload(PausedUpload):
+        def read(self, size=-1):
+            if len(self.parts) == 1:
+                raise OSError('connection reset')
+            return super().read(size)
+
+    with db.db_connection() as conn:
+        before = schema(conn)
+    upload = BrokenUpload(chat_record('imported', ('epsilon question', 'epsilon answer')).encode(), b'')
+    with pytest.raises(OSError):
+        db.import_chats(upload, batch_messages=1)
+    with db.db_connection() as conn:
+        assert schema(conn) == before
+        assert len(search_ids(conn, 'epsilon')) == 2
+        fts_integrity(conn)
+    assert db.import_chats(io.BytesIO(b''))['chats'] == 0  # The import lock was released
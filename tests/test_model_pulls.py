@@ -0,0 +1,81 @@
+import json
+import subprocess
+import sys
+import time
+
+import pytest
+
+
+class FakePullResponse:
+    """Streams ``steps`` progress lines of a pull, one every ``delay`` seconds, until closed"""
+
+    status_code = 200
+    text = ''
+
+    def __init__(self, steps=200, delay=0.02):
+        self.steps = steps
+        self.delay = delay
+        self.closed = False
+
+    def iter_lines(self):
+        for step in range(1, self.steps + 1):
+            if self.closed:
+                raise OSError('closed')
+            time.sleep(self.delay)
+            yield json.dumps({'status': 'pulling abc', 'digest': 'abc', 'total': self.steps, 'completed': step}).encode()
+        yield json.dumps({'status': 'success'}).encode()
+
+    def close(self):
+        self.closed = True
+
+
+@pytest.fixture
+def pulls(db, monkeypatch):
+    class FakeOllama:
+        def pull(self, model, stream=False):
+            return FakePullResponse()
+
+    monkeypatch.setattr(db, 'ollama_client', FakeOllama())
+    monkeypatch.setattr(db.ollama_health, 'probe', lambda: {})
+    monkeypatch.setattr(db, 'model_pulls', db.ModelPulls())
+    return db
+
+
+def wait_until(predicate, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline
+        time.sleep(0.02)
+
+
+def test_events_for_an_unknown_pull_do_not_start_one(pulls):
+    client = pulls.app.test_client()
+    assert client.get('/models/pull/llama9:70b/events').status_code == 404
+    assert pulls.model_pulls.status('llama9:70b') is None
+
+
+def test_pull_started_in_one_process_is_followed_and_cancelled_from_another(pulls):
+    client = pulls.app.test_client()
+    assert client.post('/models/pull', json={'model': 'llama2'}).status_code == 202
+    wait_until(lambda: (pulls.model_pulls.status('llama2') or {}).get('completed', 0) > 0)
+
+    other = pulls.ModelPulls()  # Another prefork worker: it knows the job only through the database
+    job = other.status('llama2')
+    assert job['status'] == 'pulling'
+    assert other.start('llama2')['started_at'] == job['started_at']
+    cancelled = other.cancel('llama2')
+    wait_until(lambda: other.status('llama2')['status'] == 'cancelled')
+    assert cancelled is not None
+    assert pulls.model_pulls.status('llama2')['status'] == 'cancelled'
+
+
+def test_pull_of_a_process_that_exited_is_reported_as_failed(pulls):
+    exited = subprocess.Popen([sys.executable, '-c', 'pass'])
+    exited.wait()
+    state = {'model': 'llama2', 'status': 'pulling', 'started_at': time.time(), 'version': 3}
+    with pulls.db_connection() as conn:
+        conn.execute('INSERT INTO model_pulls (model, state, pid, updated_at) VALUES (?, ?, ?, ?)',
+                     ('llama2', json.dumps(state), exited.pid, time.time()))
+        conn.commit()
+    job = pulls.app.test_client().get('/models/pull/llama2').get_json()
+    assert job['status'] == 'error'
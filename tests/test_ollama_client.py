@@ -0,0 +1,70 @@
+import socket
+import threading
+
+import pytest
+import requests
+
+
+@pytest.fixture
+def closing_server():
+    """A server that reads each request and drops the connection without answering; counts requests"""
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    listener.listen()
+    received = []
+
+    def serve():
+        while True:
+            try:
+                conn, _ = listener.accept()
+            except OSError:
+                return
+            conn.recv(65536)
+            received.append(True)
+            conn.close()
+
+    threading.Thread(target=serve, daemon=True).start()
+    yield f"http://127.0.0.1:{listener.getsockname()[1]}", received
+    listener.close()
+
+
+@pytest.fixture
+def silent_server():
+    """A server that accepts connections and never answers"""
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    listener.listen()
+    yield f"http://127.0.0.1:{listener.getsockname()[1]}"
+    listener.close()
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def test_refused_connections_are_retried(db):
+    client = db.OllamaClient(base_url=f"http://127.0.0.1:{free_port()}", retries=2, backoff=0)
+    with pytest.raises(requests.exceptions.ConnectionError):
+        client.chat({'model': 'llama2', 'messages': []}, stream=False)
+    assert client.stats()['retries'] == 2
+    assert client.stats()['failures'] == 1
+
+
+def test_a_request_dropped_after_it_was_sent_is_not_sent_again(db, closing_server):
+    url, received = closing_server
+    client = db.OllamaClient(base_url=url, retries=2, backoff=0)
+    with pytest.raises(requests.exceptions.ConnectionError):
+        client.chat({'model': 'llama2', 'messages': []}, stream=False)
+    assert len(received) == 1
+    assert client.stats()['retries'] == 0
+    assert client.stats()['failures'] == 1
+
+
+def test_read_timeouts_are_counted_as_failures(db, silent_server):
+    client = db.OllamaClient(base_url=silent_server, retries=2, backoff=0, timeouts={'generate': (1, 0.2)})
+    with pytest.raises(requests.exceptions.ReadTimeout):
+        client.chat({'model': 'llama2', 'messages': []}, stream=False)
+    assert client.stats()['retries'] == 0
+    assert client.stats()['failures'] == 1
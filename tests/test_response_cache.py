@@ -0,0 +1,26 @@
+def payload(model='llama2', content='What is  SQLite?', **options):
+    return {'model': model, 'messages': [{'role': 'system', 'content': 'Be brief.'}, {'role': 'user', 'content': content}],
+            'options': options}
+
+
+def test_keys_ignore_whitespace_and_unicode_normalization(db):
+    cache = db.ResponseCache(models={'llama2'})
+    key = cache.key_for(payload(temperature=0))
+    assert key == cache.key_for(payload(content='  What is SQLite?\n', temperature=0))
+    assert cache.key_for(payload(content='café', temperature=0)) == cache.key_for(payload(content='café', temperature=0))
+
+
+def test_keys_differ_by_model_text_and_options(db):
+    cache = db.ResponseCache(models={'*'})
+    key = cache.key_for(payload(temperature=0))
+    assert key != cache.key_for(payload(model='mistral', temperature=0))
+    assert key != cache.key_for(payload(content='What is Postgres?', temperature=0))
+    assert key != cache.key_for(payload(temperature=0, num_ctx=4096))
+
+
+def test_only_listed_models_with_deterministic_options_are_cached(db):
+    cache = db.ResponseCache(models={'llama2'})
+    assert cache.key_for(payload(model='mistral', temperature=0)) is None
+    assert cache.key_for(payload()) is None  # Ollama samples at temperature 0.8 unless told otherwise
+    assert cache.key_for(payload(temperature=0.7)) is None
+    assert db.ResponseCache(models={'llama2'}, allow_sampled=True).key_for(payload(temperature=0.7)) is not None
@@ -0,0 +1,55 @@
+import pytest
+
+
+def test_full_queue_is_rejected_with_a_retry_hint(db):
+    scheduler = db.GenerationScheduler(default_limit=1, limits={}, queue_size=2, per_client=1)
+    running = scheduler.admit('llama2', 'a')
+    assert running.granted
+    queued = scheduler.admit('llama2', 'b')
+    assert not queued.granted
+
+    with pytest.raises(db.QueueFull) as per_client:
+        scheduler.admit('llama2', 'b')
+    assert per_client.value.retry_after >= 1
+    scheduler.admit('llama2', 'c')
+    with pytest.raises(db.QueueFull):
+        scheduler.admit('llama2', 'd')
+    assert scheduler.admit('mistral', 'd').granted  # Each model has a queue of its own
+    assert scheduler.stats()['rejected'] == 2
+
+
+def test_waiting_clients_are_served_round_robin(db):
+    scheduler = db.GenerationScheduler(default_limit=1, limits={}, queue_size=10, per_client=5)
+    running = scheduler.admit('llama2', 'greedy')
+    greedy = [scheduler.admit('llama2', 'greedy') for _ in range(3)]
+    polite = scheduler.admit('llama2', 'polite')
+    assert scheduler.position(greedy[0]) == 1
+    assert scheduler.position(polite) == 2
+    assert scheduler.position(greedy[1]) == 3
+
+    served = []
+    current = running
+    for _ in range(4):
+        scheduler.release(current)
+        current = next(ticket for ticket in greedy + [polite] if ticket.granted and not ticket.released)
+        served.append(current)
+    assert served == [greedy[0], polite, greedy[1], greedy[2]]
+
+
+def test_abandoned_tickets_give_up_their_place(db):
+    scheduler = db.GenerationScheduler(default_limit=1, limits={}, queue_size=10, per_client=5)
+    running = scheduler.admit('llama2', 'a')
+    gone = scheduler.admit('llama2', 'b')
+    waiting = scheduler.admit('llama2', 'c')
+    scheduler.release(gone)
+    assert scheduler.position(waiting) == 1
+    scheduler.release(running)
+    assert waiting.granted and not gone.granted
+
+
+def test_chat_answers_429_when_the_queue_is_full(db, client, monkeypatch):
+    monkeypatch.setattr(db, 'check_ollama_status', lambda: (True, None))
+    monkeypatch.setattr(db, 'generation_scheduler', db.GenerationScheduler(default_limit=0, limits={}, queue_size=0))
+    response = client.post('/chat', json={'prompt': 'hi', 'model': 'llama2'})
+    assert response.status_code == 429
+    assert int(response.headers['Retry-After']) == response.get_json()['retry_after'] >= 1